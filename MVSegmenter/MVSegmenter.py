@@ -1,6 +1,14 @@
+import contextlib
 import importlib
+import json
 import logging
 import math
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from timeit import default_timer as timer
 
@@ -13,6 +21,7 @@ import sitkUtils
 import slicer
 import vtk
 from slicer.ScriptedLoadableModule import *
+from vtk.util import numpy_support
 
 
 #
@@ -57,9 +66,17 @@ class MVSegmenterWidget(ScriptedLoadableModuleWidget):
         self.papillaryMarkupsNode = None
         self.papillaryMarkupNodeObserver = None
 
+        # Minimum time between live preview updates
+        self.previewFrameBudgetMs = 100
+        self.pendingMoldPreview = False
+        self.pendingAnnulusPreview = False
+
     def setup(self):
         ScriptedLoadableModuleWidget.setup(self)
 
+        # Default number of threads of SimpleITK, VTK SMP and torch
+        self.logic.configureThreads()
+
         # Vertical spacing between sections
         vSpace = 10
 
@@ -130,6 +147,12 @@ class MVSegmenterWidget(ScriptedLoadableModuleWidget):
         self.runDeepMVButton.enabled = False
         self.layout.addWidget(self.runDeepMVButton)
 
+        self.refineDeepMVCheckBox = qt.QCheckBox("Refine with active contours")
+        self.refineDeepMVCheckBox.toolTip = "Initialize the leaflet level set from the DeepMV result so it can be " \
+                                            "refined with the leaflet segmentation iterations"
+        self.refineDeepMVCheckBox.checked = False
+        self.layout.addWidget(self.refineDeepMVCheckBox)
+
         # Add vertical spacer
         self.layout.addSpacing(vSpace)
 
@@ -179,6 +202,11 @@ class MVSegmenterWidget(ScriptedLoadableModuleWidget):
         self.incrementFirstButton500.enabled = False
         incrementFirstHBox.addWidget(self.incrementFirstButton500)
 
+        self.convergeFirstButton = qt.QPushButton("Auto")
+        self.convergeFirstButton.toolTip = "Run the algorithm until it converges, click again to stop"
+        self.convergeFirstButton.enabled = False
+        incrementFirstHBox.addWidget(self.convergeFirstButton)
+
         self.undoButtonBP = qt.QPushButton("Undo")
         self.undoButtonBP.toolTip = "Undo previous step"
         self.undoButtonBP.enabled = False
@@ -232,6 +260,11 @@ class MVSegmenterWidget(ScriptedLoadableModuleWidget):
         self.incrementButton200.enabled = False
         incrementHBox.addWidget(self.incrementButton200)
 
+        self.convergeButton = qt.QPushButton("Auto")
+        self.convergeButton.toolTip = "Run the algorithm until it converges, click again to stop"
+        self.convergeButton.enabled = False
+        incrementHBox.addWidget(self.convergeButton)
+
         self.undoButtonLeaflet = qt.QPushButton("Undo")
         self.undoButtonLeaflet.toolTip = "Undo previous step"
         self.undoButtonLeaflet.enabled = False
@@ -244,6 +277,20 @@ class MVSegmenterWidget(ScriptedLoadableModuleWidget):
 
         secondPassFormLayout.addRow("Increment Segmentation", incrementHBox)
 
+        checkpointHBox = qt.QHBoxLayout()
+
+        self.saveCheckpointButton = qt.QPushButton("Save Checkpoint")
+        self.saveCheckpointButton.toolTip = "Save the level sets, speed image and undo history next to the scene"
+        self.saveCheckpointButton.enabled = False
+        checkpointHBox.addWidget(self.saveCheckpointButton)
+
+        self.loadCheckpointButton = qt.QPushButton("Resume Checkpoint")
+        self.loadCheckpointButton.toolTip = "Restore the level sets, speed image and undo history saved with the scene"
+        self.loadCheckpointButton.enabled = False
+        checkpointHBox.addWidget(self.loadCheckpointButton)
+
+        semiAutoFormLayout.addRow("Session", checkpointHBox)
+
         # Add vertical spacer
         self.layout.addSpacing(vSpace)
 
@@ -257,6 +304,12 @@ class MVSegmenterWidget(ScriptedLoadableModuleWidget):
 
         exportModelFormLayout = qt.QFormLayout(generateSurfaceMoldCollapsibleButton)
 
+        self.livePreviewCheckBox = qt.QCheckBox()
+        self.livePreviewCheckBox.checked = False
+        self.livePreviewCheckBox.setToolTip("Preview the mold and annulus projection while adjusting the sliders. "
+                                            "Generate Mold and Project Annulus apply the previewed values.")
+        exportModelFormLayout.addRow("Live Preview", self.livePreviewCheckBox)
+
         self.baseDepthSlider = ctk.ctkSliderWidget()
         self.baseDepthSlider.singleStep = 0.1
         self.baseDepthSlider.pageStep = 1
@@ -291,6 +344,12 @@ class MVSegmenterWidget(ScriptedLoadableModuleWidget):
         self.projectAnnulusButton.enabled = False
         exportModelFormLayout.addRow(self.projectAnnulusButton)
 
+        self.meshSubtractionCheckBox = qt.QCheckBox()
+        self.meshSubtractionCheckBox.checked = False
+        self.meshSubtractionCheckBox.setToolTip(
+            "Subtract the annulus on the surface models instead of the labelmaps, keeping the surface resolution")
+        exportModelFormLayout.addRow("Mesh Subtraction", self.meshSubtractionCheckBox)
+
         self.subtractAnnulusButton = qt.QPushButton("Subtract Annulus")
         self.subtractAnnulusButton.toolTip = "Subtract annulus from mold"
         self.subtractAnnulusButton.enabled = False
@@ -318,6 +377,21 @@ class MVSegmenterWidget(ScriptedLoadableModuleWidget):
         self.exportMoldButton.enabled = False
         exportModelFormLayout.addRow(self.exportMoldButton)
 
+        self.exportDirectoryButton = ctk.ctkDirectoryButton()
+        self.exportDirectoryButton.directory = qt.QDir.homePath()
+        self.exportDirectoryButton.setToolTip("Directory the mold parts are written to")
+        exportModelFormLayout.addRow("Export Directory", self.exportDirectoryButton)
+
+        self.exportFormatSelector = qt.QComboBox()
+        self.exportFormatSelector.addItems(['stl', 'ply'])
+        self.exportFormatSelector.setToolTip("File format of the exported mold parts")
+        exportModelFormLayout.addRow("Export Format", self.exportFormatSelector)
+
+        self.exportMoldFilesButton = qt.QPushButton("Export Mold to Files")
+        self.exportMoldFilesButton.toolTip = "Write the mold parts and a manifest to the export directory."
+        self.exportMoldFilesButton.enabled = False
+        exportModelFormLayout.addRow(self.exportMoldFilesButton)
+
         # Add vertical spacer
         self.layout.addSpacing(vSpace)
 
@@ -327,6 +401,7 @@ class MVSegmenterWidget(ScriptedLoadableModuleWidget):
         self.incrementFirstButton50.connect('clicked(bool)', self.onIncrementFirst50Button)
         self.incrementFirstButton100.connect('clicked(bool)', self.onIncrementFirst100Button)
         self.incrementFirstButton500.connect('clicked(bool)', self.onIncrementFirst500Button)
+        self.convergeFirstButton.connect('clicked(bool)', self.onConvergeFirstButton)
         self.undoButtonBP.connect('clicked(bool)', self.onUndoButtonBP)
         self.redoButtonBP.connect('clicked(bool)', self.onRedoButtonBP)
 
@@ -334,8 +409,11 @@ class MVSegmenterWidget(ScriptedLoadableModuleWidget):
         self.incrementButton10.connect('clicked(bool)', self.onIncrement10Button)
         self.incrementButton50.connect('clicked(bool)', self.onIncrement50Button)
         self.incrementButton200.connect('clicked(bool)', self.onIncrement200Button)
+        self.convergeButton.connect('clicked(bool)', self.onConvergeButton)
         self.undoButtonLeaflet.connect('clicked(bool)', self.onUndoButtonLeaflet)
         self.redoButtonLeaflet.connect('clicked(bool)', self.onRedoButtonLeaflet)
+        self.saveCheckpointButton.connect('clicked(bool)', self.onSaveCheckpointButton)
+        self.loadCheckpointButton.connect('clicked(bool)', self.onLoadCheckpointButton)
 
         self.heartValveSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
         self.inputSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
@@ -351,6 +429,28 @@ class MVSegmenterWidget(ScriptedLoadableModuleWidget):
         self.deleteLastPapillaryButton.connect('clicked(bool)', self.onDeleteLastPapillaryButton)
         self.deleteAllPapillarryButton.connect('clicked(bool)', self.onDeleteAllPapillaryButton)
         self.exportMoldButton.connect('clicked(bool)', self.onExportModelButton)
+        self.exportMoldFilesButton.connect('clicked(bool)', self.onExportMoldFilesButton)
+
+        self.livePreviewCheckBox.connect('toggled(bool)', self.onLivePreviewToggled)
+        self.baseDepthSlider.connect('valueChanged(double)', self.onBaseDepthSliderChanged)
+        self.annulusOffsetSlider.connect('valueChanged(double)', self.onAnnulusOffsetSliderChanged)
+
+        # Throttle preview updates to the frame budget
+        self.previewTimer = qt.QTimer()
+        self.previewTimer.setSingleShot(True)
+        self.previewTimer.setInterval(self.previewFrameBudgetMs)
+        self.previewTimer.connect('timeout()', self.onPreviewTimer)
+
+        # Poll automatic convergence running on a worker thread
+        self.convergenceSegNode = None
+        self.convergenceTimer = qt.QTimer()
+        self.convergenceTimer.setInterval(200)
+        self.convergenceTimer.connect('timeout()', self.onConvergenceTimer)
+
+        # Release the state of a case when its segmentation node is removed or the scene is closed
+        self.sceneObservers = [
+            slicer.mrmlScene.AddObserver(slicer.mrmlScene.NodeRemovedEvent, self.onNodeRemoved),
+            slicer.mrmlScene.AddObserver(slicer.mrmlScene.EndCloseEvent, self.onSceneEndClose)]
 
         # Add vertical spacer
         self.layout.addStretch(1)
@@ -359,10 +459,49 @@ class MVSegmenterWidget(ScriptedLoadableModuleWidget):
         self.onSelect()
 
     def cleanup(self):
+        for observer in self.sceneObservers:
+            slicer.mrmlScene.RemoveObserver(observer)
+        self.sceneObservers = []
+        self.previewTimer.stop()
+        self.convergenceTimer.stop()
+        if self.convergenceSegNode:
+            self.logic.abortConvergence(self.convergenceSegNode)
+        self.logic.removeContourPreview()
         self.papillaryMarkupsNode.RemoveObserver(self.papillaryMarkupNodeObserver)
         self.papillaryMarkupsNode = None
         self.papillaryMarkupNodeObserver = None
 
+    @vtk.calldata_type(vtk.VTK_OBJECT)
+    def onNodeRemoved(self, caller, event, node):
+        if not node.IsA('vtkMRMLSegmentationNode'):
+            return
+
+        if node is self.convergenceSegNode:
+            self.stopConvergenceTimer()
+        self.logic.removeSession(node)
+
+    def onSceneEndClose(self, caller, event):
+        if self.convergenceSegNode:
+            self.stopConvergenceTimer()
+        self.logic.removeAllSessions()
+
+    def stopConvergenceTimer(self):
+        # Stop polling a convergence whose case is gone, the session removal aborts it
+        self.convergenceTimer.stop()
+        removedSegNode = self.convergenceSegNode
+        self.convergenceSegNode = None
+        self.logic.removeContourPreview()
+        for segmentId in ('BP Segmentation', 'Leaflet Segmentation'):
+            node = slicer.util.getFirstNodeByName(self.logic.getPreviewModelName(removedSegNode, segmentId))
+            if node:
+                slicer.mrmlScene.RemoveNode(node)
+        self.convergeFirstButton.text = "Auto"
+        self.convergeButton.text = "Auto"
+
+        # The case of the convergence is gone, show the state of the selected case if it is another one
+        segNode = self.outputSegmentationSelector.currentNode()
+        self.updateIterationButtons(segNode if segNode is not removedSegNode else None)
+
     def setupPapillaryMarkups(self):
         if self.papillaryMarkupsNode:
             if self.papillaryMarkupsNode.GetScene():
@@ -396,6 +535,8 @@ class MVSegmenterWidget(ScriptedLoadableModuleWidget):
 
         self.runDeepMVButton.enabled = self.heartValveSelector.currentNode() and self.inputSelector.currentNode() and self.outputSegmentationSelector.currentNode()
         self.initBPButton.enabled = self.heartValveSelector.currentNode() and self.inputSelector.currentNode() and self.outputSegmentationSelector.currentNode()
+        self.saveCheckpointButton.enabled = self.outputSegmentationSelector.currentNode() is not None
+        self.loadCheckpointButton.enabled = self.outputSegmentationSelector.currentNode() is not None
         # self.generateSurfaceMarkups.enabled = self.heartValveSelector.currentNode() and self.outputSegmentationSelector.currentNode() and self.markupsSelector.currentNode()
         self.generateMoldButton.enabled = self.heartValveSelector.currentNode() \
                                           and self.outputSegmentationSelector.currentNode() \
@@ -409,6 +550,7 @@ class MVSegmenterWidget(ScriptedLoadableModuleWidget):
 
         numberOfPoints = self.papillaryMarkupsNode.GetNumberOfDefinedControlPoints()
         self.exportMoldButton.enabled = self.projectAnnulusButton.enabled and numberOfPoints >= 2
+        self.exportMoldFilesButton.enabled = self.exportMoldButton.enabled
         self.subtractAnnulusButton.enabled = self.projectAnnulusButton.enabled and self.outputSegmentationSelector.currentNode().GetSegmentation().GetSegment(
             'Projected_Annulus')
 
@@ -421,8 +563,16 @@ class MVSegmenterWidget(ScriptedLoadableModuleWidget):
             # This can be a long operation - indicate it to the user
             qt.QApplication.setOverrideCursor(qt.Qt.WaitCursor)
 
+            refine = self.refineDeepMVCheckBox.checked
             self.logic.runDeepMitral(self.heartValveSelector.currentNode(), self.inputSelector.currentNode(),
-                                     self.outputSegmentationSelector.currentNode())
+                                     self.outputSegmentationSelector.currentNode(), initializeLevelSet=refine)
+            if refine:
+                self.incrementButton10.enabled = True
+                self.incrementButton50.enabled = True
+                self.incrementButton200.enabled = True
+                self.convergeButton.enabled = True
+                session = self.logic.getSession(self.outputSegmentationSelector.currentNode())
+                self.undoButtonLeaflet.enabled = len(session.undoLeafletLevelSetStack) > 0
             self.onSelect()
         finally:
             qt.QApplication.restoreOverrideCursor()
@@ -437,43 +587,20 @@ class MVSegmenterWidget(ScriptedLoadableModuleWidget):
             self.incrementFirstButton50.enabled = True
             self.incrementFirstButton100.enabled = True
             self.incrementFirstButton500.enabled = True
+            self.convergeFirstButton.enabled = True
             self.initLeafletButton.enabled = True
             self.onSelect()
         finally:
             qt.QApplication.restoreOverrideCursor()
 
     def onIncrementFirst50Button(self):
-        try:
-            # This can be a long operation - indicate it to the user
-            qt.QApplication.setOverrideCursor(qt.Qt.WaitCursor)
-
-            self.logic.iterateFirstPass(50, self.outputSegmentationSelector.currentNode())
-            self.undoButtonBP.enabled = True
-
-        finally:
-            qt.QApplication.restoreOverrideCursor()
+        self.toggleConvergence('BP Segmentation', 50)
 
     def onIncrementFirst100Button(self):
-        try:
-            # This can be a long operation - indicate it to the user
-            qt.QApplication.setOverrideCursor(qt.Qt.WaitCursor)
-
-            self.logic.iterateFirstPass(100, self.outputSegmentationSelector.currentNode())
-            self.undoButtonBP.enabled = True
-
-        finally:
-            qt.QApplication.restoreOverrideCursor()
+        self.toggleConvergence('BP Segmentation', 100)
 
     def onIncrementFirst500Button(self):
-        try:
-            # This can be a long operation - indicate it to the user
-            qt.QApplication.setOverrideCursor(qt.Qt.WaitCursor)
-
-            self.logic.iterateFirstPass(500, self.outputSegmentationSelector.currentNode())
-            self.undoButtonBP.enabled = True
-
-        finally:
-            qt.QApplication.restoreOverrideCursor()
+        self.toggleConvergence('BP Segmentation', 500)
 
     def onInitLeafletButton(self):
         try:
@@ -484,36 +611,92 @@ class MVSegmenterWidget(ScriptedLoadableModuleWidget):
             self.incrementButton10.enabled = True
             self.incrementButton50.enabled = True
             self.incrementButton200.enabled = True
+            self.convergeButton.enabled = True
             self.onSelect()
 
         finally:
             qt.QApplication.restoreOverrideCursor()
 
     def onIncrement10Button(self):
-        self.logic.iterateSecondPass(10, self.outputSegmentationSelector.currentNode())
-        self.undoButtonLeaflet.enabled = True
+        self.toggleConvergence('Leaflet Segmentation', 10)
 
     def onIncrement50Button(self):
-        try:
-            # This can be a long operation - indicate it to the user
-            qt.QApplication.setOverrideCursor(qt.Qt.WaitCursor)
+        self.toggleConvergence('Leaflet Segmentation', 50)
 
-            self.logic.iterateSecondPass(50, self.outputSegmentationSelector.currentNode())
-            self.undoButtonLeaflet.enabled = True
+    def onIncrement200Button(self):
+        self.toggleConvergence('Leaflet Segmentation', 200)
 
-        finally:
-            qt.QApplication.restoreOverrideCursor()
+    def onConvergeFirstButton(self):
+        self.toggleConvergence('BP Segmentation')
 
-    def onIncrement200Button(self):
-        try:
-            # This can be a long operation - indicate it to the user
-            qt.QApplication.setOverrideCursor(qt.Qt.WaitCursor)
+    def onConvergeButton(self):
+        self.toggleConvergence('Leaflet Segmentation')
 
-            self.logic.iterateSecondPass(200, self.outputSegmentationSelector.currentNode())
-            self.undoButtonLeaflet.enabled = True
+    def toggleConvergence(self, segmentId, nIter=None):
+        if self.convergenceSegNode:
+            self.logic.abortConvergence(self.convergenceSegNode)
+            return
 
-        finally:
-            qt.QApplication.restoreOverrideCursor()
+        # Iterations run on a worker, intermediate contours are drawn as a slice view outline
+        segNode = self.outputSegmentationSelector.currentNode()
+        if not self.logic.startConvergence(segNode, segmentId, nIter=nIter, snapshotCallback=self.onContourSnapshot):
+            return
+
+        self.convergenceSegNode = segNode
+        self.setIterationButtonsEnabled(False, segmentId)
+        self.convergenceTimer.start()
+
+    def setIterationButtonsEnabled(self, enabled, segmentId=None):
+        buttons = [self.initBPButton, self.incrementFirstButton50, self.incrementFirstButton100,
+                   self.incrementFirstButton500, self.convergeFirstButton, self.undoButtonBP, self.redoButtonBP,
+                   self.initLeafletButton, self.incrementButton10, self.incrementButton50, self.incrementButton200,
+                   self.convergeButton, self.undoButtonLeaflet, self.redoButtonLeaflet, self.loadCheckpointButton]
+        for button in buttons:
+            button.enabled = enabled
+
+        # Keep the running pass's button to stop it
+        if not enabled:
+            stopButton = self.convergeFirstButton if segmentId == 'BP Segmentation' else self.convergeButton
+            stopButton.enabled = True
+            stopButton.text = "Stop"
+
+    def onContourSnapshot(self, levelSet, convergence):
+        session = self.logic.getSession(self.convergenceSegNode)
+        self.logic.updateContourPreview(levelSet, session.speedImgRefNode)
+
+    def onConvergenceTimer(self):
+        convergence = self.logic.pollConvergence(self.convergenceSegNode)
+        if convergence and convergence.status == 'running':
+            button = self.convergeFirstButton if convergence.segmentId == 'BP Segmentation' else self.convergeButton
+            button.toolTip = "{0} iterations, RMS change {1}".format(convergence.iterations, convergence.rmsChange)
+            return
+
+        self.convergenceTimer.stop()
+        self.logic.removeContourPreview()
+        segNode = self.convergenceSegNode
+        self.convergenceSegNode = None
+
+        self.convergeFirstButton.text = "Auto"
+        self.convergeButton.text = "Auto"
+        self.updateIterationButtons(segNode)
+
+    def updateIterationButtons(self, segNode=None):
+        # Enable the passes and undo/redo steps the session of the case has level sets for, none without a case
+        self.setIterationButtonsEnabled(True)
+
+        session = self.logic.getSession(segNode) if segNode else None
+        bpInitialized = session is not None and session.bpLevelSet is not None
+        leafletInitialized = session is not None and session.leafletLevelSet is not None
+        for button in (self.incrementFirstButton50, self.incrementFirstButton100, self.incrementFirstButton500,
+                       self.convergeFirstButton, self.initLeafletButton):
+            button.enabled = bpInitialized
+        for button in (self.incrementButton10, self.incrementButton50, self.incrementButton200, self.convergeButton):
+            button.enabled = leafletInitialized
+        self.undoButtonBP.enabled = session is not None and len(session.undoBPLevelSetStack) > 0
+        self.redoButtonBP.enabled = session is not None and len(session.redoBPLevelSetStack) > 0
+        self.undoButtonLeaflet.enabled = session is not None and len(session.undoLeafletLevelSetStack) > 0
+        self.redoButtonLeaflet.enabled = session is not None and len(session.redoLeafletLevelSetStack) > 0
+        self.onSelect()
 
     def onUndoButtonBP(self):
         # Will disable button when undo stack is empty
@@ -543,6 +726,33 @@ class MVSegmenterWidget(ScriptedLoadableModuleWidget):
         # Enable undo button on redo
         self.undoButtonLeaflet.enabled = True
 
+    def onSaveCheckpointButton(self):
+        try:
+            # This can be a long operation - indicate it to the user
+            qt.QApplication.setOverrideCursor(qt.Qt.WaitCursor)
+
+            directory = self.getCheckpointDirectory()
+            if directory:
+                self.logic.saveSessionCheckpoint(self.outputSegmentationSelector.currentNode(), directory)
+
+        finally:
+            qt.QApplication.restoreOverrideCursor()
+
+    def onLoadCheckpointButton(self):
+        segNode = self.outputSegmentationSelector.currentNode()
+        directory = self.getCheckpointDirectory()
+        if not directory or not self.logic.loadSessionCheckpoint(segNode, directory):
+            return
+
+        self.updateIterationButtons(segNode)
+
+    def getCheckpointDirectory(self):
+        # Checkpoints are stored next to the scene, ask for a directory if the scene has not been saved
+        directory = self.logic.getCheckpointDirectory(self.outputSegmentationSelector.currentNode())
+        if not directory:
+            directory = qt.QFileDialog.getExistingDirectory(slicer.util.mainWindow(), "Checkpoint Directory")
+        return directory
+
     def onGenerateSurfaceMarkups(self):
         success = self.logic.generateSurfaceMarkups(self.outputSegmentationSelector.currentNode(),
                                                     self.heartValveSelector.currentNode(),
@@ -557,6 +767,7 @@ class MVSegmenterWidget(ScriptedLoadableModuleWidget):
                                            self.heartValveSelector.currentNode(),
                                            float(self.baseDepthSlider.value),
                                            self.inputSelector.currentNode())
+            self.logic.removePreviews(annulusPreview=False)
             self.onSelect()
 
         finally:
@@ -570,6 +781,7 @@ class MVSegmenterWidget(ScriptedLoadableModuleWidget):
             self.logic.projectAnnulus(self.outputSegmentationSelector.currentNode(),
                                       self.heartValveSelector.currentNode(),
                                       float(self.annulusOffsetSlider.value))
+            self.logic.removePreviews(moldPreview=False)
             self.onSelect()
 
         finally:
@@ -580,13 +792,66 @@ class MVSegmenterWidget(ScriptedLoadableModuleWidget):
             # This can be a long operation - indicate it to the user
             qt.QApplication.setOverrideCursor(qt.Qt.WaitCursor)
 
-            self.logic.subtractAnnulusSegmentation(self.outputSegmentationSelector.currentNode(),
-                                                   self.inputSelector.currentNode())
+            # Fall back to labelmap subtraction if the mesh subtraction does not give a closed surface
+            if not self.meshSubtractionCheckBox.checked or not self.logic.subtractAnnulusModel(
+                    self.outputSegmentationSelector.currentNode()):
+                self.logic.subtractAnnulusSegmentation(self.outputSegmentationSelector.currentNode(),
+                                                       self.inputSelector.currentNode())
             self.onSelect()
 
         finally:
             qt.QApplication.restoreOverrideCursor()
 
+    def onLivePreviewToggled(self, checked):
+        # Sliders only emit value changes while dragging when tracking
+        self.baseDepthSlider.tracking = checked
+        self.annulusOffsetSlider.tracking = checked
+
+        if checked:
+            self.pendingMoldPreview = True
+            self.pendingAnnulusPreview = True
+            self.previewTimer.start()
+        else:
+            self.previewTimer.stop()
+            self.pendingMoldPreview = False
+            self.pendingAnnulusPreview = False
+            self.logic.removePreviews()
+
+    def onBaseDepthSliderChanged(self, value):
+        if not self.livePreviewCheckBox.checked:
+            return
+
+        self.pendingMoldPreview = True
+        if not self.previewTimer.isActive():
+            self.previewTimer.start()
+
+    def onAnnulusOffsetSliderChanged(self, value):
+        if not self.livePreviewCheckBox.checked:
+            return
+
+        self.pendingAnnulusPreview = True
+        if not self.previewTimer.isActive():
+            self.previewTimer.start()
+
+    def onPreviewTimer(self):
+        start = timer()
+
+        if self.pendingMoldPreview and self.generateMoldButton.enabled:
+            self.logic.previewSurfaceMold(self.outputSegmentationSelector.currentNode(),
+                                          self.heartValveSelector.currentNode(),
+                                          float(self.baseDepthSlider.value))
+        self.pendingMoldPreview = False
+
+        if self.pendingAnnulusPreview and self.projectAnnulusButton.enabled:
+            self.logic.previewProjectedAnnulus(self.outputSegmentationSelector.currentNode(),
+                                               self.heartValveSelector.currentNode(),
+                                               float(self.annulusOffsetSlider.value))
+        self.pendingAnnulusPreview = False
+
+        # Slow previews stretch the interval so slider events do not queue up
+        elapsedMs = int((timer() - start) * 1000)
+        self.previewTimer.setInterval(max(self.previewFrameBudgetMs, elapsedMs))
+
     def onAddPapillaryButton(self):
         self.papillaryMarkupsNode.SetAndObserveTransformNodeID(
             self.outputSegmentationSelector.currentNode().GetTransformNodeID())
@@ -625,10 +890,139 @@ class MVSegmenterWidget(ScriptedLoadableModuleWidget):
         finally:
             qt.QApplication.restoreOverrideCursor()
 
+    def onExportMoldFilesButton(self):
+        try:
+            # This can be a long operation - indicate it to the user
+            qt.QApplication.setOverrideCursor(qt.Qt.WaitCursor)
+
+            self.logic.writeMoldParts(self.outputSegmentationSelector.currentNode(), self.papillaryMarkupsNode,
+                                      self.exportDirectoryButton.directory, self.exportFormatSelector.currentText)
+
+        finally:
+            qt.QApplication.restoreOverrideCursor()
+
     def onGenerateBasePlate(self):
         return
 
 
+#
+# MVSegmenterSession
+#
+
+class MVSegmenterSession(object):
+    """State of a single case, i.e. one output segmentation node. Access is serialized with the reentrant lock so
+    several cases can be processed concurrently with one logic instance. MRML nodes must still only be modified from
+    the main thread.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.lastAccess = time.monotonic()
+
+        self.speedImg = None
+        self.speedImgRefNode = None
+        self.leafletLevelSet = None
+        self.bpLevelSet = None
+
+        self.undoBPLevelSetStack = []
+        self.redoBPLevelSetStack = []
+        self.undoLeafletLevelSetStack = []
+        self.redoLeafletLevelSetStack = []
+
+        self.moldBasePlate = None
+
+        # Depth independent mold surfaces with their cache key
+        self.moldSurfaces = None
+
+        # Projected annulus tube model as generated, before conversion to labelmap
+        self.projectedAnnulus = None
+
+        # Mold surface from mesh subtraction with the modified time of the Mold_base source representation it is
+        # stored in, used for export while the segment is unchanged
+        self.subtractedMold = None
+
+        # Running automatic convergence of an active contour pass
+        self.convergence = None
+
+        # Preview surface blocks of each segment keyed on block index
+        self.surfaceBlocks = {}
+
+    def setSpeedImage(self, speedImg, refNode):
+        """
+        Sets the speed image and the volume it was computed from. Level sets and undo history of another volume or
+        image geometry are cleared, they can not be compared with level sets of the new speed image.
+        :param speedImg: Speed itk image
+        :param refNode: The volume node the speed image was computed from
+        :return: True if the level sets were cleared
+        """
+        previous = self.speedImg
+        changed = refNode is not self.speedImgRefNode or (previous is not None and (
+            previous.GetSize() != speedImg.GetSize() or
+            not np.allclose(previous.GetOrigin(), speedImg.GetOrigin()) or
+            not np.allclose(previous.GetSpacing(), speedImg.GetSpacing()) or
+            not np.allclose(previous.GetDirection(), speedImg.GetDirection())))
+        if changed:
+            self.bpLevelSet = None
+            self.leafletLevelSet = None
+            self.undoBPLevelSetStack = []
+            self.redoBPLevelSetStack = []
+            self.undoLeafletLevelSetStack = []
+            self.redoLeafletLevelSetStack = []
+            self.surfaceBlocks = {}
+
+        self.speedImg = speedImg
+        self.speedImgRefNode = refNode
+
+        return changed
+
+    def popLevelSet(self, stack):
+        """
+        Pops a level set from an undo or redo stack. Stacks restored from a checkpoint hold loaders that read the
+        level set from the checkpoint when first needed.
+        :param stack: Undo or redo stack
+        :return: The level set itk image
+        """
+        levelSet = stack.pop()
+        if callable(levelSet):
+            levelSet = levelSet()
+
+        return levelSet
+
+
+class MVSegmenterConvergence(object):
+    """Active contour pass run in chunks on a worker thread, either until convergence or for a fixed number of
+    iterations. The worker only updates the level set and progress, the logic shows snapshots as a preview surface and
+    hands them to a callback from the main thread, and pushes the result to the segmentation node once done.
+    """
+
+    def __init__(self, segmentId, levelSet, snapshotCallback=None):
+        self.segmentId = segmentId
+        self.levelSet = levelSet
+        self.iterations = 0
+        self.rmsChange = None
+        self.changedVoxels = None
+        self.elapsed = 0.0
+
+        # 'running', 'converged', 'time budget', 'max iterations', 'aborted' or 'failed'
+        self.status = 'running'
+        self.abortEvent = threading.Event()
+        self.future = None
+
+        # Called from the main thread with each new snapshot of the level set, callback(levelSet, convergence)
+        self.snapshotCallback = snapshotCallback
+
+        # Level set version of the worker and the last version pushed as preview
+        self.version = 0
+        self.pushedVersion = 0
+        self.lastPreview = time.monotonic()
+
+        # Level set matching the segment contents, used to find the region changed by the final push
+        self.pushedLevelSet = levelSet
+
+        # Level set shown by the preview surface, used to find the blocks changed by the next snapshot
+        self.previewLevelSet = None
+
+
 #
 # MVSegmenterLogic
 #
@@ -643,19 +1037,304 @@ class MVSegmenterLogic(ScriptedLoadableModuleLogic):
     https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
     """
 
+    # VTK SMP and torch thread counts are process wide, thread stages of all instances share their saved settings
+    _threadStageLock = threading.Lock()
+    _threadStageDepth = 0
+    _threadStageSettings = None
+
     def __init__(self):
         ScriptedLoadableModuleLogic.__init__(self)
-        self._speedImg = None
-        self._speedImgRefNode = None
-        self._leafletLevelSet = None
-        self._bpLevelSet = None
 
-        self._undoBPLevelSetStack = []
-        self._redoBPLevelSetStack = []
-        self._undoLeafletLevelSetStack = []
-        self._redoLeafletLevelSetStack = []
+        # Precision policy, pixel type of the speed image and all level sets
+        self.levelSetPixelType = sitk.sitkFloat32
+
+        # Speed images whose intermediate images would take more than the memory budget in bytes are computed in slabs,
+        # the halo in slices covers the largest Gaussian kernel radius plus the gradient
+        self.speedImageMemoryBudget = 2 * 1024 ** 3
+        self.speedImageBytesPerVoxel = 24
+        self.speedImageTileHalo = 17
+        self.speedImageTileWorkers = 2
+
+        # Blood pool initialization, seed offsets in mm along the annulus normal from the annulus center and the fast
+        # marching arrival time threshold of the initial region
+        self.bloodPoolSeedOffsets = [-10]
+        self.fastMarchingThreshold = 10
+
+        # Automatic convergence of the active contour passes. Runs chunks of iterations until the RMS change or the
+        # fraction of voxels changing sign within a chunk drops below the tolerances, or a budget runs out. A snapshot
+        # is taken after every chunk, previews are shown at most every preview interval in seconds.
+        self.convergenceChunkIterations = 25
+        self.convergenceRMSTolerance = 0.001
+        self.convergenceVolumeTolerance = 0.001
+        self.convergenceTimeBudget = 60
+        self.convergenceMaxIterations = 2000
+        self.convergencePreviewInterval = 1.0
+        self._convergenceExecutor = ThreadPoolExecutor(max_workers=2)
+
+        # Label layer and outline setting of the slice views replaced by the contour preview, restored on removal
+        self._contourPreviewSliceState = None
+
+        # Segment updates only write the bounding box of the voxels changed since the previous level set, with a full
+        # import when more than the fraction of the volume changed. Preview surfaces are meshed in blocks of voxels.
+        self.incrementalUpdateMaxFraction = 0.25
+        self.surfaceBlockSize = 32
+
+        # Leaflet metrics are computed within the annulus, voxels further than the ROI height in mm from the annulus
+        # plane are excluded
+        self.metricsRoiHeight = 25
+
+        # Visibility test of surface points from the annulus, a point is kept when the line to the target crosses no
+        # triangle other than those at its start point. 'batched' tests all lines at once, 'obb' tests them one by one
+        # with vtkOBBTree and is kept as reference.
+        self.visibilityBackend = 'batched'
+
+        # Signed distance backend used to (re)initialize level sets, 'danielsson', 'maurer' or 'narrowband'. Maurer is
+        # exact and much faster than Danielsson but its distances differ by up to a voxel, so it is opt-in. The narrow
+        # band backend clamps distances to the band width in voxels, the active contours only need the zero level set.
+        self.distanceBackend = 'danielsson'
+        self.distanceBandWidth = 4
+
+        # Per case state keyed on output segmentation node ID. Sessions are removed when their segmentation node is
+        # removed or the scene is closed. Optionally sessions idle for longer than the timeout in seconds are evicted.
+        self._sessions = {}
+        self._sessionsLock = threading.Lock()
+        self.sessionIdleTimeout = None
+
+        # Use the segment editor effects instead of direct labelmap operations for smoothing and subtraction
+        self.useSegmentEditorEffects = False
+
+        # Build independent branches of the mold and annulus pipelines on a thread pool
+        self.parallelMoldBuild = True
+
+        # Threads used by SimpleITK, VTK SMP and torch, defaults to the number of cores. Stages can be overridden in
+        # stageThreads: 'speedImage', 'distance', 'activeContour', 'surface', 'mold' and 'deepMitral'.
+        self.numberOfThreads = None
+        self.stageThreads = {}
+        self.vtkSMPBackend = 'STDThread'
+
+        # Decimation budgets, a target triangle count or a maximum Hausdorff error in mm. Without a budget the fixed
+        # reduction of each stage is used
+        self.decimationBudgets = {
+            'innerSurface': {'targetTriangles': None, 'maxError': None},
+            'mold': {'targetTriangles': None, 'maxError': None},
+            'stiffener': {'targetTriangles': None, 'maxError': None},
+        }
+
+        # Triangle count, Hausdorff error and whether the budget was met by the last decimation of each stage. The
+        # Hausdorff error is only measured for a maximum error budget or when measureDecimationError is set, as it
+        # costs more than the decimation. A maximum error budget tightens the pro decimation error bound up to
+        # decimationErrorAttempts times before falling back to the undecimated surface.
+        self.decimationResults = {}
+        self.measureDecimationError = False
+        self.decimationErrorAttempts = 3
+
+        # Papillary tip sphere radius in mm and resolution, glyph templates are cached per radius and resolution
+        self.papillaryTipRadius = 2
+        self.papillaryTipResolution = 8
+        self._glyphTemplates = {}
+
+        # Point spacing in mm of the spline fitted projected annulus, close to the side length of the annulus tube
+        self.annulusSplineSpacing = 0.3
+
+    def getSession(self, segNode):
+        """
+        Retrieves the session holding the state of the case segmented into a segmentation node, creating it on first
+        use. Evicts idle sessions of other cases if sessionIdleTimeout is set.
+        :param segNode: Output segmentation node of the case
+        :return: MVSegmenterSession
+        """
+        with self._sessionsLock:
+            session = self._sessions.get(segNode.GetID())
+            if not session:
+                session = MVSegmenterSession()
+                self._sessions[segNode.GetID()] = session
 
-        self.moldBasePlate = None
+            session.lastAccess = time.monotonic()
+
+            if self.sessionIdleTimeout is not None:
+                self.evictIdleSessions(segNode.GetID())
+
+            return session
+
+    def evictIdleSessions(self, keepSegNodeId=None):
+        """
+        Removes sessions that have not been accessed for sessionIdleTimeout seconds and are not in use
+        :param keepSegNodeId: Segmentation node ID of a session that is never evicted, i.e. the one being requested
+        :return: None
+        """
+        now = time.monotonic()
+        for segNodeId, session in list(self._sessions.items()):
+            if segNodeId == keepSegNodeId or now - session.lastAccess < self.sessionIdleTimeout or session.convergence:
+                continue
+
+            if session.lock.acquire(blocking=False):
+                try:
+                    del self._sessions[segNodeId]
+                finally:
+                    session.lock.release()
+
+    def removeSession(self, segNode):
+        """
+        Removes the session of a case, releasing its images and undo history. A running convergence is aborted.
+        :param segNode: Output segmentation node of the case
+        :return: None
+        """
+        with self._sessionsLock:
+            session = self._sessions.pop(segNode.GetID(), None)
+
+        if session and session.convergence:
+            session.convergence.abortEvent.set()
+
+    def removeAllSessions(self):
+        """
+        Removes the sessions of all cases, e.g. when the scene is closed. Running convergences are aborted.
+        :return: None
+        """
+        with self._sessionsLock:
+            sessions = list(self._sessions.values())
+            self._sessions.clear()
+
+        for session in sessions:
+            if session.convergence:
+                session.convergence.abortEvent.set()
+
+    def getCheckpointDirectory(self, segNode):
+        """
+        Directory of the session checkpoint of a case, next to the scene file
+        :param segNode: Output segmentation node of the case
+        :return: Path of the checkpoint directory, None if the scene has not been saved
+        """
+        # The root directory of an unsaved scene is the working directory
+        if not slicer.mrmlScene.GetURL():
+            return None
+
+        return Path(slicer.mrmlScene.GetRootDirectory()) / 'MVSegmenterCheckpoints' / segNode.GetID()
+
+    def saveSessionCheckpoint(self, segNode, directory=None):
+        """
+        Saves the session of a case to a checkpoint directory. The speed image, the current level sets and each undo
+        and redo entry are written as uncompressed float32 .npy files, so they can be memory-mapped when loaded. The
+        image geometry and stack layout are written as metadata.json.
+        :param segNode: Output segmentation node of the case
+        :param directory: Checkpoint directory, defaults to getCheckpointDirectory. Required if the scene is not saved.
+        :return: Path of the checkpoint directory, None on failure
+        """
+        if not segNode:
+            logging.debug("saveSessionCheckpoint failed: Missing parameter")
+            return None
+
+        directory = Path(directory) if directory else self.getCheckpointDirectory(segNode)
+        if not directory:
+            logging.debug("saveSessionCheckpoint failed: Scene not saved, checkpoint directory required")
+            return None
+
+        historyDirectory = directory / 'history'
+        historyDirectory.mkdir(parents=True, exist_ok=True)
+
+        session = self.getSession(segNode)
+        with session.lock:
+            images = {}
+            for name in ('speedImg', 'bpLevelSet', 'leafletLevelSet'):
+                img = getattr(session, name)
+                if img is not None:
+                    np.save(directory / (name + '.npy'), sitk.GetArrayViewFromImage(img).astype(np.float32))
+                    images[name] = self.getImageGeometry(img)
+
+            # Entries still on disk are loaded before their files are replaced
+            stacks = {}
+            for name in ('undoBPLevelSetStack', 'redoBPLevelSetStack', 'undoLeafletLevelSetStack',
+                         'redoLeafletLevelSetStack'):
+                stack = [levelSet() if callable(levelSet) else levelSet for levelSet in getattr(session, name)]
+                setattr(session, name, stack)
+                stacks[name] = [self.getImageGeometry(levelSet) for levelSet in stack]
+
+            for path in historyDirectory.glob('*.npy'):
+                path.unlink()
+            for name in stacks:
+                for i, levelSet in enumerate(getattr(session, name)):
+                    np.save(historyDirectory / '{0}_{1}.npy'.format(name, i),
+                            sitk.GetArrayViewFromImage(levelSet).astype(np.float32))
+
+            metadata = {
+                'segmentationNodeID': segNode.GetID(),
+                'speedImgRefNodeID': session.speedImgRefNode.GetID() if session.speedImgRefNode else None,
+                'images': images,
+                'stacks': stacks,
+            }
+
+            # Metadata is written last so an interrupted save is not picked up as a complete checkpoint
+            with open(directory / 'metadata.json', 'w') as f:
+                json.dump(metadata, f, indent=2)
+
+        logging.info('Saved session checkpoint to {0}'.format(directory))
+
+        return directory
+
+    def loadSessionCheckpoint(self, segNode, directory=None):
+        """
+        Restores the session of a case from a checkpoint directory. Images are read through memory maps, so the files
+        are only copied once into the itk images. Undo and redo entries are only read when they are popped.
+        :param segNode: Output segmentation node of the case
+        :param directory: Checkpoint directory, defaults to getCheckpointDirectory. Required if the scene is not saved.
+        :return: True on success, False otherwise
+        """
+        if not segNode:
+            logging.debug("loadSessionCheckpoint failed: Missing parameter")
+            return False
+
+        directory = Path(directory) if directory else self.getCheckpointDirectory(segNode)
+        if not directory:
+            logging.debug("loadSessionCheckpoint failed: Scene not saved, checkpoint directory required")
+            return False
+
+        if not (directory / 'metadata.json').exists():
+            logging.debug("loadSessionCheckpoint failed: No checkpoint in " + str(directory))
+            return False
+
+        start = timer()
+        with open(directory / 'metadata.json') as f:
+            metadata = json.load(f)
+
+        def loadImage(array, geometry):
+            img = sitk.GetImageFromArray(array)
+            img.SetOrigin(geometry['origin'])
+            img.SetSpacing(geometry['spacing'])
+            img.SetDirection(geometry['direction'])
+            if img.GetPixelID() != geometry['pixelType']:
+                img = sitk.Cast(img, geometry['pixelType'])
+            return img
+
+        def historyLoader(key, geometry):
+            return lambda: loadImage(np.load(directory / 'history' / (key + '.npy'), mmap_mode='r'), geometry)
+
+        session = self.getSession(segNode)
+        with session.lock:
+            for name in ('speedImg', 'bpLevelSet', 'leafletLevelSet'):
+                geometry = metadata['images'].get(name)
+                img = None
+                if geometry:
+                    img = loadImage(np.load(directory / (name + '.npy'), mmap_mode='r'), geometry)
+                setattr(session, name, img)
+
+            refNodeId = metadata['speedImgRefNodeID']
+            session.speedImgRefNode = slicer.mrmlScene.GetNodeByID(refNodeId) if refNodeId else None
+
+            for name, geometries in metadata['stacks'].items():
+                setattr(session, name, [historyLoader('{0}_{1}'.format(name, i), geometry)
+                                        for i, geometry in enumerate(geometries)])
+
+        logging.info('Loaded session checkpoint from {0} in {1:.3f}s'.format(directory, timer() - start))
+
+        return True
+
+    def getImageGeometry(self, img):
+        """
+        Geometry and pixel type of an itk image for serialization
+        :param img: The itk image
+        :return: Dictionary of origin, spacing, direction and pixel type
+        """
+        return {'origin': img.GetOrigin(), 'spacing': img.GetSpacing(), 'direction': img.GetDirection(),
+                'pixelType': img.GetPixelID()}
 
     def initBPSeg(self, inputVolume, heartValveNode, outputSeg):
         """
@@ -675,18 +1354,62 @@ class MVSegmenterLogic(ScriptedLoadableModuleLogic):
             logging.debug("initBPSeg failed: Annulus contour not defined")
             return
 
-        if valveModel.getProbeToRasTransformNode():
-            outputSeg.SetAndObserveTransformNodeID(valveModel.getProbeToRasTransformNode().GetID())
+        session = self.getSession(outputSeg)
+        with session.lock:
+            if valveModel.getProbeToRasTransformNode():
+                outputSeg.SetAndObserveTransformNodeID(valveModel.getProbeToRasTransformNode().GetID())
 
-        if not outputSeg.GetNodeReference(outputSeg.GetReferenceImageGeometryReferenceRole()):
-            outputSeg.SetReferenceImageGeometryParameterFromVolumeNode(inputVolume)
+            if not outputSeg.GetNodeReference(outputSeg.GetReferenceImageGeometryReferenceRole()):
+                outputSeg.SetReferenceImageGeometryParameterFromVolumeNode(inputVolume)
 
-        self._speedImgRefNode = inputVolume
-        # calculate speed image from input volume
-        # Uses DiscreteGaussian -> GradientMagnitude -> Sigmoid filters
-        speedImg = sitkUtils.PullVolumeFromSlicer(inputVolume)
+            # calculate speed image from input volume
+            speedImg = self.computeSpeedImage(sitkUtils.PullVolumeFromSlicer(inputVolume))
+            session.setSpeedImage(speedImg, inputVolume)
+
+            # compute initial level set
+            seeds = self.getBloodPoolSeeds(valveModel, inputVolume)
+            if not seeds:
+                logging.debug("initBPSeg failed: Blood pool seeds are outside the input volume")
+                return
+
+            out_mask = self.computeInitialBPLevelSet(speedImg, seeds)
+
+            self.updateBPLevelSet(outputSeg, out_mask)
+
+            threshold = sitk.BinaryThresholdImageFilter()
+            threshold.SetInsideValue(1)
+            threshold.SetLowerThreshold(-1000.0)
+            threshold.SetOutsideValue(0)
+            threshold.SetUpperThreshold(0.0)
+            out_mask = threshold.Execute(out_mask)
+
+            self.pushITKImageToSegmentation(out_mask, outputSeg, 'BP Segmentation')
+
+    def computeSpeedImage(self, img):
+        """
+        Computes the speed image for the active contours from the input image. Volumes whose intermediate images would
+        exceed speedImageMemoryBudget are processed in tiles.
+        :param img: Input itk image
+        :return: Speed image in the working precision
+        """
+        if img.GetNumberOfPixels() * self.speedImageBytesPerVoxel > self.speedImageMemoryBudget:
+            return self.computeSpeedImageTiled(img)
+
+        return self.filterSpeedImage(img)
+
+    def filterSpeedImage(self, img, numberOfThreads=None):
+        """
+        Applies the speed image filters, DiscreteGaussian -> GradientMagnitude -> Sigmoid, to the input cast to the
+        working precision.
+        :param img: Input itk image
+        :param numberOfThreads: Threads per filter, defaults to the speedImage stage
+        :return: Speed image in the working precision
+        """
+        numberOfThreads = numberOfThreads or self.getNumberOfThreads('speedImage')
+        speedImg = self.castToWorkingPrecision(img)
 
         blurFilter = sitk.DiscreteGaussianImageFilter()
+        blurFilter.SetNumberOfThreads(numberOfThreads)
         blurFilter.SetMaximumError(0.25)
         blurFilter.SetMaximumKernelWidth(32)
         blurFilter.SetUseImageSpacing(True)
@@ -694,20 +1417,80 @@ class MVSegmenterLogic(ScriptedLoadableModuleLogic):
         speedImg = blurFilter.Execute(speedImg)
 
         gradMag = sitk.GradientMagnitudeImageFilter()
+        gradMag.SetNumberOfThreads(numberOfThreads)
         gradMag.SetUseImageSpacing(True)
         speedImg = gradMag.Execute(speedImg)
 
         sigmoid = sitk.SigmoidImageFilter()
+        sigmoid.SetNumberOfThreads(numberOfThreads)
         sigmoid.SetOutputMinimum(0)
         sigmoid.SetOutputMaximum(1.0)
         sigmoid.SetAlpha(-5.0)
         sigmoid.SetBeta(10.0)
         speedImg = sigmoid.Execute(speedImg)
 
-        self._speedImg = speedImg
-
-        # compute initial level set
+        return self.castToWorkingPrecision(speedImg)
 
+    def computeSpeedImageTiled(self, img, memoryBudget=None, workers=None):
+        """
+        Computes the speed image in slabs along the image z axis. Each slab is filtered with a halo of neighbouring
+        slices covering the filter kernels, so the result is identical to filtering the whole volume. Slabs are
+        processed in parallel and written to a memory-mapped temporary file, the input keeps its own pixel type.
+        The active contour filters consume an itk image, so the full-volume result is loaded into memory once all
+        slabs are done. The budget therefore covers the result in the working precision plus the slabs in flight;
+        if the result alone exceeds it, slabs of a single slice are used.
+        :param img: Input itk image
+        :param memoryBudget: Peak memory in bytes of the result and the slabs in flight, defaults to
+        speedImageMemoryBudget
+        :param workers: Number of slabs processed in parallel, defaults to speedImageTileWorkers
+        :return: Speed image in the working precision
+        """
+        memoryBudget = memoryBudget or self.speedImageMemoryBudget
+        workers = workers or self.speedImageTileWorkers
+        size = img.GetSize()
+        halo = self.speedImageTileHalo
+        dtype = np.float32 if self.levelSetPixelType == sitk.sitkFloat32 else np.float64
+
+        # Slab depth such that the result and all slabs in flight, including their halo, fit in the budget
+        resultBytes = img.GetNumberOfPixels() * np.dtype(dtype).itemsize
+        sliceBytes = size[0] * size[1] * self.speedImageBytesPerVoxel
+        depth = max(int((memoryBudget - resultBytes) / (workers * sliceBytes)) - 2 * halo, 1)
+        if resultBytes > memoryBudget:
+            logging.warning('Speed image of {0} bytes exceeds the memory budget of {1} bytes'.format(resultBytes,
+                                                                                                    memoryBudget))
+        slabs = list(range(0, size[2], depth))
+
+        numberOfThreads = self.getNumberOfThreads('speedImage', workers)
+        with tempfile.TemporaryFile(dir=slicer.app.temporaryPath) as file:
+            speed = np.memmap(file, dtype=dtype, mode='w+', shape=(size[2], size[1], size[0]))
+
+            def filterSlab(first):
+                last = min(first + depth, size[2])
+                lower = max(first - halo, 0)
+                upper = min(last + halo, size[2])
+                slab = self.filterSpeedImage(sitk.RegionOfInterest(img, [size[0], size[1], upper - lower],
+                                                                   [0, 0, lower]), numberOfThreads)
+                speed[first:last] = sitk.GetArrayViewFromImage(slab)[first - lower:last - lower]
+
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(filterSlab, slabs))
+
+            speedImg = sitk.GetImageFromArray(speed)
+            del speed
+
+        speedImg.CopyInformation(img)
+        logging.info('Speed image computed in {0} slabs of {1} slices'.format(len(slabs), depth))
+
+        return speedImg
+
+    def getBloodPoolSeeds(self, valveModel, inputVolume):
+        """
+        Computes the seed indices of the blood pool segmentation along the annulus normal through the annulus center,
+        at the offsets in bloodPoolSeedOffsets. Seeds outside the volume are skipped.
+        :param valveModel: SlicerHeart HeartValve MRML node containing annulus definition
+        :param inputVolume: The reference image volume
+        :return: List of seed indices as lists of integers
+        """
         # Find annulus center
         markups = valveModel.getAnnulusContourMarkupNode()
         pos = np.zeros(3)
@@ -717,25 +1500,45 @@ class MVSegmenterLogic(ScriptedLoadableModuleLogic):
             centroid += pos
 
         centroid = centroid / markups.GetNumberOfFiducials()
-        centroid = centroid + valveModel.getAnnulusContourPlane()[1] * -10
-        centroid = np.array(self.rasToIJK(centroid, inputVolume))
-        if centroid[2] <= 0:
-            centroid[2] = 1
-
-        # Run fast marching based on annulus center
+        normal = valveModel.getAnnulusContourPlane()[1]
+        dimensions = inputVolume.GetImageData().GetDimensions()
+
+        seeds = []
+        for offset in self.bloodPoolSeedOffsets:
+            seed = np.array(self.rasToIJK(centroid + normal * offset, inputVolume))
+            if seed[2] <= 0:
+                seed[2] = 1
+            if np.any(seed < 0) or np.any(seed >= dimensions):
+                continue
+            seed = seed.astype('uint32').tolist()
+            if seed not in seeds:
+                seeds.append(seed)
+
+        return seeds
+
+    def computeInitialBPLevelSet(self, speedImg, seeds):
+        """
+        Computes the initial blood pool level set by fast marching from the seeds followed by the first pass of the
+        geodesic active contour. The front is stopped once it passes the arrival time threshold, so the cost scales
+        with the size of the blood pool rather than the volume.
+        :param speedImg: Speed image
+        :param seeds: List of seed indices
+        :return: Level set in the working precision
+        """
+        # Run fast marching from the seeds below the annulus center, voxels not reached keep the maximum arrival time
         fastMarching = sitk.FastMarchingImageFilter()
-        fastMarching.SetTrialPoints([centroid.astype('uint32').tolist()])
+        fastMarching.SetTrialPoints(seeds)
+        fastMarching.SetStoppingValue(self.fastMarchingThreshold + 1)
         fmarch = fastMarching.Execute(speedImg)
 
         thresh = sitk.BinaryThresholdImageFilter()
         thresh.SetLowerThreshold(0)
-        thresh.SetUpperThreshold(10)
+        thresh.SetUpperThreshold(self.fastMarchingThreshold)
         thresh.SetInsideValue(1)
         thresh.SetOutsideValue(0)
         mask = thresh.Execute(fmarch)
 
-        signedDis = sitk.SignedDanielssonDistanceMapImageFilter()
-        levelSet = signedDis.Execute(mask)
+        levelSet = self.computeSignedDistance(mask)
 
         # Run first pass of geodesic active contour
         geodesicActiveContour = sitk.GeodesicActiveContourLevelSetImageFilter()
@@ -744,19 +1547,140 @@ class MVSegmenterLogic(ScriptedLoadableModuleLogic):
         geodesicActiveContour.SetPropagationScaling(1.0)
         geodesicActiveContour.SetMaximumRMSError(0.0001)
         geodesicActiveContour.SetNumberOfIterations(500)
+        geodesicActiveContour.SetNumberOfThreads(self.getNumberOfThreads('activeContour'))
 
-        out_mask = geodesicActiveContour.Execute(levelSet, speedImg)
+        return geodesicActiveContour.Execute(levelSet, self.castToWorkingPrecision(speedImg))
 
-        self.updateBPLevelSet(out_mask)
+    def getNumberOfThreads(self, stage=None, workers=1):
+        """
+        Number of threads for the filters of a stage
+        :param stage: Stage name, see stageThreads
+        :param workers: Number of workers running filters concurrently that share the threads
+        :return: Number of threads per worker
+        """
+        numberOfThreads = self.stageThreads.get(stage) or self.numberOfThreads or os.cpu_count() or 1
+        return max(numberOfThreads // workers, 1)
 
-        threshold = sitk.BinaryThresholdImageFilter()
-        threshold.SetInsideValue(1)
-        threshold.SetLowerThreshold(-1000.0)
-        threshold.SetOutsideValue(0)
-        threshold.SetUpperThreshold(0.0)
-        out_mask = threshold.Execute(out_mask)
+    def configureThreads(self, numberOfThreads=None):
+        """
+        Sets the default number of threads of SimpleITK, the VTK SMP backend and its number of threads, and the torch
+        intra- and inter-op threads if torch is loaded. Torch inter-op threads can only be set before torch runs
+        anything in parallel.
+        :param numberOfThreads: Number of threads, defaults to the number of cores
+        :return: Number of threads configured
+        """
+        self.numberOfThreads = numberOfThreads
+        numberOfThreads = self.getNumberOfThreads()
+
+        sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(numberOfThreads)
+        if not vtk.vtkSMPTools.SetBackend(self.vtkSMPBackend):
+            logging.debug("configureThreads failed: VTK SMP backend {0} not available, using {1}".format(
+                self.vtkSMPBackend, vtk.vtkSMPTools.GetBackend()))
+        vtk.vtkSMPTools.Initialize(numberOfThreads)
+
+        torch = sys.modules.get('torch')
+        if torch:
+            torch.set_num_threads(numberOfThreads)
+            try:
+                torch.set_num_interop_threads(numberOfThreads)
+            except RuntimeError as e:
+                logging.debug("configureThreads failed: {0}".format(e))
+
+        return numberOfThreads
+
+    @contextlib.contextmanager
+    def threadStage(self, stage, workers=1):
+        """
+        Context in which VTK SMP and torch use the number of threads of a stage. SimpleITK filters set their threads
+        individually with getNumberOfThreads. VTK SMP and torch only have process wide settings, so the settings are
+        saved by the first stage entered and restored when the last one exits, under a lock. Overlapping stages, e.g.
+        of concurrent cases, use the number of threads of the stage entered last. Threads are divided among concurrent
+        workers so they do not oversubscribe the cores.
+        :param stage: Stage name, see stageThreads
+        :param workers: Number of workers running filters concurrently
+        :return: Context manager yielding the number of threads per worker
+        """
+        numberOfThreads = self.getNumberOfThreads(stage, workers)
+        torch = sys.modules.get('torch')
+
+        with MVSegmenterLogic._threadStageLock:
+            if MVSegmenterLogic._threadStageDepth == 0:
+                MVSegmenterLogic._threadStageSettings = (vtk.vtkSMPTools.GetEstimatedNumberOfThreads(),
+                                                         torch.get_num_threads() if torch else None)
+            MVSegmenterLogic._threadStageDepth += 1
+
+            vtk.vtkSMPTools.Initialize(numberOfThreads)
+            if torch:
+                torch.set_num_threads(numberOfThreads)
+        try:
+            yield numberOfThreads
+        finally:
+            with MVSegmenterLogic._threadStageLock:
+                MVSegmenterLogic._threadStageDepth -= 1
+                if MVSegmenterLogic._threadStageDepth == 0:
+                    vtkThreads, torchThreads = MVSegmenterLogic._threadStageSettings
+                    vtk.vtkSMPTools.Initialize(vtkThreads)
+                    if torch and torchThreads:
+                        torch.set_num_threads(torchThreads)
+
+    def castToWorkingPrecision(self, img):
+        """
+        Casts an itk image to the pixel type of the precision policy, levelSetPixelType
+        :param img: The itk image
+        :return: The image in the working precision, the input itself if it already is
+        """
+        if img.GetPixelID() == self.levelSetPixelType:
+            return img
 
-        self.pushITKImageToSegmentation(out_mask, outputSeg, 'BP Segmentation')
+        return sitk.Cast(img, self.levelSetPixelType)
+
+    def computeSignedDistance(self, mask, backend=None, bandWidth=None):
+        """
+        Computes the signed distance map of a binary mask in voxels, negative inside, in the working precision.
+        :param mask: Binary itk image
+        :param backend: 'danielsson', 'maurer' or 'narrowband', defaults to distanceBackend
+        :param bandWidth: Band width in voxels of the narrow band backend, defaults to distanceBandWidth. Distances are
+        clamped to [-bandWidth, bandWidth], so it must cover any distance read from the map.
+        :return: Signed distance itk image
+        """
+        backend = backend or self.distanceBackend
+        if backend == 'danielsson':
+            signedDis = sitk.SignedDanielssonDistanceMapImageFilter()
+            signedDis.SetNumberOfThreads(self.getNumberOfThreads('distance'))
+            return self.castToWorkingPrecision(signedDis.Execute(mask))
+
+        signedDis = sitk.SignedMaurerDistanceMapImageFilter()
+        signedDis.SetNumberOfThreads(self.getNumberOfThreads('distance'))
+        signedDis.SetInsideIsPositive(False)
+        signedDis.SetSquaredDistance(False)
+        signedDis.SetUseImageSpacing(False)
+        if backend == 'maurer':
+            return self.castToWorkingPrecision(signedDis.Execute(mask))
+
+        if backend != 'narrowband':
+            raise ValueError('Unknown distance backend: {0}'.format(backend))
+
+        # Only compute the distance within the bounding box of the mask padded by the band, everything outside is
+        # further than the band from the mask
+        bandWidth = bandWidth or self.distanceBandWidth
+        labelStats = sitk.LabelShapeStatisticsImageFilter()
+        labelStats.Execute(sitk.Cast(mask != 0, sitk.sitkUInt8))
+        if not labelStats.HasLabel(1):
+            levelSet = sitk.Image(mask.GetSize(), self.levelSetPixelType)
+            levelSet.CopyInformation(mask)
+            return levelSet + float(bandWidth)
+
+        bbox = labelStats.GetBoundingBox(1)
+        dimension = mask.GetDimension()
+        lower = [max(bbox[i] - bandWidth - 1, 0) for i in range(dimension)]
+        upper = [min(bbox[i] + bbox[i + dimension] + bandWidth + 1, mask.GetSize()[i]) for i in range(dimension)]
+        region = sitk.RegionOfInterest(mask, [upper[i] - lower[i] for i in range(dimension)], lower)
+
+        distance = sitk.Clamp(self.castToWorkingPrecision(signedDis.Execute(region)), self.levelSetPixelType,
+                              -float(bandWidth), float(bandWidth))
+        levelSet = sitk.Image(mask.GetSize(), self.levelSetPixelType) + float(bandWidth)
+        levelSet.CopyInformation(mask)
+        return sitk.Paste(levelSet, distance, distance.GetSize(), [0] * dimension, lower)
 
     def iterateFirstPass(self, nIter, outputSeg):
         """
@@ -765,27 +1689,26 @@ class MVSegmenterLogic(ScriptedLoadableModuleLogic):
         :param outputSeg: Segmentation node to save output to
         :return: None
         """
-        self.updateBPLevelSetFromSegmentation(outputSeg)
-
-        geodesicActiveContour = sitk.GeodesicActiveContourLevelSetImageFilter()
-        geodesicActiveContour.SetCurvatureScaling(1.2)
-        geodesicActiveContour.SetAdvectionScaling(1.0)
-        geodesicActiveContour.SetPropagationScaling(0.9)
-        geodesicActiveContour.SetMaximumRMSError(0.00001)
-        geodesicActiveContour.SetNumberOfIterations(nIter)
+        session = self.getSession(outputSeg)
+        with session.lock:
+            self.updateBPLevelSetFromSegmentation(outputSeg)
+            previousLevelSet = session.bpLevelSet
 
-        out_mask = geodesicActiveContour.Execute(self._bpLevelSet, self._speedImg)
+            geodesicActiveContour = self.createActiveContourFilter('BP Segmentation', nIter)
+            out_mask = geodesicActiveContour.Execute(self.castToWorkingPrecision(session.bpLevelSet),
+                                                     self.castToWorkingPrecision(session.speedImg))
 
-        self.updateBPLevelSet(out_mask)
+            self.updateBPLevelSet(outputSeg, out_mask)
 
-        threshold = sitk.BinaryThresholdImageFilter()
-        threshold.SetInsideValue(1)
-        threshold.SetLowerThreshold(-1000.0)
-        threshold.SetOutsideValue(0)
-        threshold.SetUpperThreshold(0.0)
-        out_mask = threshold.Execute(out_mask)
+            threshold = sitk.BinaryThresholdImageFilter()
+            threshold.SetInsideValue(1)
+            threshold.SetLowerThreshold(-1000.0)
+            threshold.SetOutsideValue(0)
+            threshold.SetUpperThreshold(0.0)
+            out_mask = threshold.Execute(out_mask)
 
-        self.pushITKImageToSegmentation(out_mask, outputSeg, 'BP Segmentation')
+            self.updateSegmentationRegion(out_mask, previousLevelSet <= 0, outputSeg, 'BP Segmentation',
+                                          session.speedImgRefNode)
 
     def initLeafletSeg(self, outputSeg):
         """
@@ -793,50 +1716,75 @@ class MVSegmenterLogic(ScriptedLoadableModuleLogic):
         :param outputSeg: Segmentation node to save output to
         :return: None
         """
-        self.updateBPLevelSetFromSegmentation(outputSeg)
-
-        # Get region bordering initial blood-pool segmentation
-        threshold = sitk.BinaryThresholdImageFilter()
-        threshold.SetInsideValue(1)
-        threshold.SetLowerThreshold(-1000.0)
-        threshold.SetOutsideValue(0)
-        threshold.SetUpperThreshold(0.0)
-        distMap = threshold.Execute(self._bpLevelSet)
-
-        signedDis = sitk.SignedDanielssonDistanceMapImageFilter()
-        distMap = signedDis.Execute(distMap)
-
-        distThreshold = sitk.BinaryThresholdImageFilter()
-        distThreshold.SetInsideValue(1)
-        distThreshold.SetLowerThreshold(1)
-        distThreshold.SetOutsideValue(0)
-        distThreshold.SetUpperThreshold(11)
-        leafletMask = distThreshold.Execute(distMap)
-
-        # Run second pass to get final leaflet segmentation
-
-        levelSet = signedDis.Execute(leafletMask)
-
-        geodesicActiveContour2 = sitk.GeodesicActiveContourLevelSetImageFilter()
-        geodesicActiveContour2.SetCurvatureScaling(1.0)
-        geodesicActiveContour2.SetAdvectionScaling(0.1)
-        geodesicActiveContour2.SetPropagationScaling(-0.6)
-        geodesicActiveContour2.SetMaximumRMSError(0.0001)
-        geodesicActiveContour2.SetNumberOfIterations(300)
-        out_mask = geodesicActiveContour2.Execute(levelSet, self._speedImg)
-
-        self.updateLeafletLevelSet(out_mask)
+        session = self.getSession(outputSeg)
+        with session.lock:
+            self.updateBPLevelSetFromSegmentation(outputSeg)
+
+            # Get region bordering initial blood-pool segmentation
+            threshold = sitk.BinaryThresholdImageFilter()
+            threshold.SetInsideValue(1)
+            threshold.SetLowerThreshold(-1000.0)
+            threshold.SetOutsideValue(0)
+            threshold.SetUpperThreshold(0.0)
+            distMap = threshold.Execute(session.bpLevelSet)
+
+            distMap = self.computeSignedDistance(distMap, bandWidth=12)
+
+            distThreshold = sitk.BinaryThresholdImageFilter()
+            distThreshold.SetInsideValue(1)
+            distThreshold.SetLowerThreshold(1)
+            distThreshold.SetOutsideValue(0)
+            distThreshold.SetUpperThreshold(11)
+            leafletMask = distThreshold.Execute(distMap)
+
+            # Run second pass to get final leaflet segmentation
+
+            levelSet = self.computeSignedDistance(leafletMask)
+
+            geodesicActiveContour2 = sitk.GeodesicActiveContourLevelSetImageFilter()
+            geodesicActiveContour2.SetCurvatureScaling(1.0)
+            geodesicActiveContour2.SetAdvectionScaling(0.1)
+            geodesicActiveContour2.SetPropagationScaling(-0.6)
+            geodesicActiveContour2.SetMaximumRMSError(0.0001)
+            geodesicActiveContour2.SetNumberOfIterations(300)
+            geodesicActiveContour2.SetNumberOfThreads(self.getNumberOfThreads('activeContour'))
+            out_mask = geodesicActiveContour2.Execute(levelSet, self.castToWorkingPrecision(session.speedImg))
+
+            self.updateLeafletLevelSet(outputSeg, out_mask)
+
+            threshold = sitk.BinaryThresholdImageFilter()
+            threshold.SetInsideValue(1)
+            threshold.SetLowerThreshold(-1000.0)
+            threshold.SetOutsideValue(0)
+            threshold.SetUpperThreshold(0.0)
+            out_mask = threshold.Execute(out_mask)
+
+            self.pushITKImageToSegmentation(out_mask, outputSeg, 'Leaflet Segmentation')
+
+            return out_mask
+
+    def initLeafletSegFromSegmentation(self, inputVolume, outputSeg, img=None, segmentId='Leaflet Segmentation'):
+        """
+        Initializes the leaflet level set directly from an existing leaflet segmentation, e.g. the DeepMitral output,
+        so it can be refined with iterateSecondPass. Skips the blood pool segmentation and leaflet band construction.
+        :param inputVolume: The reference image volume
+        :param outputSeg: Segmentation node containing the leaflet segmentation
+        :param img: Optional itk image of the input volume if already pulled
+        :param segmentId: The segment ID of the leaflet segmentation
+        :return: None
+        """
+        if not outputSeg.GetSegmentation().GetSegment(segmentId):
+            logging.debug("initLeafletSegFromSegmentation failed: No leaflet segmentation")
+            return
 
-        threshold = sitk.BinaryThresholdImageFilter()
-        threshold.SetInsideValue(1)
-        threshold.SetLowerThreshold(-1000.0)
-        threshold.SetOutsideValue(0)
-        threshold.SetUpperThreshold(0.0)
-        out_mask = threshold.Execute(out_mask)
+        session = self.getSession(outputSeg)
+        with session.lock:
+            if img is None:
+                img = sitkUtils.PullVolumeFromSlicer(inputVolume)
 
-        self.pushITKImageToSegmentation(out_mask, outputSeg, 'Leaflet Segmentation')
+            session.setSpeedImage(self.computeSpeedImage(img), inputVolume)
 
-        return out_mask
+            self.updateLeafletLevelSetFromSegmentation(outputSeg, segmentId)
 
     def iterateSecondPass(self, nIter, outputSeg):
         """
@@ -845,69 +1793,276 @@ class MVSegmenterLogic(ScriptedLoadableModuleLogic):
         :param outputSeg: Segmentation node to save the output to
         :return: None
         """
-        self.updateLeafletLevelSetFromSegmentation(outputSeg)
+        session = self.getSession(outputSeg)
+        with session.lock:
+            self.updateLeafletLevelSetFromSegmentation(outputSeg)
+            previousLevelSet = session.leafletLevelSet
 
-        geodesicActiveContour2 = sitk.GeodesicActiveContourLevelSetImageFilter()
-        geodesicActiveContour2.SetCurvatureScaling(0.9)
-        geodesicActiveContour2.SetAdvectionScaling(0.1)
-        geodesicActiveContour2.SetPropagationScaling(-0.4)
-        geodesicActiveContour2.SetMaximumRMSError(0.0001)
-        geodesicActiveContour2.SetNumberOfIterations(nIter)
-        out_mask = geodesicActiveContour2.Execute(self._leafletLevelSet, self._speedImg)
+            geodesicActiveContour2 = self.createActiveContourFilter('Leaflet Segmentation', nIter)
+            out_mask = geodesicActiveContour2.Execute(self.castToWorkingPrecision(session.leafletLevelSet),
+                                                      self.castToWorkingPrecision(session.speedImg))
 
-        self.updateLeafletLevelSet(out_mask)
+            self.updateLeafletLevelSet(outputSeg, out_mask)
 
-        threshold = sitk.BinaryThresholdImageFilter()
-        threshold.SetInsideValue(1)
-        threshold.SetLowerThreshold(-1000.0)
-        threshold.SetOutsideValue(0)
-        threshold.SetUpperThreshold(0.0)
-        out_mask = threshold.Execute(out_mask)
+            threshold = sitk.BinaryThresholdImageFilter()
+            threshold.SetInsideValue(1)
+            threshold.SetLowerThreshold(-1000.0)
+            threshold.SetOutsideValue(0)
+            threshold.SetUpperThreshold(0.0)
+            out_mask = threshold.Execute(out_mask)
 
-        self.pushITKImageToSegmentation(out_mask, outputSeg, 'Leaflet Segmentation')
+            self.updateSegmentationRegion(out_mask, previousLevelSet <= 0, outputSeg, 'Leaflet Segmentation',
+                                          session.speedImgRefNode)
 
-        return out_mask
+            return out_mask
 
-    def updateBPLevelSet(self, levelSet):
+    def createActiveContourFilter(self, segmentId, nIter):
         """
-        Update the blood pool level set instance variable. Maintains the undo stack.
-        :param levelSet: New level set
-        :return: None
+        Creates the geodesic active contour filter used to iterate a segmentation
+        :param segmentId: 'BP Segmentation' or 'Leaflet Segmentation'
+        :param nIter: Number of iterations
+        :return: Configured GeodesicActiveContourLevelSetImageFilter
         """
-        if self._bpLevelSet:
-            # Only update if there has been a change to preserve undo pool
-            if not self.levelSetsEqual(levelSet, self._bpLevelSet):
-                self._undoBPLevelSetStack.append(self._bpLevelSet)
-                self._bpLevelSet = levelSet
+        geodesicActiveContour = sitk.GeodesicActiveContourLevelSetImageFilter()
+        if segmentId == 'BP Segmentation':
+            geodesicActiveContour.SetCurvatureScaling(1.2)
+            geodesicActiveContour.SetAdvectionScaling(1.0)
+            geodesicActiveContour.SetPropagationScaling(0.9)
+            geodesicActiveContour.SetMaximumRMSError(0.00001)
         else:
-            self._bpLevelSet = levelSet
+            geodesicActiveContour.SetCurvatureScaling(0.9)
+            geodesicActiveContour.SetAdvectionScaling(0.1)
+            geodesicActiveContour.SetPropagationScaling(-0.4)
+            geodesicActiveContour.SetMaximumRMSError(0.0001)
+        geodesicActiveContour.SetNumberOfIterations(nIter)
+        geodesicActiveContour.SetNumberOfThreads(self.getNumberOfThreads('activeContour'))
 
-    def undoBPIteration(self, outputSeg):
+        return geodesicActiveContour
+
+    def startConvergence(self, outputSeg, segmentId, rmsTolerance=None, volumeTolerance=None, timeBudget=None,
+                         maxIterations=None, nIter=None, snapshotCallback=None, snapshotIterations=None):
         """
-        Performs the undo operation on the blood pool level set
-        :param outputSeg: Segmentation node used to save output
-        :return: True if the stack has additional items, False if it is empty
+        Starts iterating a segmentation until convergence, or for a fixed number of iterations, on a worker thread.
+        Call pollConvergence from the main thread to show previews and store the final result.
+        :param outputSeg: Segmentation node to save output to
+        :param segmentId: 'BP Segmentation' or 'Leaflet Segmentation'
+        :param rmsTolerance: RMS change of the level set below which it is converged, defaults to
+        convergenceRMSTolerance
+        :param volumeTolerance: Fraction of the segmented voxels changing within a chunk below which it is converged,
+        defaults to convergenceVolumeTolerance
+        :param timeBudget: Maximum run time in seconds, defaults to convergenceTimeBudget
+        :param maxIterations: Maximum number of iterations, defaults to convergenceMaxIterations
+        :param nIter: Run exactly this many iterations instead, unless the active contour itself converges
+        :param snapshotCallback: Called from pollConvergence with new level set snapshots, callback(levelSet,
+        convergence). Without it previews are pushed to the segmentation.
+        :param snapshotIterations: Iterations between snapshots, defaults to convergenceChunkIterations, or to nIter so
+        a fixed number of iterations is one continuous filter run. The filter is restarted at every snapshot, which
+        reinitializes the level set, so chunked runs differ slightly from a continuous run of the same length.
+        :return: The MVSegmenterConvergence, None on failure
         """
-        if not self._undoBPLevelSetStack:
-            logging.debug("undoBPIteration failed: stack empty")
-            return False
+        session = self.getSession(outputSeg)
+        with session.lock:
+            if session.convergence:
+                logging.debug("startConvergence failed: Convergence already running")
+                return None
+
+            if segmentId == 'BP Segmentation':
+                self.updateBPLevelSetFromSegmentation(outputSeg)
+                levelSet = session.bpLevelSet
+            else:
+                self.updateLeafletLevelSetFromSegmentation(outputSeg)
+                levelSet = session.leafletLevelSet
+
+            if levelSet is None or session.speedImg is None:
+                logging.debug("startConvergence failed: Segmentation not initialized")
+                return None
+
+            if nIter:
+                # Fixed number of iterations, tolerances and time budget disabled
+                rmsTolerance, volumeTolerance, timeBudget, maxIterations = -1, -1, float('inf'), nIter
+                snapshotIterations = snapshotIterations or nIter
+
+            convergence = MVSegmenterConvergence(segmentId, self.castToWorkingPrecision(levelSet), snapshotCallback)
+            convergence.future = self._convergenceExecutor.submit(
+                self.runConvergence, convergence, self.castToWorkingPrecision(session.speedImg),
+                rmsTolerance if rmsTolerance is not None else self.convergenceRMSTolerance,
+                volumeTolerance if volumeTolerance is not None else self.convergenceVolumeTolerance,
+                timeBudget or self.convergenceTimeBudget, maxIterations or self.convergenceMaxIterations,
+                snapshotIterations or self.convergenceChunkIterations)
+            session.convergence = convergence
+
+            return convergence
+
+    def runConvergence(self, convergence, speedImg, rmsTolerance, volumeTolerance, timeBudget, maxIterations,
+                       chunkIterations):
+        """
+        Worker of startConvergence, iterates the active contour in chunks and records the progress
+        :param convergence: The MVSegmenterConvergence
+        :param speedImg: Speed image
+        :param rmsTolerance: RMS change tolerance
+        :param volumeTolerance: Changed voxel fraction tolerance
+        :param timeBudget: Maximum run time in seconds
+        :param maxIterations: Maximum number of iterations
+        :param chunkIterations: Iterations per chunk, a snapshot is taken after each
+        :return: None
+        """
+        start = timer()
+        try:
+            while not convergence.abortEvent.is_set():
+                chunk = min(chunkIterations, maxIterations - convergence.iterations)
+                geodesicActiveContour = self.createActiveContourFilter(convergence.segmentId, chunk)
+
+                # Count iterations as they run for progress display, a long chunk can not be interrupted
+                chunkStart = convergence.iterations
+
+                def onIteration():
+                    convergence.iterations += 1
+
+                geodesicActiveContour.AddCommand(sitk.sitkIterationEvent, onIteration)
+                levelSet = geodesicActiveContour.Execute(convergence.levelSet, speedImg)
+
+                # Keep the masks referenced while their array views are in use
+                inside = levelSet <= 0
+                changed = inside != (convergence.levelSet <= 0)
+                convergence.changedVoxels = int(np.count_nonzero(sitk.GetArrayViewFromImage(changed)))
+                convergence.rmsChange = geodesicActiveContour.GetRMSChange()
+                convergence.iterations = chunkStart + geodesicActiveContour.GetElapsedIterations()
+                convergence.levelSet = levelSet
+                convergence.version += 1
+                convergence.elapsed = timer() - start
+
+                if (geodesicActiveContour.GetElapsedIterations() < chunk or convergence.rmsChange < rmsTolerance or
+                        convergence.changedVoxels <= volumeTolerance * max(
+                            np.count_nonzero(sitk.GetArrayViewFromImage(inside)), 1)):
+                    convergence.status = 'converged'
+                elif convergence.iterations >= maxIterations:
+                    convergence.status = 'max iterations'
+                elif convergence.elapsed >= timeBudget:
+                    convergence.status = 'time budget'
+                else:
+                    continue
+                return
 
-        self._redoBPLevelSetStack.append(self._bpLevelSet)
-        self._bpLevelSet = self._undoBPLevelSetStack.pop()
+            convergence.status = 'aborted'
+        except Exception as e:
+            convergence.status = 'failed'
+            logging.debug("runConvergence failed: {0}".format(e))
 
-        threshold = sitk.BinaryThresholdImageFilter()
-        threshold.SetInsideValue(1)
-        threshold.SetLowerThreshold(-1000.0)
-        threshold.SetOutsideValue(0)
-        threshold.SetUpperThreshold(0.0)
+    def pollConvergence(self, outputSeg):
+        """
+        Shows the progress of a running convergence, throttled to the preview interval, by updating the preview surface
+        with the latest snapshot and passing it to the snapshot callback. The segment is left untouched until the
+        worker is done, then the final level set is pushed with a single undo step. Must be called from the main
+        thread.
+        :param outputSeg: Segmentation node to save output to
+        :return: The MVSegmenterConvergence, None if none is running
+        """
+        session = self.getSession(outputSeg)
+        with session.lock:
+            convergence = session.convergence
+            if not convergence:
+                return None
+
+            if convergence.future.done():
+                session.convergence = None
+                if convergence.version > 0 and convergence.status != 'failed':
+                    if convergence.segmentId == 'BP Segmentation':
+                        self.updateBPLevelSet(outputSeg, convergence.levelSet)
+                    else:
+                        self.updateLeafletLevelSet(outputSeg, convergence.levelSet)
+                    self.updateSegmentationRegion(convergence.levelSet <= 0, convergence.pushedLevelSet <= 0, outputSeg,
+                                                  convergence.segmentId, session.speedImgRefNode)
+                self.removeSegmentPreview(outputSeg, convergence.segmentId)
+
+                logging.info('{0} {1} after {2} iterations in {3:.1f}s'.format(
+                    convergence.segmentId, convergence.status, convergence.iterations, convergence.elapsed))
+                return convergence
+
+            now = time.monotonic()
+            if (convergence.version != convergence.pushedVersion and
+                    now - convergence.lastPreview >= self.convergencePreviewInterval):
+                version = convergence.version
+                levelSet = convergence.levelSet
+                self.updateSegmentPreview(outputSeg, convergence.segmentId, levelSet, convergence.previewLevelSet)
+                convergence.previewLevelSet = levelSet
+                if convergence.snapshotCallback:
+                    convergence.snapshotCallback(levelSet, convergence)
+                convergence.pushedVersion = version
+                convergence.lastPreview = now
+
+            return convergence
+
+    def abortConvergence(self, outputSeg):
+        """
+        Requests a running convergence to stop after the current chunk. The result so far is kept.
+        :param outputSeg: Segmentation node of the case
+        :return: None
+        """
+        session = self.getSession(outputSeg)
+        with session.lock:
+            if session.convergence:
+                session.convergence.abortEvent.set()
 
-        self.pushITKImageToSegmentation(threshold.Execute(self._bpLevelSet), outputSeg, 'BP Segmentation')
+    def iterateUntilConverged(self, outputSeg, segmentId, **kwargs):
+        """
+        Iterates a segmentation until convergence, blocking until done. For scripted use, the widget polls instead.
+        :param outputSeg: Segmentation node to save output to
+        :param segmentId: 'BP Segmentation' or 'Leaflet Segmentation'
+        :param kwargs: Tolerances and budgets as in startConvergence
+        :return: The finished MVSegmenterConvergence, None on failure
+        """
+        convergence = self.startConvergence(outputSeg, segmentId, **kwargs)
+        if not convergence:
+            return None
 
-        # Return true if stack is not empty
-        if self._undoBPLevelSetStack:
-            return True
-        else:
-            return False
+        convergence.future.result()
+        return self.pollConvergence(outputSeg)
+
+    def updateBPLevelSet(self, segNode, levelSet):
+        """
+        Update the blood pool level set of the case session. Maintains the undo stack.
+        :param segNode: Output segmentation node of the case
+        :param levelSet: New level set
+        :return: None
+        """
+        session = self.getSession(segNode)
+        with session.lock:
+            if session.bpLevelSet:
+                # Only update if there has been a change to preserve undo pool
+                if not self.levelSetsEqual(levelSet, session.bpLevelSet):
+                    session.undoBPLevelSetStack.append(session.bpLevelSet)
+                    session.bpLevelSet = levelSet
+            else:
+                session.bpLevelSet = levelSet
+
+    def undoBPIteration(self, outputSeg):
+        """
+        Performs the undo operation on the blood pool level set
+        :param outputSeg: Segmentation node used to save output
+        :return: True if the stack has additional items, False if it is empty
+        """
+        session = self.getSession(outputSeg)
+        with session.lock:
+            if not session.undoBPLevelSetStack:
+                logging.debug("undoBPIteration failed: stack empty")
+                return False
+
+            session.redoBPLevelSetStack.append(session.bpLevelSet)
+            session.bpLevelSet = session.popLevelSet(session.undoBPLevelSetStack)
+
+            threshold = sitk.BinaryThresholdImageFilter()
+            threshold.SetInsideValue(1)
+            threshold.SetLowerThreshold(-1000.0)
+            threshold.SetOutsideValue(0)
+            threshold.SetUpperThreshold(0.0)
+
+            self.pushITKImageToSegmentation(threshold.Execute(session.bpLevelSet), outputSeg, 'BP Segmentation')
+
+            # Return true if stack is not empty
+            if session.undoBPLevelSetStack:
+                return True
+            else:
+                return False
 
     def redoBPIteration(self, outputSeg):
         """
@@ -915,40 +2070,45 @@ class MVSegmenterLogic(ScriptedLoadableModuleLogic):
         :param outputSeg: Segmentation node used to save output
         :return: True if the stack has additional items, False if it is empty
         """
-        if not self._redoBPLevelSetStack:
-            logging.debug("redoBPIteration failed: stack empty")
-            return False
-
-        self._undoBPLevelSetStack.append(self._bpLevelSet)
-        self._bpLevelSet = self._redoBPLevelSetStack.pop()
-
-        threshold = sitk.BinaryThresholdImageFilter()
-        threshold.SetInsideValue(1)
-        threshold.SetLowerThreshold(-1000.0)
-        threshold.SetOutsideValue(0)
-        threshold.SetUpperThreshold(0.0)
-
-        self.pushITKImageToSegmentation(threshold.Execute(self._bpLevelSet), outputSeg, 'BP Segmentation')
-
-        # Return true if stack is not empty
-        if self._redoBPLevelSetStack:
-            return True
-        else:
-            return False
+        session = self.getSession(outputSeg)
+        with session.lock:
+            if not session.redoBPLevelSetStack:
+                logging.debug("redoBPIteration failed: stack empty")
+                return False
+
+            session.undoBPLevelSetStack.append(session.bpLevelSet)
+            session.bpLevelSet = session.popLevelSet(session.redoBPLevelSetStack)
+
+            threshold = sitk.BinaryThresholdImageFilter()
+            threshold.SetInsideValue(1)
+            threshold.SetLowerThreshold(-1000.0)
+            threshold.SetOutsideValue(0)
+            threshold.SetUpperThreshold(0.0)
+
+            self.pushITKImageToSegmentation(threshold.Execute(session.bpLevelSet), outputSeg, 'BP Segmentation')
+
+            # Return true if stack is not empty
+            if session.redoBPLevelSetStack:
+                return True
+            else:
+                return False
 
-    def updateLeafletLevelSet(self, levelSet):
+    def updateLeafletLevelSet(self, segNode, levelSet):
         """
-        Update the leaflet level set instance variable. Maintains the undo stack.
+        Update the leaflet level set of the case session. Maintains the undo stack.
+        :param segNode: Output segmentation node of the case
         :param levelSet: New level set
         :return: None
         """
-        if self._leafletLevelSet:
-            # Only update if there has been a change to preserve undo pool
-            if not self.levelSetsEqual(levelSet, self._leafletLevelSet):
-                self._undoLeafletLevelSetStack.append(self._leafletLevelSet)
-                self._leafletLevelSet = levelSet
-        else:
-            self._leafletLevelSet = levelSet
+        session = self.getSession(segNode)
+        with session.lock:
+            if session.leafletLevelSet:
+                # Only update if there has been a change to preserve undo pool
+                if not self.levelSetsEqual(levelSet, session.leafletLevelSet):
+                    session.undoLeafletLevelSetStack.append(session.leafletLevelSet)
+                    session.leafletLevelSet = levelSet
+            else:
+                session.leafletLevelSet = levelSet
 
     def undoLeafletIteration(self, outputSeg):
         """
@@ -956,26 +2116,29 @@ class MVSegmenterLogic(ScriptedLoadableModuleLogic):
         :param outputSeg: Segmentation node used to save output
         :return: True if the stack has additional items, False if it is empty
         """
-        if not self._undoLeafletLevelSetStack:
-            logging.debug("undoLeafletIteration failed: stack empty")
-            return False
-
-        self._redoLeafletLevelSetStack.append(self._leafletLevelSet)
-        self._leafletLevelSet = self._undoLeafletLevelSetStack.pop()
-
-        threshold = sitk.BinaryThresholdImageFilter()
-        threshold.SetInsideValue(1)
-        threshold.SetLowerThreshold(-1000.0)
-        threshold.SetOutsideValue(0)
-        threshold.SetUpperThreshold(0.0)
-
-        self.pushITKImageToSegmentation(threshold.Execute(self._leafletLevelSet), outputSeg, 'Leaflet Segmentation')
-
-        # Return true if stack is not empty
-        if self._undoLeafletLevelSetStack:
-            return True
-        else:
-            return False
+        session = self.getSession(outputSeg)
+        with session.lock:
+            if not session.undoLeafletLevelSetStack:
+                logging.debug("undoLeafletIteration failed: stack empty")
+                return False
+
+            session.redoLeafletLevelSetStack.append(session.leafletLevelSet)
+            session.leafletLevelSet = session.popLevelSet(session.undoLeafletLevelSetStack)
+
+            threshold = sitk.BinaryThresholdImageFilter()
+            threshold.SetInsideValue(1)
+            threshold.SetLowerThreshold(-1000.0)
+            threshold.SetOutsideValue(0)
+            threshold.SetUpperThreshold(0.0)
+
+            self.pushITKImageToSegmentation(threshold.Execute(session.leafletLevelSet), outputSeg,
+                                            'Leaflet Segmentation')
+
+            # Return true if stack is not empty
+            if session.undoLeafletLevelSetStack:
+                return True
+            else:
+                return False
 
     def redoLeafletIteration(self, outputSeg):
         """
@@ -984,26 +2147,29 @@ class MVSegmenterLogic(ScriptedLoadableModuleLogic):
         :return: True if the stack has additional items, False if it is empty
         """
 
-        if not self._redoLeafletLevelSetStack:
-            logging.debug("redoLeafletIteration failed: stack empty")
-            return False
+        session = self.getSession(outputSeg)
+        with session.lock:
+            if not session.redoLeafletLevelSetStack:
+                logging.debug("redoLeafletIteration failed: stack empty")
+                return False
 
-        self._undoLeafletLevelSetStack.append(self._leafletLevelSet)
-        self._leafletLevelSet = self._redoLeafletLevelSetStack.pop()
+            session.undoLeafletLevelSetStack.append(session.leafletLevelSet)
+            session.leafletLevelSet = session.popLevelSet(session.redoLeafletLevelSetStack)
 
-        threshold = sitk.BinaryThresholdImageFilter()
-        threshold.SetInsideValue(1)
-        threshold.SetLowerThreshold(-1000.0)
-        threshold.SetOutsideValue(0)
-        threshold.SetUpperThreshold(0.0)
+            threshold = sitk.BinaryThresholdImageFilter()
+            threshold.SetInsideValue(1)
+            threshold.SetLowerThreshold(-1000.0)
+            threshold.SetOutsideValue(0)
+            threshold.SetUpperThreshold(0.0)
 
-        self.pushITKImageToSegmentation(threshold.Execute(self._leafletLevelSet), outputSeg, 'Leaflet Segmentation')
+            self.pushITKImageToSegmentation(threshold.Execute(session.leafletLevelSet), outputSeg,
+                                            'Leaflet Segmentation')
 
-        # Return true if stack is not empty
-        if self._redoLeafletLevelSetStack:
-            return True
-        else:
-            return False
+            # Return true if stack is not empty
+            if session.redoLeafletLevelSetStack:
+                return True
+            else:
+                return False
 
     def updateBPLevelSetFromSegmentation(self, segNode, segmentId='BP Segmentation'):
         """
@@ -1012,14 +2178,15 @@ class MVSegmenterLogic(ScriptedLoadableModuleLogic):
         :param segmentId: The segment ID to access
         :return: None
         """
-        # Get new binary mask from segmentation node
-        mask = self.pullITKImageFromSegmentation(segNode, segmentId, self._speedImgRefNode)
+        session = self.getSession(segNode)
+        with session.lock:
+            # Get new binary mask from segmentation node
+            mask = self.pullITKImageFromSegmentation(segNode, segmentId, session.speedImgRefNode)
 
-        # Get level set from mask
-        signedDis = sitk.SignedDanielssonDistanceMapImageFilter()
-        levelSet = signedDis.Execute(mask)
+            # Get level set from mask
+            levelSet = self.computeSignedDistance(mask)
 
-        self.updateBPLevelSet(levelSet)
+            self.updateBPLevelSet(segNode, levelSet)
 
     def updateLeafletLevelSetFromSegmentation(self, segNode, segmentId='Leaflet Segmentation'):
         """
@@ -1028,14 +2195,15 @@ class MVSegmenterLogic(ScriptedLoadableModuleLogic):
         :param segmentId: The segment ID to access
         :return: None
         """
-        # Get new binary mask from segmentation node
-        mask = self.pullITKImageFromSegmentation(segNode, segmentId, self._speedImgRefNode)
+        session = self.getSession(segNode)
+        with session.lock:
+            # Get new binary mask from segmentation node
+            mask = self.pullITKImageFromSegmentation(segNode, segmentId, session.speedImgRefNode)
 
-        # Get level set from mask
-        signedDis = sitk.SignedDanielssonDistanceMapImageFilter()
-        levelSet = signedDis.Execute(mask)
+            # Get level set from mask
+            levelSet = self.computeSignedDistance(mask)
 
-        self.updateLeafletLevelSet(levelSet)
+            self.updateLeafletLevelSet(segNode, levelSet)
 
     def levelSetsEqual(self, lvlset1, lvlset2):
         """
@@ -1090,11 +2258,227 @@ class MVSegmenterLogic(ScriptedLoadableModuleLogic):
         slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(tempNode, segmentationNode,
                                                                               segmentationIds)
 
-        segmentationNode.RemoveClosedSurfaceRepresentation()
-        segmentationNode.CreateClosedSurfaceRepresentation()
+        self.updateSegmentClosedSurface(segmentationNode, segmentId)
 
         slicer.mrmlScene.RemoveNode(tempNode)
 
+    def updateSegmentClosedSurface(self, segmentationNode, segmentId, regenerate=True):
+        """
+        Creates the closed surface representation of a single segment, leaving the surfaces of the other segments as
+        they are. The closed surface is created for all segments if none of them has one.
+        :param segmentationNode: The output segmentation node
+        :param segmentId: The segment ID to create the surface for
+        :param regenerate: Replace an existing closed surface of the segment
+        :return: None
+        """
+        segmentation = segmentationNode.GetSegmentation()
+        closedSurfaceName = slicer.vtkSegmentationConverter.GetSegmentationClosedSurfaceRepresentationName()
+        segment = segmentation.GetSegment(segmentId)
+        if not segment:
+            logging.debug('updateSegmentClosedSurface failed: Segment not found - ' + segmentId)
+            return
+
+        if segment.GetRepresentation(closedSurfaceName):
+            if not regenerate:
+                return
+            segment.RemoveRepresentation(closedSurfaceName)
+
+        with self.threadStage('surface'):
+            if any(segmentation.GetNthSegment(i).GetRepresentation(closedSurfaceName)
+                   for i in range(segmentation.GetNumberOfSegments())):
+                segmentation.ConvertSingleSegment(segmentId, closedSurfaceName)
+            else:
+                segmentationNode.CreateClosedSurfaceRepresentation()
+
+    def getChangedExtent(self, img, previousImg):
+        """
+        Computes the bounding box of the voxels that differ between two images of the same size
+        :param img: The itk image
+        :param previousImg: The previous itk image
+        :return: IJK extent [i0, i1, j0, j1, k0, k1], None if the images are equal
+        """
+        changed = sitk.GetArrayViewFromImage(img) != sitk.GetArrayViewFromImage(previousImg)
+        extent = []
+        for axes in ((0, 1), (0, 2), (1, 2)):
+            indices = np.flatnonzero(changed.any(axis=axes))
+            if not len(indices):
+                return None
+            extent += [int(indices[0]), int(indices[-1])]
+
+        return extent
+
+    def updateSegmentationRegion(self, img, previousImg, segmentationNode, segmentId, refNode, updateSurface=True):
+        """
+        Updates a segment from a binary itk image, only writing the region that changed since the previous image. Falls
+        back to pushITKImageToSegmentation when the segment does not exist yet, is not stored as a labelmap or a large
+        part of the volume changed.
+        :param img: The binary itk image with the geometry of the reference node
+        :param previousImg: The binary itk image the segment currently contains, None if unknown
+        :param segmentationNode: The output segmentation node
+        :param segmentId: The segment ID to store in
+        :param refNode: The volume node the image was computed from
+        :param updateSurface: Create the closed surface representation of the segment if it has none
+        :return: The updated IJK extent, None if nothing changed
+        """
+        segmentation = segmentationNode.GetSegmentation()
+        sourceRepresentation = self.getSourceRepresentationName(segmentation)
+
+        size = img.GetSize()
+        fullExtent = [0, size[0] - 1, 0, size[1] - 1, 0, size[2] - 1]
+        if (previousImg is None or refNode is None or previousImg.GetSize() != size or
+                segmentation.GetSegmentIndex(segmentId) == -1 or
+                sourceRepresentation != slicer.vtkSegmentationConverter.GetBinaryLabelmapRepresentationName()):
+            self.pushITKImageToSegmentation(img, segmentationNode, segmentId)
+            return fullExtent
+
+        extent = self.getChangedExtent(img, previousImg)
+        if extent is None:
+            return None
+
+        extentVoxels = np.prod([extent[2 * i + 1] - extent[2 * i] + 1 for i in range(3)])
+        if extentVoxels > self.incrementalUpdateMaxFraction * img.GetNumberOfPixels():
+            self.pushITKImageToSegmentation(img, segmentationNode, segmentId)
+            return fullExtent
+
+        # Labelmap of the changed region in the IJK space of the reference volume
+        labelmap = slicer.vtkOrientedImageData()
+        labelmap.SetExtent(extent)
+        labelmap.AllocateScalars(vtk.VTK_UNSIGNED_CHAR, 1)
+        ijkToRas = vtk.vtkMatrix4x4()
+        refNode.GetIJKToRASMatrix(ijkToRas)
+        labelmap.SetImageToWorldMatrix(ijkToRas)
+
+        region = numpy_support.vtk_to_numpy(labelmap.GetPointData().GetScalars())
+        region.reshape(extent[5] - extent[4] + 1, extent[3] - extent[2] + 1, extent[1] - extent[0] + 1)[:] = \
+            sitk.GetArrayViewFromImage(img)[extent[4]:extent[5] + 1, extent[2]:extent[3] + 1, extent[0]:extent[1] + 1]
+        labelmap.Modified()
+
+        slicer.vtkSlicerSegmentationsModuleLogic.SetBinaryLabelmapToSegment(
+            labelmap, segmentationNode, segmentId, slicer.vtkSlicerSegmentationsModuleLogic.MODE_REPLACE, extent)
+
+        # Existing closed surfaces are updated by the segmentation itself, only a removed one is created
+        if updateSurface:
+            self.updateSegmentClosedSurface(segmentationNode, segmentId, regenerate=False)
+
+        return extent
+
+    def updateBlockSurface(self, session, segmentId, mask, refNode, extent=None):
+        """
+        Meshes a binary mask in blocks of surfaceBlockSize voxels, only re-meshing the blocks touching the changed
+        extent. Blocks overlap by one voxel so their surfaces join. The surface is not smoothed or decimated.
+        :param session: Session of the case holding the blocks
+        :param segmentId: The segment ID the blocks belong to
+        :param mask: Binary itk image with the geometry of the reference node
+        :param refNode: The volume node the image was computed from
+        :param extent: Changed IJK extent, None to mesh all blocks
+        :return: vtkPolyData surface in RAS coordinates
+        """
+        blocks = session.surfaceBlocks.setdefault(segmentId, {})
+        array = sitk.GetArrayViewFromImage(mask)
+        size = mask.GetSize()
+        blockSize = self.surfaceBlockSize
+
+        if extent is None or not blocks:
+            blocks.clear()
+            extent = [0, size[0] - 1, 0, size[1] - 1, 0, size[2] - 1]
+
+        # A changed voxel also affects the cells on its lower side, which can belong to the previous block
+        blockRanges = [range(max(extent[2 * i] - 1, 0) // blockSize, extent[2 * i + 1] // blockSize + 1)
+                       for i in range(3)]
+        for bk in blockRanges[2]:
+            for bj in blockRanges[1]:
+                for bi in blockRanges[0]:
+                    lower = [bi * blockSize, bj * blockSize, bk * blockSize]
+                    upper = [min(lower[i] + blockSize, size[i] - 1) for i in range(3)]
+                    block = array[lower[2]:upper[2] + 1, lower[1]:upper[1] + 1, lower[0]:upper[0] + 1]
+                    if not block.any():
+                        blocks.pop((bi, bj, bk), None)
+                        continue
+
+                    imageData = vtk.vtkImageData()
+                    imageData.SetOrigin(lower)
+                    imageData.SetDimensions([upper[i] - lower[i] + 1 for i in range(3)])
+                    imageData.GetPointData().SetScalars(
+                        numpy_support.numpy_to_vtk(np.ascontiguousarray(block, dtype=np.uint8).ravel(), deep=True))
+
+                    flyingEdges = vtk.vtkDiscreteFlyingEdges3D()
+                    flyingEdges.SetInputData(imageData)
+                    flyingEdges.SetValue(0, 1)
+                    flyingEdges.ComputeNormalsOff()
+                    flyingEdges.ComputeGradientsOff()
+                    flyingEdges.ComputeScalarsOff()
+                    blocks[(bi, bj, bk)] = self.getPipelineOutput(flyingEdges)
+
+        if not blocks:
+            return vtk.vtkPolyData()
+
+        append = vtk.vtkAppendPolyData()
+        for polyData in blocks.values():
+            append.AddInputData(polyData)
+
+        ijkToRas = vtk.vtkMatrix4x4()
+        refNode.GetIJKToRASMatrix(ijkToRas)
+        transform = vtk.vtkTransform()
+        transform.SetMatrix(ijkToRas)
+
+        transformFilter = vtk.vtkTransformPolyDataFilter()
+        transformFilter.SetTransform(transform)
+        transformFilter.SetInputConnection(append.GetOutputPort())
+
+        return self.getPipelineOutput(transformFilter)
+
+    def updateSegmentPreview(self, segNode, segmentId, levelSet, previousLevelSet):
+        """
+        Shows an intermediate level set as a preview surface model, only re-meshing the blocks that changed since the
+        previous preview. The segment is left untouched. Its closed surface representation is removed when the preview
+        starts, so the final update of the segment only generates it once. The surfaces of other segments are kept.
+        :param segNode: Output segmentation node
+        :param segmentId: The segment ID to preview
+        :param levelSet: The level set to show
+        :param previousLevelSet: The level set shown by the previous preview, None if there is none
+        :return: None
+        """
+        session = self.getSession(segNode)
+        with session.lock:
+            mask = levelSet <= 0
+            extent = None
+            if segmentId not in session.surfaceBlocks:
+                segment = segNode.GetSegmentation().GetSegment(segmentId)
+                if segment:
+                    segment.RemoveRepresentation(
+                        slicer.vtkSegmentationConverter.GetSegmentationClosedSurfaceRepresentationName())
+            elif previousLevelSet is not None:
+                extent = self.getChangedExtent(mask, previousLevelSet <= 0)
+                if extent is None:
+                    return
+
+            surface = self.updateBlockSurface(session, segmentId, mask, session.speedImgRefNode, extent)
+            self.addOrUpdateModel(surface, self.getPreviewModelName(segNode, segmentId), segNode.GetTransformNodeID())
+
+    def removeSegmentPreview(self, segNode, segmentId):
+        """
+        Removes the preview surface of a segment created by updateSegmentPreview
+        :param segNode: Output segmentation node
+        :param segmentId: The segment ID
+        :return: None
+        """
+        session = self.getSession(segNode)
+        session.surfaceBlocks.pop(segmentId, None)
+
+        node = slicer.util.getFirstNodeByName(self.getPreviewModelName(segNode, segmentId))
+        if node:
+            slicer.mrmlScene.RemoveNode(node)
+
+    def getPreviewModelName(self, segNode, segmentId):
+        """
+        Name of the preview surface model of a segment, unique per segmentation node so that the previews of several
+        cases do not replace each other
+        :param segNode: Output segmentation node
+        :param segmentId: The segment ID
+        :return: Model node name
+        """
+        return '{0}_{1}_Preview'.format(segNode.GetID(), segmentId)
+
     def pullITKImageFromSegmentation(self, segmentationNode, segmentId, refNode=None):
         """
         Retrieves an itk image from a Segmentation MRML node
@@ -1132,6 +2516,34 @@ class MVSegmenterLogic(ScriptedLoadableModuleLogic):
 
         return itkImg
 
+    def pullITKImagesFromSegmentation(self, segmentationNode, segmentIds):
+        """
+        Retrieves itk images of several segments on a shared grid cropped to the extent of the first segment
+        :param segmentationNode: The segmentation node
+        :param segmentIds: List of segment IDs to access
+        :return: List of itk images, None if a segment is missing
+        """
+        for segmentId in segmentIds:
+            if segmentationNode.GetSegmentation().GetSegmentIndex(segmentId) == -1:
+                logging.debug('pullITKImagesFromSegmentation failed: Segment not found - ' + segmentId)
+                return None
+
+        # Export first segment with its own extent, remaining segments are exported on the same grid
+        refNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode', 'temp_labelmap')
+        refNode.SetAndObserveTransformNodeID(segmentationNode.GetTransformNodeID())
+
+        segmentationIds = vtk.vtkStringArray()
+        segmentationIds.InsertNextValue(segmentIds[0])
+        slicer.modules.segmentations.logic().ExportSegmentsToLabelmapNode(segmentationNode, segmentationIds, refNode)
+
+        images = [sitkUtils.PullVolumeFromSlicer(refNode)]
+        for segmentId in segmentIds[1:]:
+            images.append(self.pullITKImageFromSegmentation(segmentationNode, segmentId, refNode))
+
+        slicer.mrmlScene.RemoveNode(refNode)
+
+        return images
+
     def rasToIJK(self, point, volume):
         """
         Convert a RAS point to an IJK point for a reference volume. Uses the volume node's RAStoIJK matrix.
@@ -1147,6 +2559,236 @@ class MVSegmenterLogic(ScriptedLoadableModuleLogic):
 
         return outPoint[0:3]
 
+    def getSurfaceTriangles(self, polyData):
+        """
+        Retrieves the points and triangles of a surface model as numpy arrays. Point ids are preserved.
+        :param polyData: vtkPolyData surface model
+        :return: (points, triangles) arrays of shape (N, 3) and (M, 3)
+        """
+        triangleFilter = vtk.vtkTriangleFilter()
+        triangleFilter.PassVertsOff()
+        triangleFilter.PassLinesOff()
+        triangleFilter.SetInputData(polyData)
+        triangleFilter.Update()
+
+        output = triangleFilter.GetOutput()
+        if not output.GetPoints() or output.GetNumberOfPolys() == 0:
+            return np.zeros((0, 3)), np.zeros((0, 3), dtype=np.int64)
+
+        points = numpy_support.vtk_to_numpy(output.GetPoints().GetData()).astype(np.float64)
+        triangles = numpy_support.vtk_to_numpy(output.GetPolys().GetConnectivityArray()).reshape(-1, 3)
+
+        return points, triangles.astype(np.int64)
+
+    def projectToCubeMap(self, vectors, resolution, faces=None):
+        """
+        Projects direction vectors onto the faces of a cube map. Within a face the projection is gnomonic, so great
+        circle arcs map to straight lines.
+        :param vectors: (N, 3) array of direction vectors, need not be normalized
+        :param resolution: Number of grid cells along each side of a cube face
+        :param faces: Optional face index to project each vector onto, defaults to the face the vector points through
+        :return: (faces, uv) where faces is the face index (-1 if the vector does not point towards the face) and uv the
+        (N, 2) grid coordinates on the face
+        """
+        vectors = np.asarray(vectors, dtype=np.float64).reshape(-1, 3)
+        rows = np.arange(len(vectors))
+        if faces is None:
+            major = np.argmax(np.abs(vectors), axis=1)
+            faces = major * 2 + (vectors[rows, major] < 0)
+        else:
+            faces = np.broadcast_to(np.asarray(faces, dtype=np.int64), rows.shape)
+            major = faces // 2
+
+        # Component along the face axis, must be positive for the vector to reach the face
+        majorValue = np.where(faces % 2 == 0, 1.0, -1.0) * vectors[rows, major]
+        valid = majorValue > 0
+        faces = np.where(valid, faces, -1)
+
+        # Remaining two axes in cyclic order give the face coordinates, in [-1, 1] when on the face
+        scale = np.where(valid, majorValue, 1.0)
+        u = vectors[rows, (major + 1) % 3] / scale
+        v = vectors[rows, (major + 2) % 3] / scale
+        uv = (np.stack((u, v), axis=1) + 1) * (0.5 * resolution)
+
+        return faces, uv
+
+    def intersectSegmentsWithSurface(self, polyData, segmentStarts, segmentEnd, startPointIds=None):
+        """
+        Batched intersection of line segments sharing a common end point with a surface model. All segments are tested
+        in one call using a vectorized ray-triangle test, with triangles binned on a cube map of directions seen from
+        the shared end point so that each segment is only tested against triangles in its direction.
+        :param polyData: vtkPolyData surface model
+        :param segmentStarts: (N, 3) array of segment start points
+        :param segmentEnd: End point shared by all segments
+        :param startPointIds: Optional array of model point ids at the segment starts. Triangles using the start point
+        are ignored, so a segment starting on the surface does not intersect at its own start point.
+        :return: (hitCounts, firstHits) arrays with the number of triangles crossed by each segment and the parametric
+        position (0 at start, 1 at end) of the intersection closest to the start, inf if there is none
+        """
+        starts = np.asarray(segmentStarts, dtype=np.float64).reshape(-1, 3)
+        end = np.asarray(segmentEnd, dtype=np.float64)
+        hitCounts = np.zeros(len(starts), dtype=np.int64)
+        firstHits = np.full(len(starts), np.inf)
+
+        points, triangles = self.getSurfaceTriangles(polyData)
+        if len(starts) == 0 or len(triangles) == 0:
+            return hitCounts, firstHits
+
+        if startPointIds is not None:
+            startPointIds = np.asarray(startPointIds, dtype=np.int64)
+            # Start points lie on the surface, skip hits at the start itself
+            minimumHit = 1e-6
+        else:
+            minimumHit = 0.0
+
+        # Bin triangles on the cube map, aiming for about 2 triangles per cell
+        resolution = max(1, int(math.ceil(math.sqrt(len(triangles) / 12.0))))
+        vertexFaces, _ = self.projectToCubeMap(points - end, resolution)
+        triangleFaces = vertexFaces[triangles]
+
+        # Triangles crossing a cube edge are binned on every face whose half space contains them. Triangles straddling
+        # the half space of a face (very large or touching the end point) are tested against every segment.
+        crossing = (triangleFaces != triangleFaces[:, :1]).any(axis=1)
+        pairTriangles = []
+        pairCells = []
+        unbinned = np.zeros(len(triangles), dtype=bool)
+        for face in range(6):
+            faceTriangles = np.flatnonzero(crossing | (triangleFaces[:, 0] == face))
+            if len(faceTriangles) == 0:
+                continue
+
+            corners = points[triangles[faceTriangles]].reshape(-1, 3) - end
+            cornerFaces, cornerUV = self.projectToCubeMap(corners, resolution, face)
+            cornerFaces = cornerFaces.reshape(-1, 3)
+            projectable = (cornerFaces >= 0).all(axis=1)
+            unbinned[faceTriangles[~projectable & (cornerFaces >= 0).any(axis=1)]] = True
+
+            faceTriangles = faceTriangles[projectable]
+            cornerUV = cornerUV.reshape(-1, 3, 2)[projectable]
+            lower = np.clip(np.floor(cornerUV.min(axis=1) - 1e-6), 0, resolution - 1).astype(np.int64)
+            upper = np.clip(np.floor(cornerUV.max(axis=1) + 1e-6), 0, resolution - 1).astype(np.int64)
+            spanV = upper[:, 1] - lower[:, 1] + 1
+            cellsPerTriangle = (upper[:, 0] - lower[:, 0] + 1) * spanV
+
+            # Expand each triangle into the (triangle, cell) pairs covered by its bounding box
+            index = np.repeat(np.arange(len(faceTriangles)), cellsPerTriangle)
+            offsets = np.arange(len(index)) - np.repeat(np.cumsum(cellsPerTriangle) - cellsPerTriangle,
+                                                        cellsPerTriangle)
+            cellU = lower[index, 0] + offsets // spanV[index]
+            cellV = lower[index, 1] + offsets % spanV[index]
+            pairTriangles.append(faceTriangles[index])
+            pairCells.append((face * resolution + cellU) * resolution + cellV)
+
+        unbinned |= (triangleFaces < 0).any(axis=1)
+        globalTriangles = np.flatnonzero(unbinned)
+        pairTriangles = np.concatenate(pairTriangles) if pairTriangles else np.zeros(0, dtype=np.int64)
+        pairCells = np.concatenate(pairCells) if pairCells else np.zeros(0, dtype=np.int64)
+        binned = ~unbinned[pairTriangles]
+        pairTriangles = pairTriangles[binned]
+        pairCells = pairCells[binned]
+
+        # Bin segments by their direction from the shared end point
+        rayFaces, rayUV = self.projectToCubeMap(starts - end, resolution)
+        validRays = np.flatnonzero(rayFaces >= 0)
+        rayCells = np.clip(np.floor(rayUV[validRays]), 0, resolution - 1).astype(np.int64)
+        rayCells = (rayFaces[validRays] * resolution + rayCells[:, 0]) * resolution + rayCells[:, 1]
+
+        order = np.argsort(rayCells, kind='stable')
+        sortedRays = validRays[order]
+        sortedCells = rayCells[order]
+        cellStart = np.searchsorted(sortedCells, pairCells, side='left')
+        cellCount = np.searchsorted(sortedCells, pairCells, side='right') - cellStart
+
+        def testCandidates(candidateRays, candidateTriangles):
+            origins = starts[candidateRays]
+            directions = end - origins
+            v0 = points[triangles[candidateTriangles, 0]]
+            edge1 = points[triangles[candidateTriangles, 1]] - v0
+            edge2 = points[triangles[candidateTriangles, 2]] - v0
+
+            # Moller-Trumbore ray-triangle intersection
+            pvec = np.cross(directions, edge2)
+            det = np.einsum('ij,ij->i', edge1, pvec)
+            parallel = np.abs(det) < 1e-12
+            invDet = 1.0 / np.where(parallel, 1.0, det)
+            tvec = origins - v0
+            u = np.einsum('ij,ij->i', tvec, pvec) * invDet
+            qvec = np.cross(tvec, edge1)
+            v = np.einsum('ij,ij->i', directions, qvec) * invDet
+            t = np.einsum('ij,ij->i', edge2, qvec) * invDet
+
+            tolerance = 1e-9
+            hit = ~parallel & (u >= -tolerance) & (v >= -tolerance) & (u + v <= 1 + tolerance) \
+                  & (t >= minimumHit) & (t <= 1)
+            if startPointIds is not None:
+                hit &= (triangles[candidateTriangles] != startPointIds[candidateRays, np.newaxis]).all(axis=1)
+
+            np.add.at(hitCounts, candidateRays[hit], 1)
+            np.minimum.at(firstHits, candidateRays[hit], t[hit])
+
+        # Test candidate pairs in chunks to bound memory use
+        chunkSize = 1 << 20
+        candidateTotals = np.cumsum(cellCount)
+        first = 0
+        while first < len(pairCells):
+            base = candidateTotals[first - 1] if first > 0 else 0
+            last = max(int(np.searchsorted(candidateTotals, base + chunkSize, side='right')), first + 1)
+            counts = cellCount[first:last]
+            total = int(counts.sum())
+            if total > 0:
+                rayOffsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+                candidateRays = sortedRays[np.repeat(cellStart[first:last], counts) + rayOffsets]
+                testCandidates(candidateRays, np.repeat(pairTriangles[first:last], counts))
+            first = last
+
+        raysPerChunk = max(1, chunkSize // max(1, len(validRays)))
+        for first in range(0, len(globalTriangles), raysPerChunk):
+            chunk = globalTriangles[first:first + raysPerChunk]
+            testCandidates(np.tile(validRays, len(chunk)), np.repeat(chunk, len(validRays)))
+
+        return hitCounts, firstHits
+
+    def getVisibleSurfacePoints(self, polyData, pointIds, target, backend=None):
+        """
+        Tests which surface points are visible from a target point, i.e. the line from the point to the target crosses
+        no triangle other than those at the point itself.
+        Previous versions kept a point when vtkOBBTree reported exactly one intersection, assuming the intersection at
+        the point itself is always reported. It is only reported depending on rounding, and the OBB tree list query
+        also misses crossings, so that rule selected an arbitrary part of the surface.
+        :param polyData: vtkPolyData surface model
+        :param pointIds: Array of ids of the model points to test
+        :param target: Target point of the lines
+        :param backend: 'batched' or 'obb', defaults to visibilityBackend. 'batched' uses intersectSegmentsWithSurface,
+        'obb' queries the first intersection of vtkOBBTree for each line, starting just past the point
+        :return: Boolean array, True for visible points
+        """
+        backend = backend or self.visibilityBackend
+        pointIds = np.asarray(pointIds, dtype=np.int64)
+        points = numpy_support.vtk_to_numpy(polyData.GetPoints().GetData())[pointIds].astype(np.float64)
+
+        if backend == 'batched':
+            hitCounts, _ = self.intersectSegmentsWithSurface(polyData, points, target, pointIds)
+            return hitCounts == 0
+
+        if backend != 'obb':
+            raise ValueError('Unknown visibility backend: {0}'.format(backend))
+
+        obb = vtk.vtkOBBTree()
+        obb.SetDataSet(polyData)
+        obb.BuildLocator()
+
+        t = vtk.mutable(0.0)
+        x = [0.0, 0.0, 0.0]
+        pcoords = [0.0, 0.0, 0.0]
+        subId = vtk.mutable(0)
+        cellId = vtk.mutable(0)
+        visible = np.zeros(len(points), dtype=bool)
+        for i, point in enumerate(points):
+            start = point + 1e-6 * (np.asarray(target) - point)
+            visible[i] = obb.IntersectWithLine(start, target, 0.0, t, x, pcoords, subId, cellId) == 0
+
+        return visible
+
     def generateSurfaceMarkups(self, segNode, heartValveNode, markupsNode):
         """
         Generate evenly spaced markups on the surface of the model.
@@ -1169,10 +2811,6 @@ class MVSegmenterLogic(ScriptedLoadableModuleLogic):
             logging.debug("generateSurfaceMarkups failed: Missing segmentation")
             return False
 
-        obb = vtk.vtkOBBTree()
-        obb.SetDataSet(leafletModel)
-        obb.BuildLocator()
-
         markupsNode.RemoveAllMarkups()
         markupsNode.SetAndObserveTransformNodeID(segNode.GetTransformNodeID())
 
@@ -1185,16 +2823,10 @@ class MVSegmenterLogic(ScriptedLoadableModuleLogic):
         fixedMarkupsNode.RemoveAllMarkups()
 
         # Get points from leaflet model where line from point to annulus center does not self intersect
-        a0 = np.zeros(3)
         contourPlane = valveModel.getAnnulusContourPlane()
-        points = vtk.vtkPoints()
-        ids = vtk.vtkIdTypeArray()
-        for i in range(leafletModel.GetNumberOfPoints()):
-            leafletModel.GetPoint(i, a0)
-            r = obb.IntersectWithLine(a0, contourPlane[0], points, None)
-            # If only 1 intersection point, line does not cross through leaflet model as the line always intersects at a0
-            if points.GetNumberOfPoints() == 1:
-                index = ids.InsertNextValue(i)
+        visible = self.getVisibleSurfacePoints(leafletModel, np.arange(leafletModel.GetNumberOfPoints()),
+                                               contourPlane[0])
+        ids = numpy_support.numpy_to_vtk(np.flatnonzero(visible), deep=True, array_type=vtk.VTK_ID_TYPE)
 
         # Extract the points lying on the inside of the model
         selectionNode = vtk.vtkSelectionNode()
@@ -1208,28 +2840,22 @@ class MVSegmenterLogic(ScriptedLoadableModuleLogic):
         extractSelection = vtk.vtkExtractSelection()
         extractSelection.SetInputData(0, leafletModel)
         extractSelection.SetInputData(1, selection)
-        extractSelection.Update()
 
         geom = vtk.vtkGeometryFilter()
         geom.SetInputConnection(extractSelection.GetOutputPort())
-        geom.Update()
 
         # Cleaner ensures points are spaced out evenly
         cleaner = vtk.vtkCleanPolyData()
         cleaner.SetTolerance(0.07)
         cleaner.SetInputConnection(geom.GetOutputPort())
-        cleaner.Update()
 
-        # Populate markups node with model points
-        mNodeModifyState = markupsNode.StartModify()
-        fNodeModifyState = fixedMarkupsNode.StartModify()
-        points = cleaner.GetOutput().GetPoints()
-        for i in range(points.GetNumberOfPoints()):
-            markupsNode.AddFiducialFromArray(points.GetPoint(i))
-            fixedMarkupsNode.AddFiducialFromArray(points.GetPoint(i))
+        self.releaseIntermediateData(extractSelection, geom)
 
-        markupsNode.EndModify(mNodeModifyState)
-        fixedMarkupsNode.EndModify(fNodeModifyState)
+        # Populate markups node with model points
+        surfacePoints = self.getPipelineOutput(cleaner, 'generateSurfaceMarkups').GetPoints()
+        points = numpy_support.vtk_to_numpy(surfacePoints.GetData())
+        self.setMarkupsControlPoints(markupsNode, points)
+        self.setMarkupsControlPoints(fixedMarkupsNode, points)
 
         markupsNode.GetMarkupsDisplayNode().SetTextScale(0)
 
@@ -1238,6 +2864,19 @@ class MVSegmenterLogic(ScriptedLoadableModuleLogic):
 
         return True
 
+    def setMarkupsControlPoints(self, markupsNode, points):
+        """
+        Replaces all control points of a markups node from an array in a single update
+        :param markupsNode: Markups node to populate
+        :param points: (N, 3) array of control point positions in node coordinates
+        :return: None
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+
+        modifyState = markupsNode.StartModify()
+        slicer.util.updateMarkupsControlPointsFromArray(markupsNode, points)
+        markupsNode.EndModify(modifyState)
+
     def pushModelToSegmentation(self, segNode, model, name):
         """
         Method to push a vtkPolyData model to a segmentation node
@@ -1276,11 +2915,35 @@ class MVSegmenterLogic(ScriptedLoadableModuleLogic):
         valveModel = HeartValveLib.getValveModel(heartValveNode)
         segNode.CreateClosedSurfaceRepresentation()
 
-        # Get the proximal surface of the valve
-        extractedSurface = self.extractInnerSurfaceModel(segNode, valveModel)
-        if not extractedSurface:
+        mold = self.buildSurfaceMold(segNode, valveModel, depth)
+        if not mold:
             return None
 
+        self.pushModelToSegmentation(segNode, mold, 'Mold_base')
+
+        # Remake closed surface representation after adding mold (makes it generated model from labelmap)
+        segNode.RemoveClosedSurfaceRepresentation()
+        segNode.CreateClosedSurfaceRepresentation()
+
+        # Smoothing
+        self.smoothSegment(segNode, 'Mold_base', 0.8, volume)
+
+    def buildSurfaceMold(self, segNode, valveModel, depth):
+        """
+        Builds the surface mold model from the leaflet segmentation, clipped at the specified depth. Reuses the cached
+        depth independent surfaces so only the base clipping is recomputed when the depth changes.
+        :param segNode: The Segmentation node
+        :param valveModel: SlicerHeart HeartValve MRML node containing annulus definition
+        :param depth: Clipping depth
+        :return: vtkPolyData model of the mold, None on failure
+        """
+        # Get the proximal surface of the valve and the parts of the mold that do not depend on depth
+        moldSurfaces = self.getMoldSurfaces(segNode, valveModel)
+        if not moldSurfaces:
+            return None
+
+        _, topMold, bottomExtrusion = moldSurfaces
+
         contourPlane = valveModel.getAnnulusContourPlane()
 
         # Create clipped leaflet mold across middle
@@ -1288,54 +2951,222 @@ class MVSegmenterLogic(ScriptedLoadableModuleLogic):
         baseClippingPlane.SetNormal(contourPlane[1])
         baseClippingPlane.SetOrigin(contourPlane[0] + contourPlane[1] * depth)
 
-        midClippingPlane = vtk.vtkPlane()
-        midClippingPlane.SetNormal(contourPlane[1])
-        midClippingPlane.SetOrigin(contourPlane[0])
-        # midClippingPlane.SetOrigin(contourPlane[0] + (contourPlane[1] * 2))
-
-        topMold, bottomMold = self.buildMoldHalves(extractedSurface, midClippingPlane, baseClippingPlane)
+        bottomMold = self.clipBottomMoldHalf(bottomExtrusion, baseClippingPlane)
 
         # Put top, bottom and base of mold together
 
         append = vtk.vtkAppendPolyData()
         append.AddInputData(topMold)
         append.AddInputData(bottomMold)
-        append.Update()
 
         normAuto = vtk.vtkPolyDataNormals()
         normAuto.ConsistencyOn()
         normAuto.SetInputConnection(append.GetOutputPort())
-        normAuto.Update()
 
-        mold = vtk.vtkPolyData()
-        mold.DeepCopy(normAuto.GetOutput())
+        self.releaseIntermediateData(append)
 
-        self.pushModelToSegmentation(segNode, mold, 'Mold_base')
+        return self.getPipelineOutput(normAuto, 'buildSurfaceMold')
 
-        # Remake closed surface representation after adding mold (makes it generated model from labelmap)
-        segNode.RemoveClosedSurfaceRepresentation()
-        segNode.CreateClosedSurfaceRepresentation()
+    def previewSurfaceMold(self, segNode, heartValveNode, depth):
+        """
+        Shows the surface mold clipped at the specified depth as a model without modifying the segmentation.
+        :param segNode: The Segmentation node
+        :param heartValveNode: SlicerHeart HeartValve MRML node contatining annulus definition
+        :param depth: Clipping depth
+        :return: vtkPolyData model of the mold, None on failure
+        """
+        if not segNode or not heartValveNode:
+            logging.debug("previewSurfaceMold failed: Missing parameter")
+            return None
 
-        # Create segment editor to get access to effects
-        segmentEditorWidget = slicer.qMRMLSegmentEditorWidget()
-        segmentEditorWidget.setMRMLScene(slicer.mrmlScene)
-        segmentEditorNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentEditorNode")
-        segmentEditorNode.SetOverwriteMode(segmentEditorNode.OverwriteNone)
-        segmentEditorWidget.setMRMLSegmentEditorNode(segmentEditorNode)
-        segmentEditorWidget.setSegmentationNode(segNode)
-        segmentEditorWidget.setMasterVolumeNode(volume)
-        segmentEditorWidget.setCurrentSegmentID('Mold_base')
+        valveModel = HeartValveLib.getValveModel(heartValveNode)
+        mold = self.buildSurfaceMold(segNode, valveModel, depth)
+        if not mold:
+            return None
 
-        # Smoothing
-        segmentEditorWidget.setActiveEffectByName("Smoothing")
-        effect = segmentEditorWidget.activeEffect()
-        effect.setParameter("SmoothingMethod", "GAUSSIAN")
-        effect.setParameter("GaussianStandardDeviationMm", 0.8)
-        effect.self().onApply()
+        self.addOrUpdateModel(mold, 'Mold_base_Preview', segNode.GetTransformNodeID())
 
-        # Clean up
-        segmentEditorWidget = None
-        slicer.mrmlScene.RemoveNode(segmentEditorNode)
+        return mold
+
+    def previewProjectedAnnulus(self, segNode, heartValveNode, offset=0):
+        """
+        Shows the annulus projected onto the mold with the specified offset as models without modifying the
+        segmentation.
+        :param segNode: Segmentation node
+        :param heartValveNode: Heart valve node containing annulus
+        :param offset: Optional offset value for projection
+        :return: vtkPolyData models (projectedAnnulus, stiffener), None on failure
+        """
+        if not segNode or not heartValveNode:
+            logging.debug("previewProjectedAnnulus failed: Missing parameter")
+            return None
+
+        segMold = segNode.GetClosedSurfaceInternalRepresentation('Mold_base')
+        if not segMold:
+            logging.debug("previewProjectedAnnulus: Missing mold segmentation")
+            return None
+
+        valveModel = HeartValveLib.getValveModel(heartValveNode)
+        projection = self.generateProjectedAnnulus(segMold, valveModel, offset)
+        if not projection:
+            return None
+
+        projectedAnnulus, stiffener = projection
+        self.addOrUpdateModel(projectedAnnulus, 'Projected_Annulus_Preview', segNode.GetTransformNodeID())
+        self.addOrUpdateModel(stiffener, 'Stiffener_Preview', segNode.GetTransformNodeID())
+
+        return projection
+
+    def updateContourPreview(self, levelSet, referenceNode):
+        """
+        Shows the zero level set as an outline in the slice views. Only the voxels of a label map node are updated, the
+        segmentation and its closed surfaces are left untouched.
+        :param levelSet: Level set itk image with the geometry of the reference node
+        :param referenceNode: The volume node the level set was computed from
+        :return: None
+        """
+        node = slicer.util.getFirstNodeByName('Contour_Preview')
+        if not node:
+            node = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode', 'Contour_Preview')
+            node.CreateDefaultDisplayNodes()
+            node.CopyOrientation(referenceNode)
+            node.SetAndObserveTransformNodeID(referenceNode.GetTransformNodeID())
+
+            sliceCompositeNodes = slicer.util.getNodesByClass('vtkMRMLSliceCompositeNode')
+            sliceNodes = slicer.util.getNodesByClass('vtkMRMLSliceNode')
+            self._contourPreviewSliceState = (
+                [(compositeNode, compositeNode.GetLabelVolumeID()) for compositeNode in sliceCompositeNodes],
+                [(sliceNode, sliceNode.GetUseLabelOutline()) for sliceNode in sliceNodes])
+            for sliceCompositeNode in sliceCompositeNodes:
+                sliceCompositeNode.SetLabelVolumeID(node.GetID())
+            for sliceNode in sliceNodes:
+                sliceNode.SetUseLabelOutline(True)
+
+        slicer.util.updateVolumeFromArray(node, sitk.GetArrayFromImage(levelSet <= 0))
+
+    def removeContourPreview(self):
+        """
+        Removes the contour outline created by updateContourPreview and restores the label layer and outline setting of
+        the slice views
+        :return: None
+        """
+        node = slicer.util.getFirstNodeByName('Contour_Preview')
+        if node:
+            slicer.mrmlScene.RemoveNode(node)
+
+        if self._contourPreviewSliceState:
+            sliceCompositeStates, sliceStates = self._contourPreviewSliceState
+            for sliceCompositeNode, labelVolumeId in sliceCompositeStates:
+                sliceCompositeNode.SetLabelVolumeID(labelVolumeId)
+            for sliceNode, useLabelOutline in sliceStates:
+                sliceNode.SetUseLabelOutline(useLabelOutline)
+            self._contourPreviewSliceState = None
+
+    def removePreviews(self, moldPreview=True, annulusPreview=True):
+        """
+        Removes the preview models created by previewSurfaceMold and previewProjectedAnnulus
+        :param moldPreview: Remove the mold preview
+        :param annulusPreview: Remove the projected annulus and stiffener previews
+        :return: None
+        """
+        names = []
+        if moldPreview:
+            names.append('Mold_base_Preview')
+        if annulusPreview:
+            names += ['Projected_Annulus_Preview', 'Stiffener_Preview']
+
+        for name in names:
+            node = slicer.util.getFirstNodeByName(name)
+            if node:
+                slicer.mrmlScene.RemoveNode(node)
+
+    def getMoldSurfaces(self, segNode, valveModel, segName='Leaflet Segmentation'):
+        """
+        Retrieves the extracted inner surface, the top half of the mold and the unclipped bottom half of the mold. These
+        do not depend on the base depth, so they are cached and only rebuilt when the leaflet segment or the annulus
+        contour change.
+        :param segNode: The segmentation node
+        :param valveModel: SlicerHeart HeartValve MRML node containing annulus definition
+        :param segName: Name of segment containing leaflet segmentation
+        :return: vtkPolyData models (extractedSurface, topMold, bottomExtrusion), None on failure
+        """
+        key = self.getMoldCacheKey(segNode, valveModel, segName)
+        session = self.getSession(segNode)
+        cached = session.moldSurfaces
+        if key and cached and cached[0] == key:
+            return cached[1]
+
+        # Get the proximal surface of the valve
+        extractedSurface = self.extractInnerSurfaceModel(segNode, valveModel, segName)
+        if not extractedSurface:
+            return None
+
+        contourPlane = valveModel.getAnnulusContourPlane()
+
+        midClippingPlane = vtk.vtkPlane()
+        midClippingPlane.SetNormal(contourPlane[1])
+        midClippingPlane.SetOrigin(contourPlane[0])
+        # midClippingPlane.SetOrigin(contourPlane[0] + (contourPlane[1] * 2))
+
+        topSurface, bottomSurface, midFill = self.splitMoldSurface(extractedSurface, midClippingPlane)
+        topMold, bottomExtrusion = self.runInParallel(
+            lambda: self.buildTopMoldHalf(topSurface, midClippingPlane),
+            lambda: self.buildBottomMoldExtrusion(bottomSurface, midFill, midClippingPlane))
+
+        moldSurfaces = (extractedSurface, topMold, bottomExtrusion)
+        if key:
+            session.moldSurfaces = (key, moldSurfaces)
+
+        return moldSurfaces
+
+    def getMoldCacheKey(self, segNode, valveModel, segName='Leaflet Segmentation'):
+        """
+        Builds the key identifying the inputs of the depth independent mold surfaces. Uses the modified time of the
+        leaflet segment source representation, the annulus contour point positions, the decimation budgets and the
+        visibility backend.
+        :param segNode: The segmentation node
+        :param valveModel: SlicerHeart HeartValve MRML node containing annulus definition
+        :param segName: Name of segment containing leaflet segmentation
+        :return: Hashable key, None if the leaflet segment does not exist
+        """
+        sourceModifiedTime = self.getSourceRepresentationMTime(segNode, segName)
+        if sourceModifiedTime is None:
+            return None
+
+        annulusPoints = slicer.util.arrayFromMarkupsControlPoints(valveModel.getAnnulusContourMarkupNode())
+
+        return (segName, sourceModifiedTime, annulusPoints.tobytes(), json.dumps(self.decimationBudgets, sort_keys=True),
+                self.visibilityBackend)
+
+    def getSourceRepresentationMTime(self, segNode, segName):
+        """
+        Retrieves the modified time of the source representation of a segment
+        :param segNode: The segmentation node
+        :param segName: Name of the segment
+        :return: Modified time, None if the segment or its source representation does not exist
+        """
+        segmentation = segNode.GetSegmentation()
+        segment = segmentation.GetSegment(segmentation.GetSegmentIdBySegmentName(segName))
+        if not segment:
+            return None
+
+        sourceRepresentation = segment.GetRepresentation(self.getSourceRepresentationName(segmentation))
+        if not sourceRepresentation:
+            return None
+
+        return sourceRepresentation.GetMTime()
+
+    def getSourceRepresentationName(self, segmentation):
+        """
+        Retrieves the name of the source representation of a segmentation, called master representation before
+        Slicer 5.2
+        :param segmentation: vtkSegmentation
+        :return: Representation name
+        """
+        if hasattr(segmentation, 'GetSourceRepresentationName'):
+            return segmentation.GetSourceRepresentationName()
+
+        return segmentation.GetMasterRepresentationName()
 
     def projectAnnulus(self, segNode, heartValveNode, offset=0):
         """
@@ -1359,54 +3190,191 @@ class MVSegmenterLogic(ScriptedLoadableModuleLogic):
             return None
 
         # Get the annulus projected onto the proximal surface
-        projectedAnnulus, stiffener = self.generateProjectedAnnulus(segMold, valveModel, offset)
-        if not projectedAnnulus:
+        projection = self.generateProjectedAnnulus(segMold, valveModel, offset)
+        if not projection:
             return None
 
+        projectedAnnulus, stiffener = projection
+
         self.pushModelToSegmentation(segNode, projectedAnnulus, 'Projected_Annulus')
         self.pushModelToSegmentation(segNode, stiffener, 'Stiffener_Surface')
+        self.getSession(segNode).projectedAnnulus = projectedAnnulus
 
         # Remake closed surface representation after adding mold (makes it generated model from labelmap)
         segNode.RemoveClosedSurfaceRepresentation()
         segNode.CreateClosedSurfaceRepresentation()
 
-        # Create segment editor to get access to effects
-        segmentEditorWidget = slicer.qMRMLSegmentEditorWidget()
-        segmentEditorWidget.setMRMLScene(slicer.mrmlScene)
-        segmentEditorNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentEditorNode")
-        segmentEditorNode.SetOverwriteMode(segmentEditorNode.OverwriteNone)
-        segmentEditorWidget.setMRMLSegmentEditorNode(segmentEditorNode)
-        segmentEditorWidget.setSegmentationNode(segNode)
-        segmentEditorWidget.setMasterVolumeNode(valveModel.getValveVolumeNode())
-        segmentEditorWidget.setCurrentSegmentID('Stiffener_Surface')
+        # Smoothing
+        self.smoothSegment(segNode, 'Stiffener_Surface', 1.0, valveModel.getValveVolumeNode())
+
+    def subtractAnnulusSegmentation(self, segNode, volume):
+        """
+        Performs binary subtraction in the segmentation node
+        :param segNode: Segmentation node
+        :param volume: Master volume
+        :return: None
+        """
+        # Check that parameters exist
+        if not segNode or not volume:
+            logging.debug("subtractAnnulusSegmentation failed: Missing parameter")
+            return None
+
+        if not segNode.GetSegmentation().GetSegment('Projected_Annulus') or not segNode.GetSegmentation().GetSegment(
+                'Mold_base'):
+            logging.debug("subtractAnnulusSegmentation failed: Missing segment")
+            return None
+
+        if self.useSegmentEditorEffects:
+            # Subtraction
+            self.applySegmentEditorEffect(segNode, volume, 'Mold_base', "Logical operators",
+                                          {"Operation": "SUBTRACT", "Bypass masking": 1,
+                                           "ModifierSegmentID": 'Projected_Annulus'})
+
+            # Smoothing
+            self.smoothSegment(segNode, 'Mold_base', 0.8, volume)
+            return
+
+        # Subtraction on the labelmaps cropped to the mold extent
+        mold, annulus = self.pullITKImagesFromSegmentation(segNode, ['Mold_base', 'Projected_Annulus'])
+        moldArray = sitk.GetArrayViewFromImage(mold) != 0
+        moldArray &= sitk.GetArrayViewFromImage(annulus) == 0
+        subtracted = sitk.GetImageFromArray(moldArray.astype(np.uint8))
+        subtracted.CopyInformation(mold)
 
         # Smoothing
-        segmentEditorWidget.setActiveEffectByName("Smoothing")
-        effect = segmentEditorWidget.activeEffect()
-        effect.setParameter("SmoothingMethod", "GAUSSIAN")
-        effect.setParameter("GaussianStandardDeviationMm", 1.0)
-        effect.self().onApply()
+        self.pushITKImageToSegmentation(self.smoothLabelmap(subtracted, 0.8), segNode, 'Mold_base')
+
+    def subtractAnnulusModel(self, segNode):
+        """
+        Subtracts the projected annulus from the mold on the closed surface models instead of the labelmaps. Uses the
+        tube generated by projectAnnulus if available, otherwise the closed surface of the Projected_Annulus segment.
+        The resulting surface is pushed to the Mold_base segment, which converts it to its labelmap source
+        representation, and kept in the session so buildMoldExportParts exports it directly while the segment is not
+        modified.
+        :param segNode: Segmentation node
+        :return: vtkPolyData model of the subtracted mold, None on failure
+        """
+        # Check that parameters exist
+        if not segNode:
+            logging.debug("subtractAnnulusModel failed: Missing parameter")
+            return None
+
+        if not segNode.GetSegmentation().GetSegment('Projected_Annulus') or not segNode.GetSegmentation().GetSegment(
+                'Mold_base'):
+            logging.debug("subtractAnnulusModel failed: Missing segment")
+            return None
+
+        segMold = segNode.GetClosedSurfaceInternalRepresentation('Mold_base')
+        annulus = self.getSession(segNode).projectedAnnulus
+        if not annulus:
+            annulus = segNode.GetClosedSurfaceInternalRepresentation('Projected_Annulus')
+        if not segMold or not annulus:
+            logging.debug("subtractAnnulusModel failed: Missing closed surface representation")
+            return None
+
+        mold = self.subtractSurface(segMold, annulus)
+        if not mold:
+            return None
+
+        self.pushModelToSegmentation(segNode, mold, 'Mold_base')
+        self.getSession(segNode).subtractedMold = (self.getSourceRepresentationMTime(segNode, 'Mold_base'), mold)
+
+        return mold
+
+    def subtractSurface(self, surface, cutter):
+        """
+        Boolean difference of two closed surface models. The intersection curves are stitched into both surfaces by
+        vtkLoopBooleanPolyDataFilter, so the result is closed if both inputs are.
+        :param surface: vtkPolyData closed surface model
+        :param cutter: vtkPolyData closed surface model to subtract
+        :return: vtkPolyData model of the difference, None if the result is not closed
+        """
+        # Boolean filter requires triangles, the projected annulus tube consists of triangle strips
+        surfaceTriangles = vtk.vtkTriangleFilter()
+        surfaceTriangles.SetInputData(surface)
+
+        cutterTriangles = vtk.vtkTriangleFilter()
+        cutterTriangles.SetInputData(cutter)
+
+        boolean = vtk.vtkLoopBooleanPolyDataFilter()
+        boolean.SetOperationToDifference()
+        boolean.SetInputConnection(0, surfaceTriangles.GetOutputPort())
+        boolean.SetInputConnection(1, cutterTriangles.GetOutputPort())
+
+        # Merge the duplicated points along the intersection curves
+        clean = vtk.vtkCleanPolyData()
+        clean.SetInputConnection(boolean.GetOutputPort())
+
+        triangles = vtk.vtkTriangleFilter()
+        triangles.SetInputConnection(clean.GetOutputPort())
+
+        self.releaseIntermediateData(surfaceTriangles, cutterTriangles, boolean, clean)
+        difference = self.getPipelineOutput(triangles, 'subtractSurface')
+
+        # Check the result is watertight, no boundary or non-manifold edges
+        edges = vtk.vtkFeatureEdges()
+        edges.BoundaryEdgesOn()
+        edges.NonManifoldEdgesOn()
+        edges.FeatureEdgesOff()
+        edges.ManifoldEdgesOff()
+        edges.SetInputData(difference)
+        edges.Update()
+
+        openEdges = edges.GetOutput().GetNumberOfCells()
+        if difference.GetNumberOfCells() == 0 or openEdges > 0:
+            logging.debug("subtractSurface failed: Result is not closed, {0} open edges".format(openEdges))
+            return None
+
+        return difference
+
+    def smoothSegment(self, segNode, segmentId, standardDeviationMm, volume=None):
+        """
+        Gaussian smoothing of a segment. Operates directly on the segment labelmap unless useSegmentEditorEffects is
+        set, in which case the segment editor Smoothing effect is used.
+        :param segNode: Segmentation node
+        :param segmentId: The segment ID to smooth
+        :param standardDeviationMm: Standard deviation of the Gaussian kernel in mm
+        :param volume: Master volume, only required by the segment editor effect
+        :return: None
+        """
+        if self.useSegmentEditorEffects:
+            self.applySegmentEditorEffect(segNode, volume, segmentId, "Smoothing",
+                                          {"SmoothingMethod": "GAUSSIAN",
+                                           "GaussianStandardDeviationMm": standardDeviationMm})
+            return
+
+        images = self.pullITKImagesFromSegmentation(segNode, [segmentId])
+        if not images:
+            return
+
+        self.pushITKImageToSegmentation(self.smoothLabelmap(images[0], standardDeviationMm), segNode, segmentId)
+
+    def smoothLabelmap(self, img, standardDeviationMm):
+        """
+        Gaussian smoothing of a binary labelmap, equivalent to the GAUSSIAN method of the segment editor Smoothing
+        effect. Uses a recursive Gaussian filter and thresholds the result at half the label value.
+        :param img: Binary itk image
+        :param standardDeviationMm: Standard deviation of the Gaussian kernel in mm
+        :return: Smoothed binary itk image
+        """
+        # Pad so the image boundary does not affect the smoothing near the segment
+        padding = [int(math.ceil(4 * standardDeviationMm / spacing)) for spacing in img.GetSpacing()]
+        padded = sitk.ConstantPad(sitk.Cast(img != 0, sitk.sitkFloat32), padding, padding, 0)
+
+        smoothed = sitk.SmoothingRecursiveGaussian(padded, standardDeviationMm)
 
-        # Clean up
-        segmentEditorWidget = None
-        slicer.mrmlScene.RemoveNode(segmentEditorNode)
+        return sitk.Cast(smoothed >= 0.5, sitk.sitkUInt8)
 
-    def subtractAnnulusSegmentation(self, segNode, volume):
+    def applySegmentEditorEffect(self, segNode, volume, segmentId, effectName, parameters):
         """
-        Performs binary subtraction in the segmentation node
+        Applies a segment editor effect to a segment using a temporary segment editor widget. Requires the GUI.
         :param segNode: Segmentation node
         :param volume: Master volume
+        :param segmentId: The segment ID to modify
+        :param effectName: Name of the segment editor effect
+        :param parameters: Dictionary of effect parameters
         :return: None
         """
-        # Check that parameters exist
-        if not segNode or not volume:
-            logging.debug("subtractAnnulusSegmentation failed: Missing parameter")
-            return None
-
-        if not segNode.GetSegmentation().GetSegment('Projected_Annulus') or not segNode.GetSegmentation().GetSegment(
-                'Mold_base'):
-            logging.debug("subtractAnnulusSegmentation failed: Missing segment")
-
         # Create segment editor to get access to effects
         segmentEditorWidget = slicer.qMRMLSegmentEditorWidget()
         segmentEditorWidget.setMRMLScene(slicer.mrmlScene)
@@ -1415,21 +3383,12 @@ class MVSegmenterLogic(ScriptedLoadableModuleLogic):
         segmentEditorWidget.setMRMLSegmentEditorNode(segmentEditorNode)
         segmentEditorWidget.setSegmentationNode(segNode)
         segmentEditorWidget.setMasterVolumeNode(volume)
-        segmentEditorWidget.setCurrentSegmentID('Mold_base')
-
-        # Subtraction
-        segmentEditorWidget.setActiveEffectByName("Logical operators")
-        effect = segmentEditorWidget.activeEffect()
-        effect.setParameter("Operation", "SUBTRACT")
-        effect.setParameter("Bypass masking", 1)
-        effect.setParameter("ModifierSegmentID", 'Projected_Annulus')
-        effect.self().onApply()
+        segmentEditorWidget.setCurrentSegmentID(segmentId)
 
-        # Smoothing
-        segmentEditorWidget.setActiveEffectByName("Smoothing")
+        segmentEditorWidget.setActiveEffectByName(effectName)
         effect = segmentEditorWidget.activeEffect()
-        effect.setParameter("SmoothingMethod", "GAUSSIAN")
-        effect.setParameter("GaussianStandardDeviationMm", 0.8)
+        for name, value in parameters.items():
+            effect.setParameter(name, value)
         effect.self().onApply()
 
         # Clean up
@@ -1442,100 +3401,311 @@ class MVSegmenterLogic(ScriptedLoadableModuleLogic):
         :param segNode: Segmentation node containing mold
         :return: None
         """
-
-        # Get segmentation closed surface representations
-        segMold = segNode.GetClosedSurfaceInternalRepresentation('Mold_base')
-        annulusMold = segNode.GetClosedSurfaceInternalRepresentation('Projected_Annulus')
-        stiffener = segNode.GetClosedSurfaceInternalRepresentation('Stiffener_Surface')
-        # if not segMold or not annulusMold or not stiffener:
-        #     logging.debug("exportSurfaceMold failed: Missing mold segmentation")
-        #     return
+        parts = self.buildMoldExportParts(segNode, papillaryMarkupsNode)
+        if not parts:
+            return
 
         # Set default polydata extension to stl
         defaultModelStorageNode = slicer.vtkMRMLModelStorageNode()
         defaultModelStorageNode.SetDefaultWriteFileExtension('stl')
         slicer.mrmlScene.AddDefaultNode(defaultModelStorageNode)
 
+        # Export closed surface meshes to model nodes
+        for name, model, color in parts:
+            self.addOrUpdateModel(model, name, segNode.GetTransformNodeID(), color)
+
+    def writeMoldParts(self, segNode, papillaryMarkupsNode, directory, fileFormat='stl'):
+        """
+        Writes the mold parts as binary STL or PLY files to a directory along with a manifest.json listing the file,
+        triangle count and bounding box of each part. The parts are written in parallel and no model nodes are
+        created, so this can be used for headless batch export. The transform of the segmentation is hardened, so
+        coordinates are in world RAS.
+        :param segNode: Segmentation node containing mold
+        :param papillaryMarkupsNode: Optional markups node containing papillary muscle tips
+        :param directory: Output directory, created if it does not exist
+        :param fileFormat: 'stl' or 'ply'
+        :return: Manifest dictionary, None on failure
+        """
+        if fileFormat not in ('stl', 'ply'):
+            logging.debug("writeMoldParts failed: Unsupported file format - " + str(fileFormat))
+            return None
+
+        parts = self.buildMoldExportParts(segNode, papillaryMarkupsNode)
+        if not parts:
+            return None
+
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+
+        def writePart(name, model):
+            triangles = vtk.vtkTriangleFilter()
+            triangles.SetInputData(model)
+            surface = self.getPipelineOutput(triangles)
+
+            writer = vtk.vtkSTLWriter() if fileFormat == 'stl' else vtk.vtkPLYWriter()
+            writer.SetFileTypeToBinary()
+            writer.SetFileName(str(directory / (name + '.' + fileFormat)))
+            writer.SetInputData(surface)
+            writer.Write()
+
+            return {'name': name, 'file': name + '.' + fileFormat, 'triangles': surface.GetNumberOfCells(),
+                    'bounds': list(surface.GetBounds())}
+
+        # Skip empty parts, e.g. the papillary model without tips
+        parts = [(name, model) for name, model, color in parts if model.GetNumberOfCells() > 0]
+
+        # Parts are in the coordinates of the segmentation, e.g. probe coordinates under a ProbeToRAS transform
+        if segNode.GetParentTransformNode():
+            toWorld = vtk.vtkGeneralTransform()
+            slicer.vtkMRMLTransformNode.GetTransformBetweenNodes(segNode.GetParentTransformNode(), None, toWorld)
+
+            hardenedParts = []
+            for name, model in parts:
+                transformFilter = vtk.vtkTransformPolyDataFilter()
+                transformFilter.SetTransform(toWorld)
+                transformFilter.SetInputData(model)
+                hardenedParts.append((name, self.getPipelineOutput(transformFilter)))
+            parts = hardenedParts
+
+        entries = self.runInParallel(*[lambda part=part: writePart(*part) for part in parts])
+
+        manifest = {'segmentation': segNode.GetName(), 'format': fileFormat, 'coordinateSystem': 'RAS',
+                    'parts': entries}
+        with open(directory / 'manifest.json', 'w') as f:
+            json.dump(manifest, f, indent=2)
+
+        logging.info('Wrote {0} mold parts to {1}'.format(len(entries), directory))
+
+        return manifest
+
+    def buildMoldExportParts(self, segNode, papillaryMarkupsNode=None):
+        """
+        Builds the print ready mold parts from the Segmentation node.
+        :param segNode: Segmentation node containing mold
+        :param papillaryMarkupsNode: Optional markups node containing papillary muscle tips
+        :return: List of (name, vtkPolyData model, color) tuples, None on failure
+        """
+        # Get segmentation closed surface representations, the mesh subtracted mold while the segment is unchanged
+        segMold = segNode.GetClosedSurfaceInternalRepresentation('Mold_base')
+        subtractedMold = self.getSession(segNode).subtractedMold
+        if subtractedMold and subtractedMold[0] == self.getSourceRepresentationMTime(segNode, 'Mold_base'):
+            segMold = subtractedMold[1]
+        annulusMold = segNode.GetClosedSurfaceInternalRepresentation('Projected_Annulus')
+        stiffener = segNode.GetClosedSurfaceInternalRepresentation('Stiffener_Surface')
+        if not segMold:
+            logging.debug("buildMoldExportParts failed: Missing mold segmentation")
+            return None
+
         # Fill holes (remove boudnary edges) and clean
         holeFill = vtk.vtkFillHolesFilter()
         holeFill.SetInputData(segMold)
         holeFill.SetHoleSize(holeFill.GetHoleSizeMaxValue())
-        holeFill.Update()
 
         clean = vtk.vtkCleanPolyData()
         clean.SetInputConnection(holeFill.GetOutputPort())
-        clean.Update()
 
         # Remove disconnected fragments
         conn = vtk.vtkConnectivityFilter()
         conn.SetInputConnection(clean.GetOutputPort())
         conn.SetExtractionModeToLargestRegion()
-        conn.Update()
 
         normAuto = vtk.vtkPolyDataNormals()
         normAuto.ConsistencyOff()
         normAuto.SetInputConnection(conn.GetOutputPort())
-        normAuto.Update()
 
-        # Decimate to 80%
-        decimate = vtk.vtkDecimatePro()
-        decimate.SetTargetReduction(0.8)
-        decimate.SetInputConnection(normAuto.GetOutputPort())
-        decimate.Update()
+        self.releaseIntermediateData(holeFill, clean, conn)
 
-        holeFill = vtk.vtkFillHolesFilter()
-        holeFill.SetInputConnection(decimate.GetOutputPort())
-        holeFill.SetHoleSize(holeFill.GetHoleSizeMaxValue())
-        holeFill.Update()
+        # Decimate to the mold budget, 80% by default
+        decimated = self.decimateSurface(self.getPipelineOutput(normAuto), 'mold', 0.8)
 
-        normAuto = vtk.vtkPolyDataNormals()
-        normAuto.ConsistencyOn()
-        normAuto.AutoOrientNormalsOn()
-        normAuto.SetInputConnection(holeFill.GetOutputPort())
-        normAuto.Update()
+        holeFill2 = vtk.vtkFillHolesFilter()
+        holeFill2.SetInputData(decimated)
+        holeFill2.SetHoleSize(holeFill2.GetHoleSizeMaxValue())
 
-        # Export closed surface meshes to model nodes
-        moldModel = vtk.vtkPolyData()
-        moldModel.DeepCopy(normAuto.GetOutput())
+        normAuto2 = vtk.vtkPolyDataNormals()
+        normAuto2.ConsistencyOn()
+        normAuto2.AutoOrientNormalsOn()
+        normAuto2.SetInputConnection(holeFill2.GetOutputPort())
+
+        self.releaseIntermediateData(holeFill2)
 
-        self.addOrUpdateModel(moldModel, 'Mold_base_Model', segNode.GetTransformNodeID(),
-                              segNode.GetSegmentation().GetSegment('Mold_base').GetColor())
+        segmentation = segNode.GetSegmentation()
+        parts = [('Mold_base_Model', self.getPipelineOutput(normAuto2, 'buildMoldExportParts mold'),
+                  segmentation.GetSegment('Mold_base').GetColor())]
 
         if annulusMold:
             annulusModel = vtk.vtkPolyData()
             annulusModel.DeepCopy(annulusMold)
-            self.addOrUpdateModel(annulusModel, 'Projected_Annulus_Model', segNode.GetTransformNodeID(),
-                                  segNode.GetSegmentation().GetSegment('Projected_Annulus').GetColor())
+            parts.append(('Projected_Annulus_Model', annulusModel,
+                          segmentation.GetSegment('Projected_Annulus').GetColor()))
 
         if stiffener:
-            # Decimate stiffener ring to 98%
-            decimate = vtk.vtkDecimatePro()
-            decimate.SetTargetReduction(0.98)
-            decimate.SetInputData(stiffener)
-            decimate.Update()
+            # Decimate stiffener ring to the stiffener budget, 98% by default
+            stiffenerModel = self.decimateSurface(stiffener, 'stiffener', 0.98)
+            parts.append(('Stiffener_Model', stiffenerModel, segmentation.GetSegment('Stiffener_Surface').GetColor()))
+
+        papillaryModel = self.generateLandmarkModel(papillaryMarkupsNode)
+        parts.append(('Papillary_Model', papillaryModel, None))
+
+        return parts
+
+    def generateLandmarkModel(self, markupsNode, radius=None, resolution=None):
+        """
+        Generates spheres at the defined control points of a markups node, e.g. papillary tips or chordae attachment
+        points, in a single glyph pass.
+        :param markupsNode: Markups node containing the landmarks, may be None
+        :param radius: Sphere radius in mm, defaults to papillaryTipRadius
+        :param resolution: Sphere theta and phi resolution, defaults to papillaryTipResolution
+        :return: vtkPolyData model of the spheres, empty if there are no defined control points
+        """
+        if not markupsNode or markupsNode.GetNumberOfDefinedControlPoints() == 0:
+            return vtk.vtkPolyData()
 
-            stiffenerModel = vtk.vtkPolyData()
-            stiffenerModel.DeepCopy(decimate.GetOutput())
-            self.addOrUpdateModel(stiffenerModel, 'Stiffener_Model', segNode.GetTransformNodeID(),
-                                  segNode.GetSegmentation().GetSegment('Stiffener_Surface').GetColor())
+        positions = slicer.util.arrayFromMarkupsControlPoints(markupsNode)
+        if len(positions) != markupsNode.GetNumberOfDefinedControlPoints():
+            defined = [markupsNode.GetNthControlPointPositionStatus(i) == markupsNode.PositionDefined
+                       for i in range(len(positions))]
+            positions = positions[np.asarray(defined, dtype=bool)]
+
+        points = vtk.vtkPoints()
+        points.SetData(numpy_support.numpy_to_vtk(np.ascontiguousarray(positions, dtype=np.float64), deep=True))
+        landmarks = vtk.vtkPolyData()
+        landmarks.SetPoints(points)
 
-        papillaryModel = vtk.vtkPolyData()
-        papAppend = vtk.vtkAppendPolyData()
+        glyph = vtk.vtkGlyph3D()
+        glyph.ScalingOff()
+        glyph.OrientOff()
+        glyph.SetSourceData(self.getGlyphTemplate(radius or self.papillaryTipRadius,
+                                                  resolution or self.papillaryTipResolution))
+        glyph.SetInputData(landmarks)
 
-        for i in range(papillaryMarkupsNode.GetNumberOfDefinedControlPoints()):
-            p = np.array([0, 0, 0])
-            papillaryMarkupsNode.GetNthControlPointPosition(i, p)
+        return self.getPipelineOutput(glyph, 'generateLandmarkModel')
 
+    def getGlyphTemplate(self, radius, resolution):
+        """
+        Retrieves the cached sphere glyph template for a radius and resolution, creating it on first use
+        :param radius: Sphere radius in mm
+        :param resolution: Sphere theta and phi resolution
+        :return: vtkPolyData sphere centered at the origin
+        """
+        key = (float(radius), int(resolution))
+        if key not in self._glyphTemplates:
             sphereSource = vtk.vtkSphereSource()
-            sphereSource.SetCenter(p)
-            sphereSource.SetRadius(2)
-            sphereSource.Update()
+            sphereSource.SetRadius(radius)
+            sphereSource.SetThetaResolution(int(resolution))
+            sphereSource.SetPhiResolution(int(resolution))
+            self._glyphTemplates[key] = self.getPipelineOutput(sphereSource)
+
+        return self._glyphTemplates[key]
+
+    def decimateSurface(self, polyData, stage, defaultReduction, preserveTopology=False):
+        """
+        Decimates a surface model according to the budget of the stage in decimationBudgets. A target triangle count
+        uses quadric decimation, or pro decimation if the topology must be preserved, which may stop short of the
+        target. A maximum error uses pro decimation with an absolute error bound, halved up to decimationErrorAttempts
+        times until the Hausdorff distance to the input is within the budget. If it never is, the undecimated surface is
+        returned. Without a budget pro decimation with the default reduction is used. The achieved triangle count,
+        Hausdorff distance if measured and whether the budget was met are stored in decimationResults.
+        :param polyData: vtkPolyData surface model
+        :param stage: Key of the budget in decimationBudgets
+        :param defaultReduction: Target reduction used without a budget
+        :param preserveTopology: Preserve topology and boundary vertices
+        :return: vtkPolyData decimated model, with point normals if the input has them
+        """
+        budget = self.decimationBudgets.get(stage, {})
+        targetTriangles = budget.get('targetTriangles')
+        maxError = budget.get('maxError')
+
+        triangles = vtk.vtkTriangleFilter()
+        triangles.SetInputData(polyData)
+        surface = self.getPipelineOutput(triangles)
+        numberOfTriangles = surface.GetNumberOfCells()
+
+        def decimatePro(reduction, absoluteError=None):
+            decimate = vtk.vtkDecimatePro()
+            decimate.SetTargetReduction(reduction)
+            if preserveTopology:
+                decimate.PreserveTopologyOn()
+                decimate.BoundaryVertexDeletionOff()
+            if absoluteError is not None:
+                decimate.SetErrorIsAbsolute(1)
+                decimate.SetAbsoluteError(absoluteError)
+                decimate.AccumulateErrorOn()
+            decimate.SetInputData(surface)
+            return self.getPipelineOutput(decimate)
+
+        start = timer()
+        error = None
+        withinBudget = True
+        if targetTriangles:
+            if numberOfTriangles <= targetTriangles:
+                decimated = surface
+            elif preserveTopology:
+                decimated = decimatePro(1 - targetTriangles / numberOfTriangles)
+            else:
+                decimate = vtk.vtkQuadricDecimation()
+                decimate.SetTargetReduction(1 - targetTriangles / numberOfTriangles)
+                decimate.SetInputData(surface)
+                decimated = self.getPipelineOutput(decimate)
+
+                # Quadric decimation does not pass point normals, recompute them without splitting so points are kept
+                if surface.GetPointData().GetNormals() and not decimated.GetPointData().GetNormals():
+                    normals = vtk.vtkPolyDataNormals()
+                    normals.SplittingOff()
+                    normals.ComputeCellNormalsOff()
+                    normals.SetInputData(decimated)
+                    decimated = self.getPipelineOutput(normals)
+            withinBudget = decimated.GetNumberOfCells() <= targetTriangles
+        elif maxError:
+            # Pro decimation bounds the distance to local planes, the Hausdorff distance can be larger
+            decimated = decimatePro(0.99, maxError)
+            error = self.hausdorffDistance(surface, decimated)
+            absoluteError = maxError
+            for i in range(self.decimationErrorAttempts):
+                if error <= maxError:
+                    break
+                absoluteError *= 0.5
+                decimated = decimatePro(0.99, absoluteError)
+                error = self.hausdorffDistance(surface, decimated)
+
+            if error > maxError:
+                logging.warning('{0} decimation error {1:.3f} mm exceeds the budget of {2} mm, not decimated'.format(
+                    stage, error, maxError))
+                decimated = surface
+                error = 0.0
+                withinBudget = False
+        else:
+            decimated = decimatePro(defaultReduction)
+
+        elapsed = timer() - start
+        if error is None and self.measureDecimationError:
+            error = self.hausdorffDistance(surface, decimated)
+
+        self.decimationResults[stage] = {'triangles': decimated.GetNumberOfCells(), 'hausdorffDistance': error,
+                                         'withinBudget': withinBudget}
+        logging.info('{0} decimated from {1} to {2} triangles in {3:.3f}s{4}'.format(
+            stage, numberOfTriangles, decimated.GetNumberOfCells(), elapsed,
+            '' if error is None else ', Hausdorff distance {0:.3f} mm'.format(error)))
+
+        return decimated
 
-            papAppend.AddInputConnection(sphereSource.GetOutputPort())
-        papAppend.Update()
-        papillaryModel.DeepCopy(papAppend.GetOutput())
+    def hausdorffDistance(self, reference, surface):
+        """
+        Symmetric Hausdorff distance between two surface models, using point to cell distances
+        :param reference: vtkPolyData surface model
+        :param surface: vtkPolyData surface model
+        :return: Hausdorff distance in model units
+        """
+        if reference is surface:
+            return 0.0
 
-        self.addOrUpdateModel(papillaryModel, 'Papillary_Model', segNode.GetTransformNodeID())
+        hausdorff = vtk.vtkHausdorffDistancePointSetFilter()
+        hausdorff.SetTargetDistanceMethodToPointToCell()
+        hausdorff.SetInputData(0, reference)
+        hausdorff.SetInputData(1, surface)
+        hausdorff.Update()
+
+        return hausdorff.GetOutput().GetFieldData().GetArray('HausdorffDistance').GetValue(0)
 
     def extractInnerSurfaceModel(self, segNode, valveModel, segName='Leaflet Segmentation'):
         """
@@ -1563,84 +3733,33 @@ class MVSegmenterLogic(ScriptedLoadableModuleLogic):
             logging.debug("extractInnerSurfaceModel failed: Missing segmentation")
             return None
 
-        # Decimate leaflet polydata for efficiency
-        decimate = vtk.vtkDecimatePro()
-        decimate.SetTargetReduction(0.6)
-        decimate.PreserveTopologyOn()
-        decimate.BoundaryVertexDeletionOff()
-
-        decimate.SetInputData(leafletModel)
-        decimate.Update()
-        leafletModel = vtk.vtkPolyData()
-        leafletModel.DeepCopy(decimate.GetOutput())
+        # Decimate leaflet polydata for efficiency, 60% by default
+        leafletModel = self.decimateSurface(leafletModel, 'innerSurface', 0.6, preserveTopology=True)
 
+        # Scalars are only added to the copy, the point data of the decimated model is left unchanged
         clipped = vtk.vtkPolyData()
-        clipped.DeepCopy(leafletModel)
+        clipped.ShallowCopy(leafletModel)
 
         # Get Annulus minimum radius
         annulusPoints = valveModel.getAnnulusContourModelNode().GetPolyData().GetPoints()
-        minDis = float('inf')
-        for i in range(annulusPoints.GetNumberOfPoints()):
-            p = annulusPoints.GetPoint(i)
-            dis = np.linalg.norm(np.subtract(annulusPlane[0], p))
-            minDis = min(minDis, dis)
+        annulusPoints = numpy_support.vtk_to_numpy(annulusPoints.GetData())
+        minDis = np.linalg.norm(annulusPoints - annulusPlane[0], axis=1).min()
 
         # Create tube along annulus plane normal to use for bottom half extraction
         lineSource = vtk.vtkLineSource()
         lineSource.SetPoint1(annulusPlane[0] + annulusPlane[1] * 20)
         lineSource.SetPoint2(annulusPlane[0] - annulusPlane[1] * 20)
-        lineSource.Update()
 
         tubeFilter = vtk.vtkTubeFilter()
         tubeFilter.SetRadius(0.5 * minDis)
         tubeFilter.CappingOff()
         tubeFilter.SetNumberOfSides(50)
         tubeFilter.SetInputConnection(lineSource.GetOutputPort())
-        tubeFilter.Update()
-
-        # OBBTree for determining self intersection of rays
-        obb = vtk.vtkOBBTree()
-        obb.SetDataSet(leafletModel)
-        obb.BuildLocator()
-
-        locator = vtk.vtkPointLocator()
-        locator.SetDataSet(tubeFilter.GetOutput())
-        locator.BuildLocator()
-
-        # Loop over remaining points and build scalar array using different techniques for top and bottom half
-        a0 = np.zeros(3)
-        p = annulusPlane[0] + annulusPlane[1] * 2
-        points = vtk.vtkPoints()
-        normals = clipped.GetPointData().GetNormals()
-        tubeNormals = tubeFilter.GetOutput().GetPointData().GetNormals()
-        scalars = vtk.vtkFloatArray()
-        scalars.SetNumberOfValues(clipped.GetNumberOfPoints())
-        for i in range(clipped.GetNumberOfPoints()):
-            clipped.GetPoint(i, a0)
-            if np.dot(annulusPlane[1], a0 - p) > 0:
-                # Point is above annulus plane, set scalar based on self intersection (scalar value will determine clipping)
-                r = obb.IntersectWithLine(a0, annulusPlane[0] + annulusPlane[1] * 5, points, None)
-
-                # If not match try with point below annulus plane
-                if points.GetNumberOfPoints() != 1:
-                    r = obb.IntersectWithLine(a0, annulusPlane[0] - annulusPlane[1] * 5, points, None)
-
-                # If only 1 intersection point, line does not cross through leaflet model as the line always intersects at a0
-                if points.GetNumberOfPoints() == 1:
-                    scalars.SetValue(i, 10)  # Set scalar to large value so point will be kept
-                else:
-                    scalars.SetValue(i, -10)  # Set scalar to small value so point will be discarded
-            else:
-                # Point is below annulus plane
-                # Get the closest point on tube surface, find angle between 2 normals in radians
-                closestPoint = locator.FindClosestPoint(a0)
-                v = np.array(tubeNormals.GetTuple(closestPoint))
-                n = np.array(normals.GetTuple(i))
-                angle = math.acos(np.dot(n, v) / np.linalg.norm(n) / np.linalg.norm(v))
-                scalars.SetValue(i, angle)  # Set scalar to angle
+        tube = self.getPipelineOutput(tubeFilter, 'extractInnerSurfaceModel tube')
 
-        # Scalars now angles in radians that we can threshold
-        clipped.GetPointData().SetScalars(scalars)
+        # Scalars are angles in radians that we can threshold, or +-10 for points kept or discarded by visibility
+        scalars = self.computeInnerSurfaceScalars(leafletModel, annulusPlane, tube)
+        clipped.GetPointData().SetScalars(numpy_support.numpy_to_vtk(scalars, deep=True))
 
         # Clip based on scalar values (keep scalars bigger than value)
         clip2 = vtk.vtkClipPolyData()
@@ -1651,28 +3770,73 @@ class MVSegmenterLogic(ScriptedLoadableModuleLogic):
         conn = vtk.vtkConnectivityFilter()
         conn.SetInputConnection(clip2.GetOutputPort())
         conn.SetExtractionModeToLargestRegion()
-        conn.Update()
 
         # Fill small holes resulting from extraction and clean poly data
         fill = vtk.vtkFillHolesFilter()
         fill.SetHoleSize(3)
         fill.SetInputConnection(conn.GetOutputPort())
-        fill.Update()
 
         clean = vtk.vtkCleanPolyData()
         clean.SetInputConnection(fill.GetOutputPort())
-        clean.Update()
 
         # Fix normals
         normClean = vtk.vtkPolyDataNormals()
         normClean.ConsistencyOn()
         normClean.FlipNormalsOn()
         normClean.SetInputConnection(clean.GetOutputPort())
-        normClean.Update()
 
-        innerModel = vtk.vtkPolyData()
-        innerModel.DeepCopy(normClean.GetOutput())
-        return innerModel
+        self.releaseIntermediateData(clip2, conn, fill, clean)
+
+        return self.getPipelineOutput(normClean, 'extractInnerSurfaceModel')
+
+    def computeInnerSurfaceScalars(self, polyData, annulusPlane, tube):
+        """
+        Classifies the points of a leaflet surface for the inner surface extraction, using different techniques for
+        points above and below the annulus plane. Points more than 2 mm above the plane are kept (scalar 10) when
+        visible from 5 mm above or below the annulus center, else discarded (scalar -10). Points below get the angle
+        between their normal and the normal of the closest tube point.
+        :param polyData: vtkPolyData leaflet surface with point normals
+        :param annulusPlane: (center, normal) of the annulus plane
+        :param tube: vtkPolyData tube along the annulus plane normal, with point normals
+        :return: float32 array of point scalars, points with scalars below 1.5 are discarded
+        """
+        points = numpy_support.vtk_to_numpy(polyData.GetPoints().GetData()).astype(np.float64)
+        normals = numpy_support.vtk_to_numpy(polyData.GetPointData().GetNormals()).astype(np.float64)
+        scalars = np.zeros(len(points), dtype=np.float32)
+
+        # Points above annulus plane, set scalar based on self intersection (scalar value will determine clipping)
+        p = annulusPlane[0] + annulusPlane[1] * 2
+        above = np.flatnonzero(np.dot(points - p, annulusPlane[1]) > 0)
+
+        visible = self.getVisibleSurfacePoints(polyData, above, annulusPlane[0] + annulusPlane[1] * 5)
+
+        # If not visible try with point below annulus plane
+        retry = np.flatnonzero(~visible)
+        visible[retry] = self.getVisibleSurfacePoints(polyData, above[retry], annulusPlane[0] - annulusPlane[1] * 5)
+
+        # Set scalar to large value so point will be kept, or small value so point will be discarded
+        scalars[above] = np.where(visible, 10, -10)
+
+        # Points below annulus plane
+        # Get the closest point on tube surface, find angle between 2 normals in radians
+        below = np.ones(len(points), dtype=bool)
+        below[above] = False
+        below = np.flatnonzero(below)
+        tubePoints = numpy_support.vtk_to_numpy(tube.GetPoints().GetData()).astype(np.float64)
+        tubeNormals = numpy_support.vtk_to_numpy(tube.GetPointData().GetNormals()).astype(np.float64)
+        closestPoints = np.empty(len(below), dtype=np.int64)
+        chunkSize = max(1, (1 << 20) // len(tubePoints))
+        for first in range(0, len(below), chunkSize):
+            chunk = points[below[first:first + chunkSize]]
+            distances = ((chunk[:, np.newaxis, :] - tubePoints[np.newaxis, :, :]) ** 2).sum(axis=2)
+            closestPoints[first:first + chunkSize] = np.argmin(distances, axis=1)  # Ties go to the lowest point id
+
+        v = tubeNormals[closestPoints]
+        n = normals[below]
+        cosines = np.einsum('ij,ij->i', n, v) / np.linalg.norm(n, axis=1) / np.linalg.norm(v, axis=1)
+        scalars[below] = np.arccos(np.clip(cosines, -1, 1))  # Set scalar to angle
+
+        return scalars
 
     def generateProjectedAnnulus(self, extractedLeaflet, valveModel, offset=0):
         """
@@ -1690,75 +3854,151 @@ class MVSegmenterLogic(ScriptedLoadableModuleLogic):
             return None
 
         # Project defined annulus onto inner surface
-
-        # Use OBBTree to find intersection with model
-        obb = vtk.vtkOBBTree()
-        obb.SetDataSet(extractedLeaflet)
-        obb.BuildLocator()
-
-        annulusMarkups = valveModel.getAnnulusContourMarkupNode()
+        annulusPoints = slicer.util.arrayFromMarkupsControlPoints(valveModel.getAnnulusContourMarkupNode())
+        annulusPoints = np.asarray(annulusPoints, dtype=np.float64)
         contourPlane = valveModel.getAnnulusContourPlane()
-        pos = np.zeros(3)
-        points = vtk.vtkPoints()
-        normals = vtk.vtkFloatArray()
-        normals.SetNumberOfComponents(3)
-        projPoints = vtk.vtkPoints()
 
-        # Project annulus inwards towards center
+        # Project annulus inwards towards center, all rays are intersected with the model in one call
         center = contourPlane[0] + offset * 5 * contourPlane[1]
-        for i in range(annulusMarkups.GetNumberOfFiducials()):
-            annulusMarkups.GetNthFiducialPosition(i, pos)
-            # Get point above annulus to project towards
-            stiffenerPos = pos + contourPlane[1] * 12
-            r = obb.IntersectWithLine(pos + pos - center, center, points, None)
-            if r != 0:
-                projPoints.InsertNextPoint(points.GetPoint(0))
-                normals.InsertNextTuple3(*((stiffenerPos - center) / np.linalg.norm(stiffenerPos - center)))
-
-        projPoints.InsertNextPoint(projPoints.GetPoint(0))
-        normals.InsertNextTuple3(*normals.GetTuple3(0))
+        rayStarts = annulusPoints + annulusPoints - center
+        hitCounts, firstHits = self.intersectSegmentsWithSurface(extractedLeaflet, rayStarts, center)
+        hit = hitCounts > 0
+        if not hit.any():
+            logging.debug("generateProjectedAnnulus failed: Annulus does not project onto the model")
+            return None
+
+        projPoints = rayStarts[hit] + firstHits[hit, np.newaxis] * (center - rayStarts[hit])
+
+        # Get point above annulus to project towards
+        stiffenerPos = annulusPoints[hit] + contourPlane[1] * 12
+        normals = stiffenerPos - center
+        normals /= np.linalg.norm(normals, axis=1)[:, np.newaxis]
+
+        # Repeat the first point to close the contour
+        projPoints = np.vstack((projPoints, projPoints[:1]))
+        normals = np.vstack((normals, normals[:1]))
+
+        # Create spline polydata
+        points = vtk.vtkPoints()
+        points.SetData(numpy_support.numpy_to_vtk(projPoints, deep=True))
+        normalsArray = numpy_support.numpy_to_vtk(normals.astype(np.float32), deep=True)
 
         lines = vtk.vtkCellArray()
-        lines.InsertNextCell(projPoints.GetNumberOfPoints())
-        for i in range(projPoints.GetNumberOfPoints()):
+        lines.InsertNextCell(len(projPoints))
+        for i in range(len(projPoints)):
             lines.InsertCellPoint(i)
 
-        # Create spline polydata
         projContour = vtk.vtkPolyData()
-        projContour.SetPoints(projPoints)
+        projContour.SetPoints(points)
         projContour.SetLines(lines)
-        projContour.GetPointData().SetNormals(normals)
+        projContour.GetPointData().SetNormals(normalsArray)
 
+        # Number of subdivisions follows from the arc length and the target spacing
         splineFilter = vtk.vtkSplineFilter()
-        splineFilter.SetNumberOfSubdivisions(500)
+        splineFilter.SetSubdivideToLength()
+        splineFilter.SetLength(self.annulusSplineSpacing)
         splineFilter.GetSpline().ClosedOn()
         splineFilter.SetInputData(projContour)
-        splineFilter.Update()
 
         # Close spline
         strip = vtk.vtkStripper()
         strip.SetInputConnection(splineFilter.GetOutputPort())
-        strip.Update()
+
+        self.releaseIntermediateData(splineFilter)
+        spline = self.getPipelineOutput(strip, 'generateProjectedAnnulus spline')
+
+        # The stiffener is clipped to the reference volume when converted to a labelmap, it only needs to reach its
+        # boundary along the extrusion direction of every spline point
+        extrusionLength = 100
+        volume = valveModel.getValveVolumeNode()
+        if volume:
+            bounds = [0.0] * 6
+            volume.GetBounds(bounds)
+            extrusionLength = self.getExtrusionLength(
+                numpy_support.vtk_to_numpy(spline.GetPoints().GetData()),
+                numpy_support.vtk_to_numpy(spline.GetPointData().GetNormals()), bounds)
+
+        # Push fitted annulus onto segmentation node
+        annulusFittedModel, stiffener = self.runInParallel(lambda: self.buildAnnulusTube(spline),
+                                                           lambda: self.buildStiffener(spline, extrusionLength))
+
+        return annulusFittedModel, stiffener
+
+    def getExtrusionLength(self, points, directions, bounds, margin=1.0):
+        """
+        Computes the scale factor by which points must be extruded along their directions so that all of them leave a
+        bounding box
+        :param points: (N, 3) array of points
+        :param directions: (N, 3) array of extrusion directions, scaled as in vtkLinearExtrusionFilter
+        :param bounds: Bounding box [xmin, xmax, ymin, ymax, zmin, zmax]
+        :param margin: Distance in mm added beyond the box, along unit directions
+        :return: Scale factor, 0 if no point moves
+        """
+        points = np.asarray(points, dtype=np.float64)
+        directions = np.asarray(directions, dtype=np.float64)
+        bounds = np.asarray(bounds, dtype=np.float64)
+
+        # Along each axis the box is left at the bound the direction points to, the box at the first of the three
+        with np.errstate(divide='ignore', invalid='ignore'):
+            exits = np.where(directions > 0, (bounds[1::2] - points) / directions,
+                             np.where(directions < 0, (bounds[::2] - points) / directions, np.inf))
+        exits = np.clip(exits.min(axis=1), 0, None)
+
+        lengths = np.linalg.norm(directions, axis=1)
+        moving = np.isfinite(exits) & (lengths > 0)
+        if not moving.any():
+            return 0.0
+
+        return float((exits[moving] + margin / lengths[moving]).max())
+
+    def buildAnnulusTube(self, spline):
+        """
+        Creates the tube around the spline fitted projected annulus
+        :param spline: vtkPolyData closed spline of the projected annulus, with normals
+        :return: vtkPolyData model of the tube
+        """
+        # Each branch gets its own copy of the shared spline so they can run concurrently
+        splineCopy = vtk.vtkPolyData()
+        splineCopy.ShallowCopy(spline)
 
         # Create tube from spline fitted projected annulus
         tubeFilter = vtk.vtkTubeFilter()
         tubeFilter.SetRadius(1)  # Radius of 1 determined through trial and error on printed models
         tubeFilter.SetNumberOfSides(20)
         tubeFilter.CappingOff()
-        tubeFilter.SetInputConnection(strip.GetOutputPort())
-        tubeFilter.Update()
+        tubeFilter.SetInputData(splineCopy)
+        tube = self.getPipelineOutput(tubeFilter)
+
+        # The spline is closed by repeating its first point, but the tube filter orients the last ring slightly
+        # differently. Snap the last ring onto the first so cleaning merges them and the tube is closed.
+        splinePoints = numpy_support.vtk_to_numpy(splineCopy.GetPoints().GetData())
+        tubePoints = numpy_support.vtk_to_numpy(tube.GetPoints().GetData())
+        sides = tubeFilter.GetNumberOfSides()
+        if len(splinePoints) > 1 and np.allclose(splinePoints[0], splinePoints[-1]) and len(tubePoints) > sides:
+            tubePoints[-sides:] = tubePoints[:sides]
+            tube.GetPoints().Modified()
 
         cleanTube = vtk.vtkCleanPolyData()
-        cleanTube.SetInputConnection(tubeFilter.GetOutputPort())
-        cleanTube.Update()
+        cleanTube.SetInputData(tube)
+
+        return self.getPipelineOutput(cleanTube, 'buildAnnulusTube')
+
+    def buildStiffener(self, spline, extrusionLength=100):
+        """
+        Creates the stiffener surface by extruding the spline fitted projected annulus outwards from the mold
+        :param spline: vtkPolyData closed spline of the projected annulus, with normals
+        :param extrusionLength: Distance in mm the stiffener extends from the spline, see getExtrusionLength
+        :return: vtkPolyData model of the stiffener
+        """
+        splineCopy = vtk.vtkPolyData()
+        splineCopy.ShallowCopy(spline)
 
         # Generate stiffener surface from mold outwards
         ext = vtk.vtkLinearExtrusionFilter()
         ext.SetExtrusionTypeToNormalExtrusion()
-        ext.SetInputConnection(strip.GetOutputPort())
-        ext.SetScaleFactor(100)
+        ext.SetInputData(splineCopy)
+        ext.SetScaleFactor(extrusionLength)
         ext.CappingOn()
-        ext.Update()
 
         # Clean up stiffener surface
         norm = vtk.vtkPolyDataNormals()
@@ -1766,34 +4006,39 @@ class MVSegmenterLogic(ScriptedLoadableModuleLogic):
         norm.FlipNormalsOn()
         norm.SplittingOn()
         norm.SetInputConnection(ext.GetOutputPort())
-        norm.Update()
 
         ext2 = vtk.vtkLinearExtrusionFilter()
         ext2.SetExtrusionTypeToNormalExtrusion()
         ext2.SetInputConnection(norm.GetOutputPort())
         ext2.SetScaleFactor(1.75)
         ext2.CappingOn()
-        ext2.Update()
 
-        norm = vtk.vtkPolyDataNormals()
-        norm.ConsistencyOn()
-        norm.SplittingOn()
-        norm.AutoOrientNormalsOn()
-        norm.SetInputConnection(ext2.GetOutputPort())
-        norm.Update()
+        norm2 = vtk.vtkPolyDataNormals()
+        norm2.ConsistencyOn()
+        norm2.SplittingOn()
+        norm2.AutoOrientNormalsOn()
+        norm2.SetInputConnection(ext2.GetOutputPort())
 
         cleanStiffener = vtk.vtkCleanPolyData()
-        cleanStiffener.SetInputConnection(norm.GetOutputPort())
-        cleanStiffener.Update()
+        cleanStiffener.SetInputConnection(norm2.GetOutputPort())
 
-        # Push fitted annulus onto segmentation node
-        annulusFittedModel = vtk.vtkPolyData()
-        annulusFittedModel.DeepCopy(cleanTube.GetOutput())
+        self.releaseIntermediateData(ext, norm, ext2, norm2)
 
-        stiffener = vtk.vtkPolyData()
-        stiffener.DeepCopy(cleanStiffener.GetOutput())
+        return self.getPipelineOutput(cleanStiffener, 'buildStiffener')
 
-        return annulusFittedModel, stiffener
+    def runInParallel(self, *functions):
+        """
+        Runs independent pipeline branches on a thread pool, VTK filters release the GIL while executing. Runs them
+        sequentially if parallelMoldBuild is off. The branches must not share filters or modify shared inputs.
+        :param functions: Callables without arguments
+        :return: List of the return values in the order of the callables
+        """
+        if not self.parallelMoldBuild or len(functions) < 2:
+            return [function() for function in functions]
+
+        with self.threadStage('mold', len(functions)), ThreadPoolExecutor(max_workers=len(functions)) as executor:
+            futures = [executor.submit(function) for function in functions]
+            return [future.result() for future in futures]
 
     def buildMoldHalves(self, extractedSurface, midClippingPlane, baseClippingPlane):
         """
@@ -1803,35 +4048,60 @@ class MVSegmenterLogic(ScriptedLoadableModuleLogic):
         :param baseClippingPlane: vtkPlane definition of bottom clipping plane
         :return: vtkPolyData models (topHalf, bottomHalf)
         """
+        topSurface, bottomSurface, midFill = self.splitMoldSurface(extractedSurface, midClippingPlane)
+
+        topMold, bottomMold = self.runInParallel(
+            lambda: self.buildTopMoldHalf(topSurface, midClippingPlane),
+            lambda: self.clipBottomMoldHalf(self.buildBottomMoldExtrusion(bottomSurface, midFill, midClippingPlane),
+                                            baseClippingPlane))
+
+        return topMold, bottomMold
 
+    def splitMoldSurface(self, extractedSurface, midClippingPlane):
+        """
+        Splits the extracted inner surface at the middle plane and fills the cross section.
+        :param extractedSurface: Extarcted inner surface vtkPolyData model
+        :param midClippingPlane: vtkPlane definition of middle surface plane
+        :return: vtkPolyData models (topSurface, bottomSurface, midFill)
+        """
         # Split top and bottom halves of surface
         clipMid = vtk.vtkClipPolyData()
         clipMid.SetClipFunction(midClippingPlane)
         clipMid.SetInputData(extractedSurface)
         clipMid.GenerateClippedOutputOn()
-        clipMid.Update()
 
         # Fill across mid clip plane
         cutter = vtk.vtkCutter()
         cutter.SetCutFunction(midClippingPlane)
         cutter.SetInputData(extractedSurface)
-        cutter.Update()
 
         loop = vtk.vtkContourLoopExtraction()
         loop.SetNormal(midClippingPlane.GetNormal())
         loop.SetLoopClosureToAll()
         loop.SetInputConnection(cutter.GetOutputPort())
-        loop.Update()
 
         tri = vtk.vtkTriangleFilter()
         tri.SetInputConnection(loop.GetOutputPort())
-        tri.Update()
 
+        self.releaseIntermediateData(cutter, loop)
+
+        topSurface = self.getPipelineOutput(clipMid, 'splitMoldSurface')
+        bottomSurface = self.getPipelineOutput(clipMid, port=1)
+        midFill = self.getPipelineOutput(tri, 'splitMoldSurface fill')
+
+        return topSurface, bottomSurface, midFill
+
+    def buildTopMoldHalf(self, topSurface, midClippingPlane):
+        """
+        Constructs the top half of mold by extruding inwards towards annulus center.
+        :param topSurface: Top half of the extracted inner surface
+        :param midClippingPlane: vtkPlane definition of middle surface plane
+        :return: vtkPolyData model of top half
+        """
         # Extrusion towards annulus centroid to thicken leaflet walls inwards
 
         clean = vtk.vtkCleanPolyData()
-        clean.SetInputConnection(clipMid.GetOutputPort())
-        clean.Update()
+        clean.SetInputData(topSurface)
 
         extrudeIn = vtk.vtkLinearExtrusionFilter()
         extrudeIn.CappingOn()
@@ -1839,38 +4109,42 @@ class MVSegmenterLogic(ScriptedLoadableModuleLogic):
         extrudeIn.SetScaleFactor(-0.6)
         extrudeIn.SetExtrusionPoint(midClippingPlane.GetOrigin())
         extrudeIn.SetInputConnection(clean.GetOutputPort())
-        extrudeIn.Update()
 
         normAuto = vtk.vtkPolyDataNormals()
         normAuto.ConsistencyOn()
         normAuto.AutoOrientNormalsOn()
         normAuto.SetInputConnection(extrudeIn.GetOutputPort())
-        normAuto.Update()
 
         # Need clean then fill to close extruded model
-        clean = vtk.vtkCleanPolyData()
-        clean.SetInputConnection(normAuto.GetOutputPort())
-        clean.Update()
+        clean2 = vtk.vtkCleanPolyData()
+        clean2.SetInputConnection(normAuto.GetOutputPort())
 
         # Make normals point outwards for final model
-        normAuto = vtk.vtkPolyDataNormals()
-        normAuto.ConsistencyOn()
-        normAuto.AutoOrientNormalsOn()
-        normAuto.SetInputConnection(clean.GetOutputPort())
-        normAuto.Update()
+        normAuto2 = vtk.vtkPolyDataNormals()
+        normAuto2.ConsistencyOn()
+        normAuto2.AutoOrientNormalsOn()
+        normAuto2.SetInputConnection(clean2.GetOutputPort())
+
+        self.releaseIntermediateData(clean, extrudeIn, normAuto, clean2)
 
-        topMold = vtk.vtkPolyData()
-        topMold.DeepCopy(normAuto.GetOutput())
+        return self.getPipelineOutput(normAuto2, 'buildTopMoldHalf')
 
+    def buildBottomMoldExtrusion(self, bottomSurface, midFill, midClippingPlane):
+        """
+        Extrudes the bottom half of the mold downwards. The result does not depend on the base depth and can be reused
+        when only the base clipping plane changes.
+        :param bottomSurface: Bottom half of the extracted inner surface
+        :param midFill: Fill of the cross section at the middle plane
+        :param midClippingPlane: vtkPlane definition of middle surface plane
+        :return: vtkPolyData model of the unclipped bottom half
+        """
         # Add fill back on to clipped bottom mold and clean
         append = vtk.vtkAppendPolyData()
-        append.AddInputConnection(clipMid.GetClippedOutputPort())
-        append.AddInputConnection(tri.GetOutputPort())
-        append.Update()
+        append.AddInputData(bottomSurface)
+        append.AddInputData(midFill)
 
         clean = vtk.vtkCleanPolyData()
         clean.SetInputConnection(append.GetOutputPort())
-        clean.Update()
 
         # Extrude bottom part of mold down with filled clip plane
         extrudeDown = vtk.vtkLinearExtrusionFilter()
@@ -1879,69 +4153,99 @@ class MVSegmenterLogic(ScriptedLoadableModuleLogic):
         extrudeDown.SetScaleFactor(40)
         extrudeDown.SetInputConnection(clean.GetOutputPort())
         extrudeDown.CappingOff()
-        extrudeDown.Update()
 
         normAuto = vtk.vtkPolyDataNormals()
         normAuto.ConsistencyOn()
         normAuto.AutoOrientNormalsOn()
         normAuto.SetInputConnection(extrudeDown.GetOutputPort())
-        normAuto.Update()
 
-        append = vtk.vtkAppendPolyData()
-        append.AddInputConnection(normAuto.GetOutputPort())
-        append.AddInputConnection(clean.GetOutputPort())
-        append.Update()
+        append2 = vtk.vtkAppendPolyData()
+        append2.AddInputConnection(normAuto.GetOutputPort())
+        append2.AddInputConnection(clean.GetOutputPort())
 
-        clean = vtk.vtkCleanPolyData()
-        clean.SetInputConnection(append.GetOutputPort())
-        clean.Update()
+        clean2 = vtk.vtkCleanPolyData()
+        clean2.SetInputConnection(append2.GetOutputPort())
+
+        # The cleaned surface is shared by the extrusion and the final append so its output is kept
+        self.releaseIntermediateData(append, extrudeDown, normAuto, append2)
+
+        return self.getPipelineOutput(clean2, 'buildBottomMoldExtrusion')
 
+    def clipBottomMoldHalf(self, bottomExtrusion, baseClippingPlane):
+        """
+        Clips the extruded bottom half of the mold at the base and caps the clipped surface.
+        :param bottomExtrusion: Unclipped bottom half from buildBottomMoldExtrusion
+        :param baseClippingPlane: vtkPlane definition of bottom clipping plane
+        :return: vtkPolyData model of bottom half
+        """
         # Perform the bottom clipping at the specified depth
         clipBase = vtk.vtkClipPolyData()
         clipBase.SetClipFunction(baseClippingPlane)
-        clipBase.SetInputConnection(clean.GetOutputPort())
-        clipBase.Update()
+        clipBase.SetInputData(bottomExtrusion)
 
         # Fill bottom clip plane
         cutter = vtk.vtkCutter()
         cutter.SetCutFunction(baseClippingPlane)
-        cutter.SetInputConnection(clean.GetOutputPort())
-        cutter.Update()
+        cutter.SetInputData(bottomExtrusion)
 
         loop = vtk.vtkContourLoopExtraction()
         loop.SetNormal(baseClippingPlane.GetNormal())
         loop.SetLoopClosureToAll()
         loop.SetInputConnection(cutter.GetOutputPort())
-        loop.Update()
 
         tri = vtk.vtkTriangleFilter()
         tri.SetInputConnection(loop.GetOutputPort())
-        tri.Update()
 
         # Flip bottom surface so normal points out
         reverse = vtk.vtkReverseSense()
         reverse.SetInputConnection(tri.GetOutputPort())
-        reverse.Update()
 
         appendBottom = vtk.vtkAppendPolyData()
         appendBottom.AddInputConnection(clipBase.GetOutputPort())
         appendBottom.AddInputConnection(reverse.GetOutputPort())
-        appendBottom.Update()
 
         clean = vtk.vtkCleanPolyData()
         clean.SetInputConnection(appendBottom.GetOutputPort())
-        clean.Update()
 
         normAuto = vtk.vtkPolyDataNormals()
         normAuto.ConsistencyOn()
         normAuto.AutoOrientNormalsOn()
         normAuto.SetInputConnection(clean.GetOutputPort())
-        normAuto.Update()
 
-        bottomMold = vtk.vtkPolyData()
-        bottomMold.DeepCopy(normAuto.GetOutput())
+        self.releaseIntermediateData(clipBase, cutter, loop, tri, reverse, appendBottom, clean)
 
-        return topMold, bottomMold
+        return self.getPipelineOutput(normAuto, 'clipBottomMoldHalf')
+
+    def getPipelineOutput(self, algorithm, name=None, port=0):
+        """
+        Updates a VTK pipeline from its last filter and returns a shallow copy of the output, so the data outlives the
+        pipeline without being duplicated.
+        :param algorithm: Last filter of the pipeline
+        :param name: Optional pipeline name, the update time and output size are logged if given
+        :param port: Output port to copy
+        :return: vtkPolyData output
+        """
+        start = timer()
+        algorithm.Update()
+
+        output = vtk.vtkPolyData()
+        output.ShallowCopy(algorithm.GetOutputDataObject(port))
+
+        if name:
+            logging.debug('{0} updated in {1:.3f}s, output {2} kB'.format(name, timer() - start,
+                                                                          output.GetActualMemorySize()))
+
+        return output
+
+    def releaseIntermediateData(self, *algorithms):
+        """
+        Sets the release data flag on intermediate filters, so their outputs are freed once consumed downstream. Only
+        for filters with a single consumer, as a released output has to be recomputed for any other consumer.
+        :param algorithms: Filters to release
+        :return: None
+        """
+        for algorithm in algorithms:
+            algorithm.ReleaseDataFlagOn()
 
     def addOrUpdateModel(self, model, name, tformId=None, color=None):
         """
@@ -1965,7 +4269,238 @@ class MVSegmenterLogic(ScriptedLoadableModuleLogic):
         if color:
             node.GetDisplayNode().SetColor(color)
 
-    def runDeepMitral(self, heartValveNode, volumeNode, outputSeg):
+    def computeLeafletMetrics(self, segNode, heartValveNode, segmentId='Leaflet Segmentation', refNode=None,
+                              tableNode=None):
+        """
+        Computes shape metrics of the leaflet segmentation within the annulus ROI, the voxels whose projection onto the
+        annulus plane lies inside the annulus contour and within metricsRoiHeight of the plane.
+        Thickness is measured on the medial ridge of the distance transform of the leaflet labelmap. It is within half
+        a voxel, measured along the local direction across the leaflet, of the thickness of the labelmap along that
+        direction. Heights are signed distances to the annulus plane along its normal, the tenting height is the
+        largest height on the side of the plane the leaflets lie on.
+        :param segNode: Segmentation node containing the leaflet segmentation
+        :param heartValveNode: The SlicerHeart MRML node containing annulus definition
+        :param segmentId: The segment ID of the leaflet segmentation
+        :param refNode: Optional reference volume defining the labelmap geometry, defaults to the session speed image
+        reference
+        :param tableNode: Optional table node to write the summary to
+        :return: Dictionary with the summary metrics in mm, mm^2 and mm^3, the thickness map image, the thickness and
+        height arrays of the ROI voxels. None on failure
+        """
+        if not segNode or not heartValveNode:
+            logging.debug("computeLeafletMetrics failed: Missing parameter")
+            return None
+
+        valveModel = HeartValveLib.getValveModel(heartValveNode)
+        if valveModel.getAnnulusContourMarkupNode().GetNumberOfFiducials() < 3:
+            logging.debug("computeLeafletMetrics failed: Annulus contour not defined")
+            return None
+
+        refNode = refNode or self.getSession(segNode).speedImgRefNode
+        mask = self.pullITKImageFromSegmentation(segNode, segmentId, refNode)
+        if mask is None:
+            return None
+
+        spacing = np.array(mask.GetSpacing())
+        direction = np.array(mask.GetDirection()).reshape(3, 3)
+        array = sitk.GetArrayViewFromImage(mask)
+        voxels = np.nonzero(array)
+
+        # RAS coordinates of the leaflet voxels, itk physical coordinates are LPS
+        ijk = np.stack(voxels[::-1], axis=1).astype(np.float64)
+        points = (np.array(mask.GetOrigin()) + (ijk * spacing) @ direction.T) * [-1, -1, 1]
+
+        # Heights above the annulus plane and coordinates within it
+        center, normal = valveModel.getAnnulusContourPlane()
+        normal = np.asarray(normal) / np.linalg.norm(normal)
+        axisU = np.cross(normal, [1, 0, 0] if abs(normal[0]) < 0.9 else [0, 1, 0])
+        axisU /= np.linalg.norm(axisU)
+        axisV = np.cross(normal, axisU)
+        offsets = points - center
+        heights = offsets @ normal
+
+        annulusPoints = slicer.util.arrayFromMarkupsControlPoints(valveModel.getAnnulusContourMarkupNode()) - center
+        roi = self.pointsInPolygon(offsets @ axisU, offsets @ axisV, annulusPoints @ axisU, annulusPoints @ axisV)
+        roi &= np.abs(heights) <= self.metricsRoiHeight
+        if not roi.any():
+            logging.debug("computeLeafletMetrics failed: No leaflet voxels within the annulus")
+            return None
+
+        roiArray = np.zeros(array.shape, dtype=np.uint8)
+        roiArray[tuple(axis[roi] for axis in voxels)] = 1
+        roiImage = sitk.GetImageFromArray(roiArray)
+        roiImage.CopyInformation(mask)
+
+        # Thickness on the medial ridge, the local maxima of the distance to the leaflet boundary. Boundary voxels have
+        # distance zero, so the ridge of a sheet T voxels thick is at (T - 1) / 2 voxels for odd T and (T - 2) / 2 for
+        # even T where it spans two voxels. The thickness adds 1.5 voxels to twice the ridge distance, where a voxel is
+        # the extent of a voxel along the direction across the sheet, so that anisotropic spacing is accounted for.
+        # The distance is computed here rather than taken from the session level sets: those cover the whole leaflet
+        # rather than the ROI, are no longer distances once iterated, and computeSignedDistance works in voxels and may
+        # clamp them to its narrow band.
+        signedDis = sitk.SignedMaurerDistanceMapImageFilter()
+        signedDis.SetInsideIsPositive(True)
+        signedDis.SetSquaredDistance(False)
+        signedDis.SetUseImageSpacing(True)
+        signedDis.SetNumberOfThreads(self.getNumberOfThreads('distance'))
+        distance = sitk.Cast(signedDis.Execute(roiImage), sitk.sitkFloat32)
+        ridge = (distance == sitk.GrayscaleDilate(distance, [1, 1, 1], sitk.sitkBox)) & (roiImage > 0)
+
+        distanceArray = sitk.GetArrayViewFromImage(distance)
+        ridgeIndices = np.nonzero(sitk.GetArrayViewFromImage(ridge))
+        normals = self.getRidgeNormals(distanceArray, ridgeIndices, spacing)
+        thickness = (2 * distanceArray[ridgeIndices] + 1.5 * np.abs(normals) @ spacing).astype(np.float32)
+        thicknessArray = np.zeros(array.shape, dtype=np.float32)
+        thicknessArray[ridgeIndices] = thickness
+        thicknessMap = sitk.GetImageFromArray(thicknessArray)
+        thicknessMap.CopyInformation(mask)
+
+        # One side of the leaflet is about half of the closed surface without the faces where the ROI cuts the leaflet
+        surfaceArea, cutArea = self.computeRoiSurfaceArea(roiArray, array, spacing)
+
+        roiHeights = heights[roi]
+        side = 1 if roiHeights.mean() >= 0 else -1
+
+        metrics = {
+            'voxelCount': int(roi.sum()),
+            'volume': float(roi.sum() * np.prod(spacing)),
+            'surfaceArea': surfaceArea,
+            'roiCutArea': cutArea,
+            'leafletArea': (surfaceArea - cutArea) / 2,
+            'thicknessMean': float(thickness.mean()),
+            'thicknessMedian': float(np.median(thickness)),
+            'thickness95': float(np.percentile(thickness, 95)),
+            'thicknessMax': float(thickness.max()),
+            'heightAbove': float(max(roiHeights.max(), 0)),
+            'heightBelow': float(max(-roiHeights.min(), 0)),
+            'tentingHeight': float((side * roiHeights).max()),
+        }
+        summaryNames = list(metrics.keys())
+
+        metrics['thicknessMap'] = thicknessMap
+        metrics['thickness'] = thickness
+        metrics['heights'] = roiHeights
+
+        if tableNode:
+            names = vtk.vtkStringArray()
+            names.SetName('Metric')
+            values = vtk.vtkDoubleArray()
+            values.SetName('Value')
+            for name in summaryNames:
+                names.InsertNextValue(name)
+                values.InsertNextValue(metrics[name])
+
+            table = tableNode.GetTable()
+            table.Initialize()
+            table.AddColumn(names)
+            table.AddColumn(values)
+            tableNode.Modified()
+
+        return metrics
+
+    def getRidgeNormals(self, distanceArray, indices, spacing):
+        """
+        Estimates the direction across a sheet at its medial ridge voxels, the main eigenvector of the structure tensor
+        of the distance gradient over the 3x3x3 neighbourhood. The gradient vanishes on the ridge but points away from
+        it on both sides, along the same axis.
+        :param distanceArray: Distance map array (k, j, i) in mm
+        :param indices: Tuple of the (k, j, i) index arrays of the ridge voxels
+        :param spacing: Voxel spacing (x, y, z)
+        :return: Unit normals (x, y, z) of the ridge voxels, shape (N, 3)
+        """
+        if not len(indices[0]):
+            return np.zeros((0, 3))
+
+        # Gradient within the bounding box of the ridge voxels, with a margin for the central differences of their
+        # neighbours, padded so that neighbours outside the image contribute nothing
+        lower = [max(int(axis.min()) - 2, 0) for axis in indices]
+        upper = [int(axis.max()) + 3 for axis in indices]
+        box = distanceArray[lower[0]:upper[0], lower[1]:upper[1], lower[2]:upper[2]]
+        gradient = np.stack(np.gradient(box, *np.asarray(spacing)[::-1])[::-1], axis=-1)
+        gradient = np.pad(gradient, ((1, 1), (1, 1), (1, 1), (0, 0)))
+
+        local = [axis - lowerAxis + 1 for axis, lowerAxis in zip(indices, lower)]
+        tensor = np.zeros((len(indices[0]), 3, 3))
+        for dk in (-1, 0, 1):
+            for dj in (-1, 0, 1):
+                for di in (-1, 0, 1):
+                    g = gradient[local[0] + dk, local[1] + dj, local[2] + di]
+                    tensor += g[:, :, None] * g[:, None, :]
+
+        return np.linalg.eigh(tensor)[1][:, :, -1]
+
+    def computeRoiSurfaceArea(self, roiArray, maskArray, spacing):
+        """
+        Computes the area of the surface of the ROI voxels of a labelmap, and the part of it where the ROI cuts through
+        the labelmap rather than following its boundary. Surface points lie halfway between an ROI voxel and an outside
+        voxel, a point is on a cut when its outside voxel belongs to the labelmap. Triangles count towards the cut area
+        in proportion to their points on a cut.
+        :param roiArray: Binary array (k, j, i) of the ROI voxels
+        :param maskArray: Binary array (k, j, i) of the labelmap, containing the ROI voxels
+        :param spacing: Voxel spacing (x, y, z)
+        :return: (surfaceArea, cutArea) in mm^2
+        """
+        imageData = vtk.vtkImageData()
+        imageData.SetDimensions(roiArray.shape[::-1])
+        imageData.SetSpacing(spacing)
+        imageData.GetPointData().SetScalars(numpy_support.numpy_to_vtk(roiArray.ravel(), deep=True))
+        flyingEdges = vtk.vtkDiscreteFlyingEdges3D()
+        flyingEdges.SetInputData(imageData)
+        flyingEdges.SetValue(0, 1)
+        flyingEdges.ComputeNormalsOff()
+        flyingEdges.ComputeScalarsOff()
+        surface = self.getPipelineOutput(flyingEdges)
+        if not surface.GetNumberOfPolys():
+            return 0.0, 0.0
+
+        points = numpy_support.vtk_to_numpy(surface.GetPoints().GetData()).astype(np.float64)
+        triangles = numpy_support.vtk_to_numpy(surface.GetPolys().GetConnectivityArray()).reshape(-1, 3)
+        corners = points[triangles]
+        areas = 0.5 * np.linalg.norm(np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0]), axis=1)
+
+        # The two voxels of the edge each point lies on, (i, j, k) -> (k, j, i) indices
+        index = points / spacing
+        lower = tuple(np.floor(index + 0.25).astype(int).T[::-1])
+        upper = tuple(np.ceil(index - 0.25).astype(int).T[::-1])
+        outside = tuple(np.where(roiArray[lower] > 0, upperAxis, lowerAxis) for lowerAxis, upperAxis in zip(lower, upper))
+        cut = (maskArray[outside] > 0) & (roiArray[outside] == 0)
+
+        return float(areas.sum()), float((areas * cut[triangles].mean(axis=1)).sum())
+
+    def pointsInPolygon(self, x, y, polygonX, polygonY):
+        """
+        Tests which points lie inside a closed polygon using the crossing number, vectorized over points and edges
+        :param x: Point x coordinates
+        :param y: Point y coordinates
+        :param polygonX: Polygon vertex x coordinates
+        :param polygonY: Polygon vertex y coordinates
+        :return: Boolean array, True for points inside
+        """
+        inside = np.zeros(len(x), dtype=bool)
+        nextX = np.roll(polygonX, -1)
+        nextY = np.roll(polygonY, -1)
+
+        # Process points in chunks to bound the size of the point-edge arrays
+        chunkSize = max(int(1e7 // max(len(polygonX), 1)), 1)
+        for start in range(0, len(x), chunkSize):
+            px = x[start:start + chunkSize, None]
+            py = y[start:start + chunkSize, None]
+            crosses = (polygonY > py) != (nextY > py)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                intersectX = polygonX + (py - polygonY) * (nextX - polygonX) / (nextY - polygonY)
+            inside[start:start + chunkSize] = np.count_nonzero(crosses & (px < intersectX), axis=1) % 2 == 1
+
+        return inside
+
+    def runDeepMitral(self, heartValveNode, volumeNode, outputSeg, initializeLevelSet=False):
+        """
+        Segments the leaflets with the DeepMitral network
+        :param heartValveNode: The SlicerHeart MRML node containing annulus definition
+        :param volumeNode: The image volume to segment
+        :param outputSeg: Segmentation node to save output to
+        :param initializeLevelSet: Initialize the leaflet level set from the result, see initLeafletSegFromSegmentation
+        :return: None
+        """
         try:
             import monai
             import torch
@@ -2064,7 +4599,7 @@ class MVSegmenterLogic(ScriptedLoadableModuleLogic):
 
         # Evaluate model on image
         net.eval()
-        with torch.no_grad():
+        with self.threadStage('deepMitral'), torch.no_grad():
             for batch in loader:
                 out = sliding_window_inference(batch['image'].to(device), (96, 96, 96), 16, net)
                 out = post_tform(decollate_batch(out))
@@ -2089,6 +4624,9 @@ class MVSegmenterLogic(ScriptedLoadableModuleLogic):
         # Binary threshold here as linear interpolation used in resampling
         self.pushITKImageToSegmentation(sitk.BinaryThreshold(segIm, 0.5), outputSeg, 'Leaflet Segmentation')
 
+        if initializeLevelSet:
+            self.initLeafletSegFromSegmentation(volumeNode, outputSeg, img)
+
         end = timer()
         print('Segmented in {0:.3f}s'.format(end - start))
 
@@ -2113,6 +4651,18 @@ class MVSegmenterTest(ScriptedLoadableModuleTest):
         """
         self.setUp()
         self.test_MVSegmenter1()
+        self.test_filterSpeedImage()
+        self.test_speedImageTiled()
+        self.test_visibleSurfacePoints()
+        self.test_innerSurfaceScalars()
+        self.test_decimateSurface()
+        self.test_extrusionLength()
+        self.test_sessionCheckpoint()
+        self.test_signedDistance()
+        self.test_sessionSpeedImage()
+        self.test_blockSurface()
+        self.test_pointsInPolygon()
+        self.test_leafletRoiMetrics()
 
     def test_MVSegmenter1(self):
         """ Ideally you should have several levels of tests.  At the lowest level
@@ -2127,3 +4677,371 @@ class MVSegmenterTest(ScriptedLoadableModuleTest):
         """
 
         self.delayDisplay("No tests are implemented")
+
+    def test_filterSpeedImage(self):
+        """ Pins the speed image of a synthetic volume. The input is cast to float32 before the blur, changes to the
+        filter chain or its order show up as different values.
+        """
+        z, y, x = np.ogrid[:24, :28, :32]
+        sphere = ((x - 16) ** 2 + (y - 14) ** 2 + (z - 12) ** 2) < 8 ** 2
+        img = sitk.GetImageFromArray((sphere * 120 + x + 2 * y).astype(np.uint8))
+        img.SetSpacing((0.5, 0.6, 0.7))
+
+        speedImg = MVSegmenterLogic().filterSpeedImage(img)
+        self.assertEqual(speedImg.GetPixelID(), sitk.sitkFloat32)
+        self.assertEqual(speedImg.GetSize(), img.GetSize())
+
+        speed = sitk.GetArrayViewFromImage(speedImg)
+        self.assertAlmostEqual(float(speed.sum(dtype=np.float64)), 13480.5289, delta=1e-2)
+        self.assertAlmostEqual(float(speed.max()), 0.867533, places=5)
+        self.assertAlmostEqual(float(speed[12, 14, 16]), 0.772510, places=5)
+        self.assertAlmostEqual(float(speed[12, 14, 8]), 0.000611, places=5)
+        self.assertAlmostEqual(float(speed[12, 6, 16]), 0.000261, places=5)
+
+    def test_speedImageTiled(self):
+        """ The tiled speed image is identical to filtering the whole volume, with slabs thinner than the halo and the
+        result counted in the memory budget
+        """
+        z, y, x = np.ogrid[:60, :20, :24]
+        sphere = ((x - 12) ** 2 + (y - 10) ** 2 + (z - 30) ** 2) < 15 ** 2
+        img = sitk.GetImageFromArray((sphere * 120 + x + 2 * y + 3 * z).astype(np.uint8))
+        img.SetSpacing((0.5, 0.6, 0.7))
+
+        logic = MVSegmenterLogic()
+        sliceBytes = 24 * 20 * logic.speedImageBytesPerVoxel
+        resultBytes = img.GetNumberOfPixels() * 4
+        memoryBudget = resultBytes + 2 * (5 + 2 * logic.speedImageTileHalo) * sliceBytes
+
+        tiledImg = logic.computeSpeedImageTiled(img, memoryBudget, 2)
+        fullImg = logic.filterSpeedImage(img)
+        self.assertEqual(tiledImg.GetPixelID(), fullImg.GetPixelID())
+        self.assertEqual(tiledImg.GetSpacing(), img.GetSpacing())
+        np.testing.assert_array_equal(sitk.GetArrayViewFromImage(tiledImg), sitk.GetArrayViewFromImage(fullImg))
+
+        # Result alone over budget: single slice slabs, still identical
+        tiledImg = logic.computeSpeedImageTiled(img, resultBytes // 2, 2)
+        np.testing.assert_array_equal(sitk.GetArrayViewFromImage(tiledImg), sitk.GetArrayViewFromImage(fullImg))
+
+    def createTorus(self):
+        """ Closed torus surface of ring radius 10 and cross section radius 3 in the xy plane, with point normals
+        """
+        torus = vtk.vtkParametricTorus()
+        torus.SetRingRadius(10)
+        torus.SetCrossSectionRadius(3)
+        source = vtk.vtkParametricFunctionSource()
+        source.SetParametricFunction(torus)
+        source.SetUResolution(60)
+        source.SetVResolution(30)
+
+        clean = vtk.vtkCleanPolyData()
+        clean.SetInputConnection(source.GetOutputPort())
+        normals = vtk.vtkPolyDataNormals()
+        normals.SplittingOff()
+        normals.SetInputConnection(clean.GetOutputPort())
+        normals.Update()
+
+        return normals.GetOutput()
+
+    def test_visibleSurfacePoints(self):
+        """ The batched visibility test selects the same points of a torus as the per point OBB tree test, for targets
+        inside the tube, above its hole and outside of it
+        """
+        logic = MVSegmenterLogic()
+        torus = self.createTorus()
+        pointIds = np.arange(torus.GetNumberOfPoints())
+
+        for target, visibleCount in (((10, 0, 0.5), 785), ((2, 1, 4), 755), ((15, 3, -2), 127)):
+            batched = logic.getVisibleSurfacePoints(torus, pointIds, target, 'batched')
+            obb = logic.getVisibleSurfacePoints(torus, pointIds, target, 'obb')
+            np.testing.assert_array_equal(batched, obb)
+            self.assertEqual(int(batched.sum()), visibleCount)
+
+    def test_innerSurfaceScalars(self):
+        """ The vectorized inner surface classification matches a per point loop over the OBB tree visibility test and a
+        vtkPointLocator closest tube point, the implementation of previous versions with the corrected visibility rule
+        """
+        logic = MVSegmenterLogic()
+        torus = self.createTorus()
+        normal = np.array([0.1, 0.2, 1.0]) / np.linalg.norm([0.1, 0.2, 1.0])
+        annulusPlane = (np.array([0.5, -0.3, -1.0]), normal)
+
+        lineSource = vtk.vtkLineSource()
+        lineSource.SetPoint1(annulusPlane[0] + annulusPlane[1] * 20)
+        lineSource.SetPoint2(annulusPlane[0] - annulusPlane[1] * 20)
+        tubeFilter = vtk.vtkTubeFilter()
+        tubeFilter.SetRadius(5)
+        tubeFilter.CappingOff()
+        tubeFilter.SetNumberOfSides(50)
+        tubeFilter.SetInputConnection(lineSource.GetOutputPort())
+        tubeFilter.Update()
+        tube = tubeFilter.GetOutput()
+
+        scalars = logic.computeInnerSurfaceScalars(torus, annulusPlane, tube)
+
+        locator = vtk.vtkPointLocator()
+        locator.SetDataSet(tube)
+        locator.BuildLocator()
+        tubeNormals = tube.GetPointData().GetNormals()
+        normals = torus.GetPointData().GetNormals()
+        pointIds = np.arange(torus.GetNumberOfPoints())
+        visible = (logic.getVisibleSurfacePoints(torus, pointIds, annulusPlane[0] + annulusPlane[1] * 5, 'obb') |
+                   logic.getVisibleSurfacePoints(torus, pointIds, annulusPlane[0] - annulusPlane[1] * 5, 'obb'))
+        expected = np.zeros(torus.GetNumberOfPoints())
+        for i in pointIds:
+            point = np.array(torus.GetPoint(i))
+            if np.dot(annulusPlane[1], point - annulusPlane[0] - annulusPlane[1] * 2) > 0:
+                expected[i] = 10 if visible[i] else -10
+            else:
+                v = np.array(tubeNormals.GetTuple(locator.FindClosestPoint(point)))
+                n = np.array(normals.GetTuple(i))
+                expected[i] = math.acos(np.dot(n, v) / np.linalg.norm(n) / np.linalg.norm(v))
+
+        np.testing.assert_array_equal(np.abs(scalars) == 10, np.abs(expected) == 10)
+        np.testing.assert_allclose(scalars, expected, atol=1e-6)
+        self.assertEqual(int((scalars == 10).sum()), 339)
+        self.assertEqual(int((scalars == -10).sum()), 303)
+
+    def test_decimateSurface(self):
+        """ Decimation of a sphere to a triangle budget and an error budget, and the fallback to the undecimated surface
+        when the error budget cannot be met
+        """
+        logic = MVSegmenterLogic()
+        sphere = vtk.vtkSphereSource()
+        sphere.SetRadius(10)
+        sphere.SetThetaResolution(120)
+        sphere.SetPhiResolution(120)
+        sphere.Update()
+        surface = sphere.GetOutput()
+        self.assertEqual(surface.GetNumberOfCells(), 28320)
+
+        logic.decimationBudgets['mold'] = {'targetTriangles': 2000, 'maxError': None}
+        decimated = logic.decimateSurface(surface, 'mold', 0.8)
+        self.assertEqual(decimated.GetNumberOfCells(), 2000)
+        self.assertIsNotNone(decimated.GetPointData().GetNormals())
+        self.assertTrue(logic.decimationResults['mold']['withinBudget'])
+
+        logic.decimationBudgets['mold'] = {'targetTriangles': None, 'maxError': 0.05}
+        decimated = logic.decimateSurface(surface, 'mold', 0.8)
+        result = logic.decimationResults['mold']
+        self.assertTrue(result['withinBudget'])
+        self.assertAlmostEqual(result['hausdorffDistance'], 0.0387, places=4)
+        self.assertEqual(result['triangles'], decimated.GetNumberOfCells())
+        self.assertEqual(result['triangles'], 4318)
+
+        # Pro decimation of the sphere does not get below 0.014 mm
+        logic.decimationBudgets['mold'] = {'targetTriangles': None, 'maxError': 0.005}
+        decimated = logic.decimateSurface(surface, 'mold', 0.8)
+        self.assertFalse(logic.decimationResults['mold']['withinBudget'])
+        self.assertEqual(decimated.GetNumberOfCells(), surface.GetNumberOfCells())
+
+    def test_extrusionLength(self):
+        """ Extrusion length reaching the boundary of a box along scaled and unit directions
+        """
+        logic = MVSegmenterLogic()
+        bounds = [-10, 10, -20, 20, -5, 5]
+        points = [[0, 0, 0], [5, 0, 0], [0, 10, 0]]
+
+        self.assertAlmostEqual(logic.getExtrusionLength(points[:1], [[1, 0, 0]], bounds), 11.0)
+        self.assertAlmostEqual(logic.getExtrusionLength(points, [[1, 0, 0], [1, 0, 0], [0, 1, 0]], bounds), 11.0)
+        self.assertAlmostEqual(logic.getExtrusionLength(points[1:2], [[-2, 0, 0]], bounds), 8.0)
+        self.assertAlmostEqual(logic.getExtrusionLength(points[2:], [[0, 0.6, 0.8]], bounds), 6.25 + 1.0)
+        self.assertEqual(logic.getExtrusionLength(points[:1], [[0, 0, 0]], bounds), 0.0)
+
+    def test_sessionCheckpoint(self):
+        """ Saves a session with level sets in both precisions and undo and redo entries, and restores it bit-identical
+        from the memory-mapped files
+        """
+        import shutil
+
+        logic = MVSegmenterLogic()
+        segNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLSegmentationNode')
+        session = logic.getSession(segNode)
+
+        def createImage(seed, pixelType):
+            img = sitk.GetImageFromArray(np.random.RandomState(seed).uniform(-5, 5, (12, 14, 16)))
+            img.SetSpacing((0.5, 0.6, 0.7))
+            img.SetOrigin((1, 2, 3))
+            return sitk.Cast(img, pixelType)
+
+        session.speedImg = createImage(0, sitk.sitkFloat32)
+        session.bpLevelSet = createImage(1, sitk.sitkFloat32)
+        session.undoBPLevelSetStack = [createImage(2, sitk.sitkFloat32), createImage(3, sitk.sitkFloat32)]
+        session.redoLeafletLevelSetStack = [createImage(4, sitk.sitkFloat64)]
+        saved = [session.speedImg, session.bpLevelSet] + session.undoBPLevelSetStack[::-1] + \
+            session.redoLeafletLevelSetStack
+
+        directory = Path(tempfile.mkdtemp(dir=slicer.app.temporaryPath))
+        try:
+            self.assertEqual(logic.saveSessionCheckpoint(segNode, directory), directory)
+            self.assertEqual(len(list((directory / 'history').glob('*.npy'))), 3)
+
+            logic.removeSession(segNode)
+            self.assertTrue(logic.loadSessionCheckpoint(segNode, directory))
+            session = logic.getSession(segNode)
+            self.assertIsNone(session.leafletLevelSet)
+            self.assertEqual([len(session.undoBPLevelSetStack), len(session.redoLeafletLevelSetStack)], [2, 1])
+
+            restored = [session.speedImg, session.bpLevelSet] + \
+                [session.popLevelSet(session.undoBPLevelSetStack) for i in range(2)] + \
+                [session.popLevelSet(session.redoLeafletLevelSetStack)]
+            for expected, img in zip(saved, restored):
+                self.assertEqual(img.GetPixelID(), expected.GetPixelID())
+                self.assertEqual(img.GetSpacing(), expected.GetSpacing())
+                self.assertEqual(img.GetOrigin(), expected.GetOrigin())
+                np.testing.assert_array_equal(sitk.GetArrayViewFromImage(img).astype(np.float32),
+                                              sitk.GetArrayViewFromImage(expected).astype(np.float32))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_signedDistance(self):
+        """ The Maurer and narrow band backends keep the inside and outside of Danielsson, the narrow band is the clamped
+        Maurer distance and an empty mask gives the band width everywhere
+        """
+        logic = MVSegmenterLogic()
+        z, y, x = np.ogrid[:28, :32, :36]
+        mask = (((x - 14) ** 2 + (y - 16) ** 2 + (z - 12) ** 2) < 7 ** 2) | ((x > 24) & (x < 30) & (y < 8) & (z > 20))
+        mask = sitk.GetImageFromArray(mask.astype(np.uint8))
+
+        danielsson = sitk.GetArrayFromImage(logic.computeSignedDistance(mask, 'danielsson'))
+        maurer = sitk.GetArrayFromImage(logic.computeSignedDistance(mask, 'maurer'))
+        narrowband = sitk.GetArrayFromImage(logic.computeSignedDistance(mask, 'narrowband', 4))
+
+        for levelSet in (maurer, narrowband):
+            np.testing.assert_array_equal(levelSet <= 0, danielsson <= 0)
+        np.testing.assert_array_equal(narrowband, np.clip(maurer, -4, 4))
+        band = np.abs(danielsson) < 4
+        self.assertLessEqual(float(np.abs(narrowband - danielsson)[band].max()), 1.0)
+
+        empty = logic.computeSignedDistance(mask * 0, 'narrowband', 4)
+        np.testing.assert_array_equal(sitk.GetArrayViewFromImage(empty), 4)
+
+    def test_sessionSpeedImage(self):
+        """ Level sets and undo history are kept when the speed image is recomputed from the same volume, and cleared
+        when it comes from another volume or geometry
+        """
+        session = MVSegmenterSession()
+        volume = object()
+        speedImg = sitk.Image([16, 12, 8], sitk.sitkFloat32)
+
+        def addLevelSets():
+            session.bpLevelSet = sitk.Image([16, 12, 8], sitk.sitkFloat32)
+            session.undoBPLevelSetStack = [session.bpLevelSet]
+            session.leafletLevelSet = session.bpLevelSet
+
+        self.assertTrue(session.setSpeedImage(speedImg, volume))
+        addLevelSets()
+        self.assertFalse(session.setSpeedImage(sitk.Image(speedImg), volume))
+        self.assertEqual(len(session.undoBPLevelSetStack), 1)
+
+        resampled = sitk.Image(speedImg)
+        resampled.SetSpacing([0.5, 0.5, 0.5])
+        self.assertTrue(session.setSpeedImage(resampled, volume))
+        self.assertIsNone(session.bpLevelSet)
+        self.assertEqual(session.undoBPLevelSetStack, [])
+
+        addLevelSets()
+        self.assertTrue(session.setSpeedImage(sitk.Image([20, 12, 8], sitk.sitkFloat32), object()))
+        self.assertIsNone(session.leafletLevelSet)
+        self.assertEqual(session.speedImg.GetSize(), (20, 12, 8))
+
+    def test_blockSurface(self):
+        """ The changed extent bounds the differing voxels, and re-meshing only the blocks touching it gives the same
+        blocks as meshing the whole mask
+        """
+        class ReferenceVolume:
+            def GetIJKToRASMatrix(self, matrix):
+                matrix.Identity()
+                for i, spacing in enumerate((0.5, 0.6, 0.7)):
+                    matrix.SetElement(i, i, spacing)
+
+        z, y, x = np.ogrid[:30, :36, :40]
+        previous = ((x - 20) ** 2 + (y - 18) ** 2 + (z - 15) ** 2) < 12 ** 2
+        current = previous.copy()
+        current[14:18, 20:28, 31:35] = True
+        current[15, 18, 9] = False
+        previousImg = sitk.GetImageFromArray(previous.astype(np.uint8))
+        currentImg = sitk.GetImageFromArray(current.astype(np.uint8))
+
+        logic = MVSegmenterLogic()
+        self.assertIsNone(logic.getChangedExtent(previousImg, sitk.Image(previousImg)))
+        extent = logic.getChangedExtent(currentImg, previousImg)
+        self.assertEqual(extent, [9, 34, 18, 27, 14, 17])
+
+        logic.surfaceBlockSize = 8
+        refNode = ReferenceVolume()
+        incremental = MVSegmenterSession()
+        logic.updateBlockSurface(incremental, 'Leaflet Segmentation', previousImg, refNode)
+        surface = logic.updateBlockSurface(incremental, 'Leaflet Segmentation', currentImg, refNode, extent)
+        full = MVSegmenterSession()
+        fullSurface = logic.updateBlockSurface(full, 'Leaflet Segmentation', currentImg, refNode)
+
+        incrementalBlocks = incremental.surfaceBlocks['Leaflet Segmentation']
+        fullBlocks = full.surfaceBlocks['Leaflet Segmentation']
+        self.assertEqual(set(incrementalBlocks), set(fullBlocks))
+        for key, polyData in fullBlocks.items():
+            np.testing.assert_array_equal(numpy_support.vtk_to_numpy(incrementalBlocks[key].GetPoints().GetData()),
+                                          numpy_support.vtk_to_numpy(polyData.GetPoints().GetData()))
+            self.assertEqual(incrementalBlocks[key].GetNumberOfCells(), polyData.GetNumberOfCells())
+        self.assertEqual(surface.GetNumberOfCells(), fullSurface.GetNumberOfCells())
+        self.assertAlmostEqual(surface.GetBounds()[1], 34.5 * 0.5, places=5)
+
+    def test_pointsInPolygon(self):
+        """ Crossing number test on a concave polygon, and on a fine polygon of a circle away from its boundary
+        """
+        logic = MVSegmenterLogic()
+        polygonX = np.array([0, 4, 4, 2, 2, 0], dtype=float)
+        polygonY = np.array([0, 0, 1, 1, 3, 3], dtype=float)
+        x = np.array([1, 3, 3, 1, 5, -1, 1.5])
+        y = np.array([0.5, 0.5, 2, 2.5, 0.5, 1, 2.9])
+        np.testing.assert_array_equal(logic.pointsInPolygon(x, y, polygonX, polygonY),
+                                      [True, True, False, True, False, False, True])
+
+        angle = np.linspace(0, 2 * np.pi, 360, endpoint=False)
+        y, x = np.mgrid[10:38:0.3, 8:32:0.3]
+        x, y = x.ravel(), y.ravel()
+        radius = np.hypot(x - 20, y - 24)
+        inside = logic.pointsInPolygon(x, y, 20 + 8 * np.cos(angle), 24 + 8 * np.sin(angle))
+        clear = np.abs(radius - 8) > 0.01
+        np.testing.assert_array_equal(inside[clear], radius[clear] < 8)
+
+    def test_leafletRoiMetrics(self):
+        """ Leaflet area and thickness of a flat and a tilted plate, 3 mm thick along z, within a disc of radius 8 mm.
+        The flat plate is 5 voxels thick, so its ridge thickness is half a voxel above the 3.5 mm of the labelmap. The
+        staircase of the tilted plate overestimates its area of 209.9 mm^2.
+        """
+        logic = MVSegmenterLogic()
+        spacing = np.array([0.5, 0.6, 0.7])
+        k, j, i = np.indices((40, 80, 80))
+        x, y, z = i * spacing[0], j * spacing[1], k * spacing[2]
+        disc = (x - 20) ** 2 + (y - 24) ** 2 < 64
+
+        for tilt, leafletArea in ((0.0, 198.1004), (0.3, 227.2435)):
+            plate = np.abs(z - 14 - tilt * x) < 1.5
+            roiArray = (plate & disc).astype(np.uint8)
+            surfaceArea, cutArea = logic.computeRoiSurfaceArea(roiArray, plate.astype(np.uint8), spacing)
+            self.assertAlmostEqual((surfaceArea - cutArea) / 2, leafletArea, places=3)
+
+            roiImage = sitk.GetImageFromArray(roiArray)
+            roiImage.SetSpacing(spacing.tolist())
+            signedDis = sitk.SignedMaurerDistanceMapImageFilter()
+            signedDis.SetInsideIsPositive(True)
+            signedDis.SetSquaredDistance(False)
+            signedDis.SetUseImageSpacing(True)
+            distance = sitk.Cast(signedDis.Execute(roiImage), sitk.sitkFloat32)
+            ridge = (distance == sitk.GrayscaleDilate(distance, [1, 1, 1], sitk.sitkBox)) & (roiImage > 0)
+            distanceArray = sitk.GetArrayViewFromImage(distance)
+            ridgeIndices = np.nonzero(sitk.GetArrayViewFromImage(ridge))
+
+            normals = logic.getRidgeNormals(distanceArray, ridgeIndices, spacing)
+            normal = np.array([-tilt, 0, 1]) / np.hypot(tilt, 1)
+            self.assertLess(np.median(np.degrees(np.arccos(np.abs(normals @ normal)))), 10)
+
+            # Away from the ROI boundary, within half a voxel along the normal of the plate thickness
+            thickness = 2 * distanceArray[ridgeIndices] + 1.5 * np.abs(normals) @ spacing
+            center = (x[ridgeIndices] - 20) ** 2 + (y[ridgeIndices] - 24) ** 2 < 36
+            halfVoxel = 0.5 * np.abs(normal) @ spacing
+            if tilt:
+                self.assertLess(abs(np.median(thickness[center]) - 3 / np.hypot(tilt, 1)), halfVoxel)
+            else:
+                self.assertAlmostEqual(float(np.median(thickness[center])), 3.5 + halfVoxel, places=4)
+
@@ -0,0 +1,284 @@
+import logging
+import math
+import os
+import unittest
+from timeit import default_timer as timer
+
+import HeartValveLib
+import SimpleITK as sitk
+import numpy as np
+import sitkUtils
+import slicer
+import vtk
+from MVSegmenter import MVSegmenterLogic
+from vtk.util import numpy_support
+
+
+#
+# MVSegmenterBenchmark
+#
+
+class MVSegmenterBenchmark(object):
+    """Benchmarks comparing the alternative implementations selected by MVSegmenterLogic settings. Not part of the
+    module, run from the Slicer python console with the module loaded:
+
+        import MVSegmenterBenchmark
+        MVSegmenterBenchmark.MVSegmenterBenchmark().benchmarkSignedDistance()
+    """
+
+    def __init__(self, logic=None):
+        self.logic = logic or MVSegmenterLogic()
+
+    def timeModes(self, attribute, modes, operation, repeats=3, setUp=None):
+        """
+        Times an operation with a logic setting set to each of several values. The setting is restored afterwards.
+        :param attribute: Name of the MVSegmenterLogic attribute selecting the implementation
+        :param modes: List of (mode name, attribute value) pairs
+        :param operation: Function to time, called without arguments
+        :param repeats: Number of timed runs of each mode, the fastest is reported
+        :param setUp: Optional function called before each run, not timed
+        :return: (times, outputs) dictionaries keyed on mode name with the fastest time in seconds and the return value
+        of the last run
+        """
+        value = getattr(self.logic, attribute)
+        times = {}
+        outputs = {}
+        try:
+            for mode, modeValue in modes:
+                setattr(self.logic, attribute, modeValue)
+                modeTimes = []
+                for i in range(repeats):
+                    if setUp:
+                        setUp()
+                    start = timer()
+                    outputs[mode] = operation()
+                    modeTimes.append(timer() - start)
+                times[mode] = min(modeTimes)
+        finally:
+            setattr(self.logic, attribute, value)
+
+        return times, outputs
+
+    def benchmarkSignedDistance(self, mask=None, sizes=((112, 144, 144), (160, 208, 208), (224, 256, 256)), repeats=3):
+        """
+        Times the signed distance backends against Danielsson. Without a mask, a spherical blood pool is generated at
+        each of the sizes, typical of 3D echo volumes.
+        :param mask: Optional binary itk image to benchmark on instead of the generated masks
+        :param sizes: Image sizes (x, y, z) of the generated masks
+        :param repeats: Number of timed runs of each backend, the fastest is reported
+        :return: Dictionary keyed on image size with the time in seconds of each backend, the number of voxels whose
+        inside/outside sign differs from Danielsson and the maximum absolute difference within the narrow band
+        """
+        masks = [mask] if mask is not None else [self.createSphereMask(size) for size in sizes]
+
+        results = {}
+        for image in masks:
+            size = image.GetSize()
+            backends = [(backend, backend) for backend in ('danielsson', 'maurer', 'narrowband')]
+            results[size], levelSets = self.timeModes('distanceBackend', backends,
+                                                      lambda: self.logic.computeSignedDistance(image), repeats)
+
+            reference = sitk.GetArrayViewFromImage(levelSets['danielsson'])
+            band = np.abs(reference) < self.logic.distanceBandWidth
+            for backend in ('maurer', 'narrowband'):
+                levelSet = sitk.GetArrayViewFromImage(levelSets[backend])
+                results[size][backend + 'DifferingVoxels'] = int(np.count_nonzero((reference <= 0) != (levelSet <= 0)))
+                results[size][backend + 'MaxBandError'] = float(np.abs(reference - levelSet)[band].max())
+
+            logging.info('Signed distance {0}: danielsson {1:.3f}s, maurer {2:.3f}s, narrowband {3:.3f}s'.format(
+                size, results[size]['danielsson'], results[size]['maurer'], results[size]['narrowband']))
+
+        return results
+
+    def verifyPrecisionPolicy(self, inputVolume, heartValveNode, pixelType=sitk.sitkFloat32):
+        """
+        Compares the initial blood pool segmentation computed in a working precision against the float64 path. Does
+        not modify any session or node.
+        :param inputVolume: The reference image volume
+        :param heartValveNode: The SlicerHeart MRML node containing annulus definition
+        :param pixelType: Working precision to verify
+        :return: Dictionary with the number of differing voxels, the Dice coefficient, the level set memory per
+        snapshot in bytes and the time in seconds of each precision
+        """
+        valveModel = HeartValveLib.getValveModel(heartValveNode)
+        img = sitkUtils.PullVolumeFromSlicer(inputVolume)
+        seeds = self.logic.getBloodPoolSeeds(valveModel, inputVolume)
+
+        times, levelSets = self.timeModes(
+            'levelSetPixelType', [('float64', sitk.sitkFloat64), ('working', pixelType)],
+            lambda: self.logic.computeInitialBPLevelSet(self.logic.computeSpeedImage(img), seeds), repeats=1)
+
+        results = {}
+        masks = {}
+        for name, levelSet in levelSets.items():
+            results[name + 'Time'] = times[name]
+            results[name + 'SnapshotBytes'] = levelSet.GetNumberOfPixels() * levelSet.GetSizeOfPixelComponent()
+            masks[name] = levelSet <= 0
+
+        overlap = sitk.LabelOverlapMeasuresImageFilter()
+        overlap.Execute(masks['float64'], masks['working'])
+        difference = masks['float64'] != masks['working']
+        results['differingVoxels'] = int(np.count_nonzero(sitk.GetArrayViewFromImage(difference)))
+        results['dice'] = overlap.GetDiceCoefficient()
+
+        logging.info('Precision policy: {0} differing voxels, Dice {1:.5f}, float64 {2:.3f}s, working {3:.3f}s'.format(
+            results['differingVoxels'], results['dice'], results['float64Time'], results['workingTime']))
+
+        return results
+
+    def benchmarkMoldPostProcessing(self, segNode, volume, repeats=3):
+        """
+        Times the mold smoothing and annulus subtraction for the direct labelmap implementation and the segment editor
+        effects, and counts the voxels where their results differ. Runs on a temporary copy of the segmentation.
+        :param segNode: Segmentation node containing Mold_base and optionally Projected_Annulus
+        :param volume: Master volume
+        :param repeats: Number of timed runs of each method, the fastest is reported
+        :return: Dictionary keyed on operation name with the times in seconds and the number of differing voxels
+        """
+        copyNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLSegmentationNode', 'temp_benchmark')
+        copyNode.SetAndObserveTransformNodeID(segNode.GetTransformNodeID())
+
+        operations = {'smoothing': lambda: self.logic.smoothSegment(copyNode, 'Mold_base', 0.8, volume)}
+        if segNode.GetSegmentation().GetSegment('Projected_Annulus'):
+            operations['subtraction'] = lambda: self.logic.subtractAnnulusSegmentation(copyNode, volume)
+
+        results = {}
+        try:
+            for name, operation in operations.items():
+                outputs = {}
+                results[name] = {}
+                for method, useEffects in (('direct', False), ('effect', True)):
+                    times, _ = self.timeModes('useSegmentEditorEffects', [(method, useEffects)], operation, repeats,
+                                              lambda: copyNode.GetSegmentation().DeepCopy(segNode.GetSegmentation()))
+                    results[name].update(times)
+                    outputs[method] = self.logic.pullITKImageFromSegmentation(copyNode, 'Mold_base', volume)
+
+                difference = outputs['direct'] != outputs['effect']
+                results[name]['differingVoxels'] = int(np.count_nonzero(sitk.GetArrayViewFromImage(difference)))
+                logging.info('{0}: direct {1:.3f}s, effect {2:.3f}s, {3} differing voxels'.format(
+                    name, results[name]['direct'], results[name]['effect'], results[name]['differingVoxels']))
+        finally:
+            slicer.mrmlScene.RemoveNode(copyNode)
+
+        return results
+
+    def benchmarkParallelMoldBuild(self, segNode, heartValveNode, depth, offset=0, repeats=3):
+        """
+        Times the mold halves and the projected annulus construction with sequential and parallel branches.
+        :param segNode: Segmentation node containing the leaflet segmentation and optionally Mold_base
+        :param heartValveNode: SlicerHeart HeartValve MRML node containing annulus definition
+        :param depth: Base clipping depth
+        :param offset: Annulus projection offset
+        :param repeats: Number of timed runs of each mode, the fastest is reported
+        :return: Dictionary keyed on operation name with the sequential and parallel times in seconds and the speedup
+        """
+        valveModel = HeartValveLib.getValveModel(heartValveNode)
+        moldSurfaces = self.logic.getMoldSurfaces(segNode, valveModel)
+        if not moldSurfaces:
+            logging.debug("benchmarkParallelMoldBuild failed: Mold surfaces could not be extracted")
+            return None
+
+        contourPlane = valveModel.getAnnulusContourPlane()
+        midClippingPlane = vtk.vtkPlane()
+        midClippingPlane.SetNormal(contourPlane[1])
+        midClippingPlane.SetOrigin(contourPlane[0])
+        baseClippingPlane = vtk.vtkPlane()
+        baseClippingPlane.SetNormal(contourPlane[1])
+        baseClippingPlane.SetOrigin(contourPlane[0] + contourPlane[1] * depth)
+
+        operations = {'moldHalves': lambda: self.logic.buildMoldHalves(moldSurfaces[0], midClippingPlane,
+                                                                       baseClippingPlane)}
+        segMold = segNode.GetClosedSurfaceInternalRepresentation('Mold_base')
+        if segMold:
+            operations['projectedAnnulus'] = lambda: self.logic.generateProjectedAnnulus(segMold, valveModel, offset)
+
+        results = {}
+        for name, operation in operations.items():
+            results[name], _ = self.timeModes('parallelMoldBuild', [('sequential', False), ('parallel', True)],
+                                              operation, repeats)
+            results[name]['speedup'] = results[name]['sequential'] / results[name]['parallel']
+            logging.info('{0}: sequential {1:.3f}s, parallel {2:.3f}s, speedup {3:.2f}'.format(
+                name, results[name]['sequential'], results[name]['parallel'], results[name]['speedup']))
+
+        return results
+
+    def benchmarkThreadScaling(self, threadCounts=None, size=(160, 208, 208), repeats=1):
+        """
+        Times the threaded stages on a synthetic volume for increasing numbers of threads
+        :param threadCounts: Numbers of threads to run with, defaults to powers of two up to the number of cores
+        :param size: Image size (x, y, z) of the synthetic volume
+        :param repeats: Number of timed runs of each stage, the fastest is reported
+        :return: Dictionary keyed on stage with the times in seconds and the speedups over the first thread count, keyed
+        on the number of threads
+        """
+        if not threadCounts:
+            cores = os.cpu_count() or 1
+            threadCounts = sorted(set([2 ** i for i in range(int(math.log2(cores)) + 1)] + [cores]))
+
+        mask = self.createSphereMask(size)
+        sphere = sitk.GetArrayFromImage(mask)
+        img = sitk.GetImageFromArray((sphere * 150 + np.random.RandomState(0).randint(0, 40, sphere.shape))
+                                     .astype(np.uint8))
+        speedImg = self.logic.filterSpeedImage(img)
+        levelSet = self.logic.computeSignedDistance(sitk.BinaryErode(mask, [5, 5, 5]))
+
+        maskImageData = vtk.vtkImageData()
+        maskImageData.SetDimensions(size)
+        maskImageData.GetPointData().SetScalars(numpy_support.numpy_to_vtk(sphere.ravel(), deep=True))
+
+        def extractSurface():
+            with self.logic.threadStage('surface'):
+                flyingEdges = vtk.vtkDiscreteFlyingEdges3D()
+                flyingEdges.SetInputData(maskImageData)
+                flyingEdges.SetValue(0, 1)
+                flyingEdges.Update()
+
+        stages = {
+            'speedImage': lambda: self.logic.filterSpeedImage(img),
+            'distance': lambda: self.logic.computeSignedDistance(mask, 'maurer'),
+            'activeContour': lambda: self.logic.createActiveContourFilter('BP Segmentation', 25).Execute(levelSet,
+                                                                                                        speedImg),
+            'surface': extractSurface,
+        }
+
+        results = {}
+        for stage, function in stages.items():
+            modes = [(numberOfThreads, {stage: numberOfThreads}) for numberOfThreads in threadCounts]
+            times, _ = self.timeModes('stageThreads', modes, function, repeats)
+            results[stage] = {'time': times,
+                              'speedup': {n: times[threadCounts[0]] / t for n, t in times.items()}}
+            logging.info('{0}: {1}'.format(stage, ', '.join('{0} threads {1:.3f}s'.format(n, t)
+                                                            for n, t in times.items())))
+
+        return results
+
+    def createSphereMask(self, size):
+        """
+        Creates a spherical blood pool mask
+        :param size: Image size (x, y, z)
+        :return: Binary itk image
+        """
+        z, y, x = np.ogrid[:size[2], :size[1], :size[0]]
+        radius = min(size) / 3.0
+        sphere = ((x - size[0] / 2.0) ** 2 + (y - size[1] / 2.0) ** 2 + (z - size[2] / 2.0) ** 2) < radius ** 2
+        return sitk.GetImageFromArray(sphere.astype(np.uint8))
+
+
+class MVSegmenterBenchmarkTest(unittest.TestCase):
+    """Runs the benchmarks that need no scene on small synthetic volumes, so they keep working as the logic changes"""
+
+    def test_benchmarkSignedDistance(self):
+        size = (24, 28, 32)
+        results = MVSegmenterBenchmark().benchmarkSignedDistance(sizes=(size,), repeats=1)
+        self.assertEqual(list(results.keys()), [size])
+        for backend in ('maurer', 'narrowband'):
+            self.assertEqual(results[size][backend + 'DifferingVoxels'], 0)
+            self.assertLessEqual(results[size][backend + 'MaxBandError'], 1.0)
+
+    def test_benchmarkThreadScaling(self):
+        results = MVSegmenterBenchmark().benchmarkThreadScaling(threadCounts=[1, 2], size=(24, 28, 32))
+        self.assertEqual(set(results.keys()), {'speedImage', 'distance', 'activeContour', 'surface'})
+        for stage in results.values():
+            self.assertEqual(set(stage['time'].keys()), {1, 2})
+            self.assertEqual(stage['speedup'][1], 1.0)
+